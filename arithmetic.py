@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Arithmetic Expansion Module for Custom Shell
+
+Evaluates the expression of $((...)) with the operators of bash, on
+64-bit signed integers:
+
+    , = += -= *= /= %= <<= >>= &= ^= |= ?: || && | ^ & == != < <= > >=
+    << >> + - * / % ** ! ~ unary +/- and ++/-- (prefix and postfix)
+
+Names are shell variables: unset or empty ones count as 0, others are
+evaluated as expressions themselves. Numbers are decimal, 0x hex or
+0-prefixed octal. Parsed expressions are cached, so a loop evaluating
+$((i + 1)) parses it once.
+"""
+
+import functools
+import re
+from typing import Callable, List, Optional
+
+from variables import ExpansionError, Variables
+
+_TOKEN = re.compile(r"""\s*(?:
+    (0[xX][0-9a-fA-F]+|\d+)           # number
+  | ([A-Za-z_]\w*)                    # variable
+  | (\*\*=?|<<=|>>=|\+\+|--|&&|\|\||<=|>=|==|!=|<<|>>|[-+*/%&|^]=
+     |[-+*/%<>=!~&|^?:,()])           # operator
+  )""", re.VERBOSE)
+
+# Binary operators by precedence, loosest first
+_BINARY_LEVELS = (("||",), ("&&",), ("|",), ("^",), ("&",), ("==", "!="),
+                  ("<", "<=", ">", ">="), ("<<", ">>"), ("+", "-"),
+                  ("*", "/", "%"))
+
+_ASSIGNMENTS = ("=", "+=", "-=", "*=", "/=", "%=", "<<=", ">>=", "&=",
+                "^=", "|=", "**=")
+
+# Variables whose values are expressions may refer to each other
+_MAX_DEPTH = 64
+
+_BITS = 64
+
+
+def _wrap(value: int) -> int:
+    """Truncate to a 64-bit signed integer, as bash does"""
+    return (value + (1 << (_BITS - 1))) % (1 << _BITS) - (1 << (_BITS - 1))
+
+
+def _number(text: str) -> int:
+    if text[:2] in ("0x", "0X"):
+        return int(text, 16)
+    if len(text) > 1 and text[0] == "0":
+        try:
+            return int(text, 8)
+        except ValueError:
+            raise ExpansionError(f"{text}: value too great for base") \
+                from None
+    return int(text)
+
+
+def _tokenize(expression: str) -> List[str]:
+    tokens = []
+    i = 0
+    end = len(expression.rstrip())
+    while i < end:
+        match = _TOKEN.match(expression, i)
+        if match is None:
+            raise ExpansionError(f"{expression}: syntax error: invalid "
+                                 f"arithmetic operator (error token is "
+                                 f"\"{expression[i:].strip()}\")")
+        tokens.append(match.group().strip())
+        i = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser producing a tree of tuples"""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def peek(self) -> str:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return ""
+
+    def take(self) -> str:
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, token: str):
+        if self.take() != token:
+            self.error()
+
+    def error(self):
+        rest = " ".join(self.tokens[self.position - 1:]) or \
+            self.expression.strip()
+        raise ExpansionError(f"{self.expression.strip()}: syntax error in "
+                             f"expression (error token is \"{rest}\")")
+
+    def parse(self) -> tuple:
+        if not self.tokens:
+            return ("num", 0)
+        tree = self.comma()
+        if self.position != len(self.tokens):
+            self.position += 1
+            self.error()
+        return tree
+
+    def comma(self) -> tuple:
+        tree = self.assignment()
+        while self.peek() == ",":
+            self.take()
+            tree = ("comma", tree, self.assignment())
+        return tree
+
+    def assignment(self) -> tuple:
+        start = self.position
+        token = self.peek()
+        if token and (token[0].isalpha() or token[0] == "_") and \
+                self.position + 1 < len(self.tokens) and \
+                self.tokens[self.position + 1] in _ASSIGNMENTS:
+            self.position += 2
+            operator = self.tokens[start + 1]
+            return ("assign", operator[:-1], token, self.assignment())
+        return self.conditional()
+
+    def conditional(self) -> tuple:
+        tree = self.binary(0)
+        if self.peek() != "?":
+            return tree
+        self.take()
+        when_true = self.comma()
+        self.expect(":")
+        return ("cond", tree, when_true, self.conditional())
+
+    def binary(self, level: int) -> tuple:
+        if level == len(_BINARY_LEVELS):
+            return self.power()
+        operators = _BINARY_LEVELS[level]
+        tree = self.binary(level + 1)
+        while self.peek() in operators:
+            operator = self.take()
+            tree = ("binary", operator, tree, self.binary(level + 1))
+        return tree
+
+    def power(self) -> tuple:
+        tree = self.unary()
+        if self.peek() == "**":
+            self.take()
+            return ("binary", "**", tree, self.power())
+        return tree
+
+    def unary(self) -> tuple:
+        token = self.peek()
+        if token in ("++", "--"):
+            self.take()
+            name = self.take()
+            if not name or not (name[0].isalpha() or name[0] == "_"):
+                self.error()
+            return ("incr", True, 1 if token == "++" else -1, name)
+        if token in ("!", "~", "+", "-"):
+            self.take()
+            return ("unary", token, self.unary())
+        return self.postfix()
+
+    def postfix(self) -> tuple:
+        token = self.take()
+        if token == "(":
+            tree = self.comma()
+            self.expect(")")
+            return tree
+        if token[:1].isdigit():
+            return ("num", _number(token))
+        if token and (token[0].isalpha() or token[0] == "_"):
+            if self.peek() in ("++", "--"):
+                delta = 1 if self.take() == "++" else -1
+                return ("incr", False, delta, token)
+            return ("var", token)
+        self.error()
+
+
+@functools.lru_cache(maxsize=256)
+def parse(expression: str) -> tuple:
+    """Parse an arithmetic expression into a tree (cached)"""
+    return _Parser(expression).parse()
+
+
+def _divide(left: int, right: int, operator: str) -> int:
+    if right == 0:
+        raise ExpansionError("division by 0")
+    quotient = abs(left) // abs(right)
+    if (left < 0) != (right < 0):
+        quotient = -quotient
+    # Both truncate toward zero, like C
+    return quotient if operator == "/" else left - right * quotient
+
+
+def _apply(operator: str, left: int, right: int) -> int:
+    if operator == "+":
+        return left + right
+    if operator == "-":
+        return left - right
+    if operator == "*":
+        return left * right
+    if operator in ("/", "%"):
+        return _divide(left, right, operator)
+    if operator == "**":
+        if right < 0:
+            raise ExpansionError("exponent less than 0")
+        return pow(left, right, 1 << _BITS)
+    if operator in ("<<", ">>"):
+        if right < 0:
+            raise ExpansionError("negative shift count")
+        right = min(right, _BITS)   # the result wraps to 0 (or -1) anyway
+        return left << right if operator == "<<" else left >> right
+    if operator == "&":
+        return left & right
+    if operator == "|":
+        return left | right
+    if operator == "^":
+        return left ^ right
+    if operator == "==":
+        return int(left == right)
+    if operator == "!=":
+        return int(left != right)
+    if operator == "<":
+        return int(left < right)
+    if operator == "<=":
+        return int(left <= right)
+    if operator == ">":
+        return int(left > right)
+    return int(left >= right)   # ">="
+
+
+class _Evaluator:
+    """Evaluate a parsed tree against the shell variables"""
+
+    def __init__(self, variables: Variables,
+                 assign: Callable[[str, str], None]):
+        self.variables = variables
+        self.assign = assign
+        self.depth = 0
+
+    def value_of(self, name: str) -> int:
+        text = self.variables.get(name, "").strip()
+        if not text:
+            return 0
+        if text.lstrip("-").isdigit():
+            return _wrap(int(text, 10))
+        self.depth += 1
+        if self.depth > _MAX_DEPTH:
+            raise ExpansionError(f"{name}: expression recursion level "
+                                 f"exceeded")
+        try:
+            return self.evaluate(parse(text))
+        finally:
+            self.depth -= 1
+
+    def evaluate(self, tree: tuple) -> int:
+        kind = tree[0]
+        if kind == "num":
+            return _wrap(tree[1])
+        if kind == "var":
+            return self.value_of(tree[1])
+        if kind == "binary":
+            _, operator, left, right = tree
+            if operator == "&&":
+                return int(bool(self.evaluate(left))
+                           and bool(self.evaluate(right)))
+            if operator == "||":
+                return int(bool(self.evaluate(left))
+                           or bool(self.evaluate(right)))
+            return _wrap(_apply(operator, self.evaluate(left),
+                                self.evaluate(right)))
+        if kind == "unary":
+            _, operator, operand = tree
+            value = self.evaluate(operand)
+            if operator == "-":
+                return _wrap(-value)
+            if operator == "!":
+                return int(not value)
+            if operator == "~":
+                return ~value
+            return value
+        if kind == "cond":
+            _, condition, when_true, when_false = tree
+            return self.evaluate(when_true if self.evaluate(condition)
+                                 else when_false)
+        if kind == "assign":
+            _, operator, name, operand = tree
+            value = self.evaluate(operand)
+            if operator:
+                value = _apply(operator, self.value_of(name), value)
+            return self.store(name, _wrap(value))
+        if kind == "incr":
+            _, prefix, delta, name = tree
+            old = self.value_of(name)
+            new = self.store(name, _wrap(old + delta))
+            return new if prefix else old
+        # "comma"
+        self.evaluate(tree[1])
+        return self.evaluate(tree[2])
+
+    def store(self, name: str, value: int) -> int:
+        self.assign(name, str(value))
+        return value
+
+
+def evaluate(expression: str, variables: Variables,
+             assign: Optional[Callable[[str, str], None]] = None) -> int:
+    """
+    Evaluate the expression of a $((...)).
+
+    Assignments (x = 1, i++) go through assign(name, value), by default
+    variables.set; the shell passes its set_variable so that e.g.
+    $((HISTSIZE = 10)) has the same effect as HISTSIZE=10.
+
+    Raises:
+        ExpansionError: for syntax errors, division by 0 and the like
+    """
+    if assign is None:
+        assign = variables.set
+    return _Evaluator(variables, assign).evaluate(parse(expression))
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the shell implementation
+
+Usage:
+    python3 bench.py              # run every benchmark
+    python3 bench.py script_mode  # run only the named benchmark(s)
+"""
+
+import os
+import sys
+import time
+import functools
+import contextlib
+
+# Add current directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def report(label: str, count: int, elapsed: float, unit: str = "lines"):
+    """Print one benchmark result line"""
+    rate = count / elapsed if elapsed > 0 else float("inf")
+    print(f"  {label:<40} {count:>8} {unit} in {elapsed:7.3f}s "
+          f"= {rate:>12,.0f} {unit}/s")
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    """Send stdout to /dev/null for the duration of a benchmark"""
+    original = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = original
+
+
+def bench_script_mode(total_lines: int = 100_000):
+    """Lines/second for a builtin-only script, with and without parse cache"""
+    import shell
+    import utils
+
+    template = [
+        "echo building target $HOME/out",
+        "export BUILD_STEP=compile",
+        'echo "status: $?" done',
+        "echo ~/cache/objects",
+        "export BUILD_STEP=link",
+        "echo 'quoted # not a comment' # a comment",
+    ]
+    lines = [template[i % len(template)] for i in range(total_lines)]
+    parse_line = utils.parse_line
+    is_incomplete = shell.is_incomplete
+
+    # run_script also parses each line in is_incomplete(); "before" keeps
+    # that check cached so both runs differ by one parse per line: an
+    # uncached parse in execute_line against a cache hit
+    print(f"Script mode ({total_lines} lines, {len(template)} distinct):")
+    try:
+        for label, parser, incomplete in (
+                ("before (parse on every line)", parse_line.__wrapped__,
+                 functools.lru_cache(maxsize=None)(is_incomplete)),
+                ("after (cached parse tree)", parse_line, is_incomplete)):
+            shell.parse_line = parser
+            shell.is_incomplete = incomplete
+            parse_line.cache_clear()
+            shell.shell_state.running = True
+            with quiet_stdout():
+                start = time.perf_counter()
+                shell.run_script(lines)
+                elapsed = time.perf_counter() - start
+            report(label, total_lines, elapsed)
+    finally:
+        shell.parse_line = parse_line
+        shell.is_incomplete = is_incomplete
+        shell.shell_state.variables.unset("BUILD_STEP")
+
+
+def bench_spawn(count: int = 2000, resident_mb: int = 200):
+    """Commands/second for `true` from a shell with a large resident heap"""
+    import utils
+
+    # Touch every page so the ballast is really resident, as in a
+    # long-running shell with a big heap
+    ballast = bytearray(b"\x01") * (resident_mb * 1024 * 1024)
+
+    print(f"Spawn `true` x{count} with {resident_mb} MB resident:")
+    original = utils.spawn_backend
+    try:
+        for backend in utils.SPAWN_BACKENDS:
+            try:
+                utils.set_spawn_backend(backend)
+            except ValueError as e:
+                print(f"  {backend:<40} skipped ({e})")
+                continue
+            start = time.perf_counter()
+            for _ in range(count):
+                utils.execute_command(["true"])
+            elapsed = time.perf_counter() - start
+            report(backend, count, elapsed, unit="cmds")
+    finally:
+        utils.spawn_backend = original
+        del ballast
+
+
+def bench_environment(count: int = 1000, exported: int = 2000,
+                      size: int = 200):
+    """Spawn `true` with a large environment: cached bytes vs str mapping"""
+    import shell
+    import utils
+
+    variables = shell.shell_state.variables
+    names = [f"BENCH_ENV_{i}" for i in range(exported)]
+    for name in names:
+        variables.set(name, "x" * size, export=True)
+    path = utils.find_command("true")
+
+    print(f"Spawn `true` x{count} with {exported} exported variables:")
+    try:
+        variants = (
+            ("cached encoded environment", lambda: None),
+            ("str mapping (as os.environ)",
+             lambda: dict(variables.exported())))
+        for label, environment in variants:
+            start = time.perf_counter()
+            for _ in range(count):
+                pid = utils.spawn_process(["true"], path, env=environment())
+                os.waitpid(pid, 0)
+            elapsed = time.perf_counter() - start
+            report(label, count, elapsed, unit="cmds")
+
+        # Shell variables that are not exported leave the cache alone
+        rebuilds = variables.rebuilds
+        start = time.perf_counter()
+        for i in range(count):
+            variables.set("BENCH_COUNTER", str(i))
+            utils.spawn_process(["true"], path)
+            os.wait()
+        elapsed = time.perf_counter() - start
+        report(f"VAR=value before each "
+               f"({variables.rebuilds - rebuilds} rebuilds)",
+               count, elapsed, unit="cmds")
+    finally:
+        for name in names + ["BENCH_COUNTER"]:
+            variables.unset(name)
+
+
+def bench_history(entries: int = 1_000_000, lookups: int = 20):
+    """!prefix and substring lookups: indexes vs scanning every entry"""
+    from history import History
+
+    words = ["make", "git", "ls", "grep", "python3", "cargo", "docker", "ssh"]
+    # The entry looked up is the oldest one: the worst case for a scan
+    history = History(size=entries + 1)
+    history.add("kubectl rollout restart deploy/api")
+    for i in range(entries):
+        history.add(f"{words[i % len(words)]} target-{i % 9973} --job {i}")
+
+    lines = [line for _, line in history.items(len(history))]
+
+    def scan_prefix(prefix):
+        for line in reversed(lines):
+            if line.startswith(prefix):
+                return line
+
+    def scan_search(text):
+        for line in reversed(lines):
+            if text in line:
+                return line
+
+    print(f"History lookups ({entries} entries, {lookups} lookups each):")
+    for label, lookup in (("linear scan !kub", scan_prefix),
+                          ("indexed !kub", history.find_prefix),
+                          ("linear scan !?rollout?", scan_search),
+                          ("indexed !?rollout?",
+                           lambda text: history.search(text, limit=1))):
+        query = "kub" if "kub" in label else "rollout"
+        start = time.perf_counter()
+        for _ in range(lookups):
+            lookup(query)
+        report(label, lookups, time.perf_counter() - start, unit="lookups")
+
+
+def bench_aliases(lines: int = 20_000):
+    """Parse cost per command line with 0 to 10,000 aliases defined"""
+    import shell
+    import utils
+    from parser_mod import Alias
+
+    aliases = shell.shell_state.aliases
+    saved = dict(aliases)
+    parse = utils.parse_line.__wrapped__       # measure the uncached path
+    # Distinct lines, half of them starting with an alias
+    commands = [f"ll /tmp/dir{i} | grep -c x{i}" if i % 2 else
+                f"ls /tmp/dir{i} | wc -l" for i in range(lines)]
+
+    print(f"Parse with aliases ({lines} distinct lines):")
+    try:
+        for count in (0, 100, 1_000, 10_000):
+            aliases.clear()
+            for i in range(count - 1):
+                aliases[f"alias{i}"] = Alias(f"echo {i}", ("echo", str(i)))
+            if count:
+                aliases["ll"] = Alias("ls -l", ("ls", "-l"))
+            start = time.perf_counter()
+            for line in commands:
+                parse(line)
+            report(f"{count} aliases defined", lines,
+                   time.perf_counter() - start)
+
+        # The old way: tokenizing the alias value on every use
+        value = "ls -l --color=auto"
+        start = time.perf_counter()
+        for _ in range(lines):
+            utils.tokenize_command(value)
+        report("(for scale) tokenizing a value per use", lines,
+               time.perf_counter() - start)
+    finally:
+        aliases.clear()
+        aliases.update(saved)
+
+
+def bench_lexer(lines: int = 5_000):
+    """Tokenize + expand long lines: single-pass lexer vs shlex + regex"""
+    import shlex
+    import utils
+
+    def shlex_path(line):
+        # The previous parse_command(): shlex, then per-token regex passes
+        lexer = shlex.shlex(line, posix=True)
+        lexer.whitespace_split = True
+        lexer.commenters = "#"
+        return [utils._expand_tilde(utils._expand_variables(token))
+                for token in lexer]
+
+    def lexer_path(line):
+        return utils.expand_tokens(utils.tokenize_command(line))
+
+    segment = ('grep -E "error|warn" $HOME/logs/app-$USER.log '
+               "--color=never -n 'literal $x' ~/out/report.txt | ")
+    corpus = [segment * (4 + i % 8) + f"sort -k{i % 5} | uniq -c > /tmp/r{i}"
+              for i in range(lines)]
+    chars = sum(map(len, corpus))
+
+    print(f"Tokenize + expand ({lines} lines, {chars // lines} chars "
+          f"on average):")
+    for label, function in (("shlex + regex expansion", shlex_path),
+                            ("single-pass lexer", lexer_path)):
+        start = time.perf_counter()
+        for line in corpus:
+            function(line)
+        report(label, lines, time.perf_counter() - start)
+
+
+def bench_builtin_pipeline(count: int = 500):
+    """Latency of `echo $X | cat`: builtin on a thread vs forked vs /bin/echo"""
+    import shell
+    import utils
+
+    shell.shell_state.variables.set("BENCH_TEXT", "payload")
+    variants = (("builtin echo on a thread", "echo $BENCH_TEXT", True),
+                ("builtin echo in a forked subshell", "echo $BENCH_TEXT",
+                 False),
+                ("/bin/echo", "/bin/echo $BENCH_TEXT", True))
+    runs_on_thread = utils._runs_on_thread
+
+    print(f"Pipeline `echo $X | cat > /dev/null` x{count}:")
+    try:
+        for label, stage, threaded in variants:
+            if not threaded:
+                utils._runs_on_thread = lambda args: False
+            tree = utils.parse_line(f"{stage} | cat > /dev/null")
+            start = time.perf_counter()
+            for _ in range(count):
+                utils.execute_tree(tree)
+            elapsed = time.perf_counter() - start
+            utils._runs_on_thread = runs_on_thread
+            print(f"  {label:<40} {elapsed / count * 1e3:8.3f} ms/pipeline")
+    finally:
+        utils._runs_on_thread = runs_on_thread
+        shell.shell_state.variables.unset("BENCH_TEXT")
+
+
+def bench_substitution(count: int = 300, megabytes: int = 50):
+    """$(...) latency (in-process builtin vs forked) and capture throughput"""
+    import utils
+
+    runs_on_thread = utils._runs_on_thread
+    variants = (("$(echo $HOME) in-process", "echo $HOME", True),
+                ("$(echo $HOME) in a forked subshell", "echo $HOME", False),
+                ("$(/bin/echo $HOME)", "/bin/echo $HOME", True))
+
+    print(f"Command substitution x{count}:")
+    try:
+        for label, source, in_process in variants:
+            if not in_process:
+                utils._runs_on_thread = lambda args: False
+            start = time.perf_counter()
+            for _ in range(count):
+                utils.command_substitution(source)
+            elapsed = time.perf_counter() - start
+            utils._runs_on_thread = runs_on_thread
+            print(f"  {label:<40} {elapsed / count * 1e3:8.3f} ms")
+    finally:
+        utils._runs_on_thread = runs_on_thread
+
+    size = megabytes * 1024 * 1024
+    start = time.perf_counter()
+    output = utils.command_substitution(f"head -c {size} /dev/zero")
+    elapsed = time.perf_counter() - start
+    report(f"capture {megabytes} MB", len(output) // (1024 * 1024), elapsed,
+           unit="MB")
+
+
+def bench_glob(files: int = 200_000, repeats: int = 20):
+    """Repeated `echo DIR/*.gz` over a large directory, cached vs uncached"""
+    import glob
+    import shutil
+    import tempfile
+    import glob_mod
+    import utils
+
+    directory = tempfile.mkdtemp(prefix="bench_glob_")
+    try:
+        for i in range(files):
+            suffix = ".gz" if i % 10 == 0 else ".txt"
+            os.close(os.open(os.path.join(directory, f"f{i}{suffix}"),
+                             os.O_CREAT | os.O_WRONLY, 0o644))
+        # An old mtime makes the listing cacheable (see MTIME_GRANULARITY)
+        os.utime(directory, (time.time() - 60, time.time() - 60))
+        line = f"echo {directory}/*.gz"
+        tokens = utils.tokenize_command(line)
+
+        print(f"`echo DIR/*.gz` over {files} files x{repeats}:")
+        variants = (("cached listing", False), ("listing every time", True))
+        for label, uncached in variants:
+            glob_mod.directory_cache.clear()
+            utils.expand_tokens(tokens)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                if uncached:
+                    glob_mod.directory_cache.clear()
+                matched = len(utils.expand_tokens(tokens)) - 1
+            elapsed = time.perf_counter() - start
+            print(f"  {label:<40} {elapsed / repeats * 1e3:8.2f} ms"
+                  f"  ({matched} names)")
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            glob.glob(f"{directory}/*.gz")
+        elapsed = time.perf_counter() - start
+        print(f"  {'stdlib glob.glob':<40} {elapsed / repeats * 1e3:8.2f} ms")
+    finally:
+        glob_mod.directory_cache.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_loops(iterations: int = 100_000):
+    """for-loop throughput: body parsed once vs re-parsed every iteration"""
+    import shell
+    import utils
+
+    state = shell.shell_state
+    body = "BENCH_SUM=$((BENCH_SUM + i)); echo $BENCH_SUM"
+    loop = f"for i; do {body}; done"
+    parse = utils.parse_line.__wrapped__
+
+    def compiled():
+        utils.execute_tree(parse(loop))
+
+    def reparsed():
+        # What running the body through parse_command() each time costs
+        for item in state.positional:
+            state.variables.set("i", item)
+            utils.execute_tree(parse(body))
+
+    print(f"for loop, {iterations} iterations of `{body}`:")
+    state.positional = [str(i) for i in range(iterations)]
+    try:
+        for label, run in (("body re-parsed every iteration", reparsed),
+                           ("compiled tree (parsed once)", compiled)):
+            state.variables.set("BENCH_SUM", "0")
+            with quiet_stdout():
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+            report(label, iterations, elapsed, unit="iters")
+
+        count = iterations // 2
+        line = (f"BENCH_SUM=0; while [ $BENCH_SUM -lt {count} ]; do "
+                f"BENCH_SUM=$((BENCH_SUM + 1)); done")
+        start = time.perf_counter()
+        utils.execute_tree(parse(line))
+        elapsed = time.perf_counter() - start
+        report("while [ ... ] loop (test + arithmetic)", count, elapsed,
+               unit="iters")
+    finally:
+        state.positional = []
+        state.variables.unset("BENCH_SUM")
+        state.variables.unset("i")
+
+
+def bench_builtins(count: int = 1_000_000):
+    """Builtin lookup and dispatch through the registry"""
+    import utils
+
+    print(f"Builtin dispatch x{count}:")
+    for label, run in (
+            ("is_builtin_command('return')",
+             lambda: utils.is_builtin_command("return")),
+            ("is_builtin_command('ls') (not one)",
+             lambda: utils.is_builtin_command("ls")),
+            ("execute_builtin(['false'])",
+             lambda: utils.execute_builtin(["false"]))):
+        start = time.perf_counter()
+        for _ in range(count):
+            run()
+        elapsed = time.perf_counter() - start
+        report(label, count, elapsed, unit="calls")
+
+
+def bench_startup(count: int = 100):
+    """Wall time to start `shell.py -c true`, fast path vs argparse path"""
+    import subprocess
+
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+    print(f"Startup x{count} (python3 -c pass is the floor):")
+    for label, argv in (
+            ("python3 -c pass", ["-c", "pass"]),
+            ("shell.py -c true", [shell_path, "-c", "true"]),
+            ("shell.py -c true, argparse path",
+             [shell_path, "--pipeline-stderr", "inherit", "-c", "true"])):
+        start = time.perf_counter()
+        for _ in range(count):
+            subprocess.run([sys.executable] + argv, check=True)
+        elapsed = time.perf_counter() - start
+        report(label, count, elapsed, unit="starts")
+        print(f"  {'':<40} {elapsed / count * 1000:.1f} ms per start")
+
+
+BENCHMARKS = {
+    "script_mode": bench_script_mode,
+    "spawn": bench_spawn,
+    "environment": bench_environment,
+    "history": bench_history,
+    "aliases": bench_aliases,
+    "lexer": bench_lexer,
+    "builtin_pipeline": bench_builtin_pipeline,
+    "substitution": bench_substitution,
+    "glob": bench_glob,
+    "loops": bench_loops,
+    "builtins": bench_builtins,
+    "startup": bench_startup,
+}
+
+
+def main(argv):
+    names = argv or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} "
+                  f"(available: {', '.join(BENCHMARKS)})")
+            return 1
+    for name in names:
+        BENCHMARKS[name]()
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
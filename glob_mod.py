@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Pathname Expansion Module for Custom Shell
+
+Unquoted *, ?, [...] and ** in a word are matched against the file
+system. Directory listings are kept in a cache keyed by the directory's
+(device, inode) and checked against its modification time, so expanding
+'*.gz' in a directory of 200k files again only costs one stat() while the
+directory is unchanged:
+
+- a listing records every name plus which of them are directories, so
+  patterns with more components don't stat each entry
+- the paths matching each pattern are remembered with the listing
+- a directory modified within the last MTIME_GRANULARITY seconds is not
+  cached, since a change in the same clock tick would not alter its mtime
+- the cache is bounded by the number of names held (least recently used
+  listings are dropped first)
+
+Patterns follow the shell rules: names starting with '.' only match a
+component that starts with '.', '**' matches any number of directories
+(without following symlinks), a trailing '/' matches only directories,
+and a pattern that matches nothing is left to the caller to keep as is.
+"""
+
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+# Total names held by the default cache before old listings are dropped
+GLOB_CACHE_NAMES = 1_000_000
+
+# Directories modified this recently (seconds) are listed but not cached
+MTIME_GRANULARITY = 1.0
+
+# Patterns remembered per listing
+_MATCHES_PER_LISTING = 16
+
+_MAGIC = re.compile(r"[*?\[]")
+
+
+def has_magic(pattern: str) -> bool:
+    """True if pattern has an unescaped *, ? or ["""
+    if _MAGIC.search(pattern) is None:
+        return False
+    return _MAGIC.search(re.sub(r"\\.", "", pattern)) is not None
+
+
+def escape(text: str) -> str:
+    """Quote text so that it only matches itself in a pattern"""
+    return re.sub(r"([*?\[\\])", r"\\\1", text)
+
+
+def unescape(text: str) -> str:
+    """Undo escape(): the text a pattern without magic matches"""
+    return re.sub(r"\\(.)", r"\1", text)
+
+
+def translate(pattern: str) -> str:
+    """
+    Regular expression for one pattern component.
+
+    Supports *, ?, [abc], [a-z], [!abc] / [^abc] and backslash escapes;
+    a '[' without a closing ']' matches itself.
+    """
+    result = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        char = pattern[i]
+        i += 1
+        if char == "\\" and i < n:
+            result.append(re.escape(pattern[i]))
+            i += 1
+        elif char == "*":
+            if not result or result[-1] != ".*":
+                result.append(".*")
+        elif char == "?":
+            result.append(".")
+        elif char == "[":
+            j = i
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 2 if pattern[j] == "\\" else 1
+            if j >= n:
+                result.append("\\[")
+                continue
+            body = pattern[i:j]
+            i = j + 1
+            negate = body[:1] in ("!", "^")
+            if negate:
+                body = body[1:]
+            chars = []
+            k = 0
+            while k < len(body):
+                if body[k] == "\\" and k + 1 < len(body):
+                    k += 1
+                if k + 2 < len(body) and body[k + 1] == "-":
+                    low, high = body[k], body[k + 2]
+                    if low <= high:
+                        chars.append(f"{re.escape(low)}-{re.escape(high)}")
+                    k += 3
+                else:
+                    chars.append(re.escape(body[k]))
+                    k += 1
+            if not chars:
+                result.append("." if negate else "(?!)")
+            else:
+                result.append(("[^" if negate else "[") + "".join(chars) + "]")
+        else:
+            result.append(re.escape(char))
+    return "(?s:" + "".join(result) + r")\Z"
+
+
+class _Listing:
+    """The entries of one directory at one modification time"""
+
+    __slots__ = ("mtime", "names", "dirs", "matches")
+
+    def __init__(self, mtime: int, names: List[str], dirs: FrozenSet[str]):
+        self.mtime = mtime
+        self.names = names                # sorted
+        self.dirs = dirs                  # names that are directories
+        # (directory path, component, dirs only) -> matching paths
+        self.matches: Dict[Tuple[str, str, bool], List[str]] = {}
+
+
+class DirectoryCache:
+    """Directory listings keyed by (device, inode), checked by mtime"""
+
+    def __init__(self, max_names: int = GLOB_CACHE_NAMES):
+        self.max_names = max_names
+        self._listings: "OrderedDict[Tuple[int, int], _Listing]" = \
+            OrderedDict()
+        self._names = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._listings)
+
+    def clear(self):
+        self._listings.clear()
+        self._names = 0
+
+    def listing(self, path: str) -> Optional[_Listing]:
+        """The entries of directory path, or None if it can't be read"""
+        try:
+            info = os.stat(path or ".")
+        except OSError:
+            return None
+        key = (info.st_dev, info.st_ino)
+
+        listing = self._listings.get(key)
+        if listing is not None and listing.mtime == info.st_mtime_ns:
+            self._listings.move_to_end(key)
+            self.hits += 1
+            return listing
+        if listing is not None:
+            self._drop(key)
+        self.misses += 1
+
+        names = []
+        dirs = []
+        try:
+            with os.scandir(path or ".") as entries:
+                for entry in entries:
+                    names.append(entry.name)
+                    try:
+                        # Symlinks to directories count; ** checks separately
+                        if entry.is_dir():
+                            dirs.append(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            return None
+        names.sort()
+        listing = _Listing(info.st_mtime_ns, names, frozenset(dirs))
+
+        if time.time() - info.st_mtime_ns / 1e9 >= MTIME_GRANULARITY \
+                and len(names) <= self.max_names:
+            self._listings[key] = listing
+            self._names += len(names)
+            while self._names > self.max_names:
+                self._drop(next(iter(self._listings)))
+        return listing
+
+    def _drop(self, key: Tuple[int, int]):
+        listing = self._listings.pop(key)
+        self._names -= len(listing.names)
+
+    def match(self, path: str, component: str,
+              dirs_only: bool = False) -> List[str]:
+        """Paths of the entries of directory path matching one component"""
+        listing = self.listing(path)
+        if listing is None:
+            return []
+        key = (path, component, dirs_only)
+        paths = listing.matches.get(key)
+        if paths is not None:
+            return paths
+
+        matcher = re.compile(translate(component)).match
+        hidden = component.startswith(".") or component.startswith("\\.")
+        candidates = listing.names
+        if dirs_only:
+            candidates = [name for name in candidates if name in listing.dirs]
+        prefix = _join(path, "")
+        paths = [prefix + name for name in candidates
+                 if (hidden or name[0] != ".") and matcher(name)]
+
+        if len(listing.matches) >= _MATCHES_PER_LISTING:
+            listing.matches.pop(next(iter(listing.matches)))
+        listing.matches[key] = paths
+        return paths
+
+    def walk(self, path: str) -> List[str]:
+        """path and every non-hidden directory below it (for **)"""
+        found = [path]
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            listing = self.listing(directory)
+            if listing is None:
+                continue
+            for name in sorted(listing.dirs, reverse=True):
+                if name[0] == ".":
+                    continue
+                child = _join(directory, name)
+                if os.path.islink(child):
+                    continue
+                found.append(child)
+                pending.append(child)
+        return found
+
+
+# Shared by every expansion in the shell
+directory_cache = DirectoryCache()
+
+
+def _join(directory: str, name: str) -> str:
+    if not directory:
+        return name
+    if directory.endswith("/"):
+        return directory + name
+    return directory + "/" + name
+
+
+def glob(pattern: str, cache: Optional[DirectoryCache] = None) -> List[str]:
+    """
+    Expand a pathname pattern (backslash escapes quote characters).
+
+    Returns:
+        The matching paths, sorted, or [] if nothing matches
+    """
+    if cache is None:
+        cache = directory_cache
+    if not has_magic(pattern):
+        path = unescape(pattern)
+        return [path] if os.path.lexists(path) else []
+
+    absolute = pattern.startswith("/")
+    components = pattern.split("/")
+    if absolute:
+        components = components[1:]
+    dirs_only = components[-1] == ""
+    if dirs_only:
+        components.pop()
+    components = [c for c in components if c]
+
+    paths = ["/"] if absolute else [""]
+    literal = True   # the paths so far were not checked to exist
+    for index, component in enumerate(components):
+        last = index == len(components) - 1
+        if component == "**":
+            expanded = []
+            for path in paths:
+                expanded.extend(cache.walk(path))
+            paths = expanded
+            literal = False
+            if last:
+                # A trailing ** names the directories themselves
+                paths = [p for p in paths if p]
+                dirs_only = True
+            continue
+
+        if not has_magic(component):
+            name = unescape(component)
+            paths = [_join(path, name) for path in paths]
+            literal = True
+            continue
+
+        expanded = []
+        for path in paths:
+            expanded.extend(cache.match(path, component,
+                                        dirs_only=not last or dirs_only))
+        paths = expanded
+        literal = False
+        if not paths:
+            return []
+
+    if literal:
+        paths = [p for p in paths if os.path.lexists(p)]
+    if dirs_only:
+        paths = [p if p.endswith("/") else p + "/"
+                 for p in paths if os.path.isdir(p)]
+    return sorted(paths)
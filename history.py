@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Command History Module for Custom Shell
+
+History is kept in a bounded store (HISTSIZE entries; the oldest are
+dropped) and persisted by appending to HISTFILE in batches. Entries keep
+the number they were given when added, so 'history' listings and !n stay
+stable while old entries are evicted.
+
+Lookups avoid scanning the whole history:
+- !n / !-n: entries live in a list with a start offset, so a number maps
+  straight to a position
+- !prefix: the newest entry for every prefix of a first word is kept in
+  a dict; longer prefixes only scan the entries with that first word
+- !?text? and 'history -s text': posting lists of the entries containing
+  each 3-character substring (trigram); only the shortest list is checked
+
+Evicted entries are dropped from the indexes lazily: indexes are rebuilt
+after as many evictions as the history holds, so upkeep is O(1) amortized.
+
+HISTFILE holds one entry per line. A command continued over several
+lines is one entry, so its backslashes and newlines are written as
+backslash-backslash and backslash-n, and turned back when it is read.
+"""
+
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Defaults for $HISTSIZE and $HISTFILE
+DEFAULT_HISTSIZE = 1000
+DEFAULT_HISTFILE = "~/.pyshell_history"
+
+# New entries are written to HISTFILE once this many are pending (and on exit)
+HISTORY_FLUSH_BATCH = 32
+
+# Prefixes of a first word longer than this are not indexed
+_PREFIX_INDEX_LENGTH = 16
+
+# An escape in a HISTFILE line (see _encode)
+_ESCAPE = re.compile(r"\\(.)")
+
+
+def _encode(entry: str) -> str:
+    """An entry as one HISTFILE line"""
+    return entry.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _decode(line: str) -> str:
+    """The entry stored in a HISTFILE line (see _encode)"""
+    if "\\" not in line:
+        return line
+    return _ESCAPE.sub(lambda match: "\n" if match.group(1) == "n"
+                       else match.group(1) if match.group(1) == "\\"
+                       else match.group(0), line)
+
+
+class EventNotFound(ValueError):
+    """Raised when a !-expansion refers to no history entry"""
+
+
+def _trigrams(text: str):
+    """Distinct 3-character substrings of text"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class History:
+    """Bounded command history with persistence and lookup indexes"""
+
+    def __init__(self, size: int = DEFAULT_HISTSIZE,
+                 path: Optional[str] = None):
+        self.size = max(0, size)
+        self.path = path              # HISTFILE, None: don't persist
+        self._entries: List[str] = []
+        self._head = 0                # position of the oldest live entry
+        self._first = 1               # history number of _entries[_head]
+        self._unsaved: List[str] = []  # added since the last flush
+        self._evicted = 0             # evictions since indexes were built
+        self._by_word: Dict[str, List[int]] = {}
+        self._by_prefix: Dict[str, int] = {}
+        self._by_trigram: Dict[str, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries) - self._head
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        """Iterate (number, line) from the oldest entry"""
+        return iter(list(self.items(len(self))))
+
+    @property
+    def first(self) -> int:
+        """Number of the oldest entry"""
+        return self._first
+
+    @property
+    def last(self) -> int:
+        """Number of the newest entry (first - 1 if empty)"""
+        return self._first + len(self) - 1
+
+    def get(self, number: int) -> Optional[str]:
+        """The entry with the given history number"""
+        if number < self._first or number > self.last:
+            return None
+        return self._entries[self._head + number - self._first]
+
+    def items(self, count: int) -> List[Tuple[int, str]]:
+        """The newest count entries as (number, line), oldest first"""
+        count = max(0, min(count, len(self)))
+        start = len(self._entries) - count
+        number = self.last - count + 1
+        return [(number + i, line)
+                for i, line in enumerate(self._entries[start:])]
+
+    # -- adding and evicting --------------------------------------------------
+
+    def add(self, line: str, save: bool = True):
+        """Append a line, evicting the oldest entry beyond the size cap"""
+        if self.size == 0:
+            return
+        self._entries.append(line)
+        self._index(self.last, line)
+        if save and self.path is not None:
+            self._unsaved.append(line)
+            if len(self._unsaved) >= HISTORY_FLUSH_BATCH:
+                self.flush()
+        self._trim()
+
+    def resize(self, size: int):
+        """Change the cap (HISTSIZE), evicting entries if needed"""
+        self.size = max(0, size)
+        self._trim()
+
+    def clear(self):
+        """Forget every entry (numbering continues)"""
+        self._first = self.last + 1
+        self._entries = []
+        self._head = 0
+        self._evicted = 0
+        self._rebuild()
+
+    def _trim(self):
+        excess = len(self) - self.size
+        if excess <= 0:
+            return
+        self._head += excess
+        self._first += excess
+        self._evicted += excess
+        if self._head > len(self._entries) // 2:
+            del self._entries[:self._head]
+            self._head = 0
+        if self._evicted >= max(self.size, 1):
+            self._rebuild()
+
+    def _index(self, number: int, line: str):
+        words = line.split(None, 1)
+        if words:
+            word = words[0]
+            self._by_word.setdefault(word, []).append(number)
+            for i in range(1, min(len(word), _PREFIX_INDEX_LENGTH) + 1):
+                self._by_prefix[word[:i]] = number
+        for trigram in _trigrams(line):
+            self._by_trigram.setdefault(trigram, []).append(number)
+
+    def _rebuild(self):
+        """Rebuild the indexes from the live entries only"""
+        self._by_word = {}
+        self._by_prefix = {}
+        self._by_trigram = {}
+        self._evicted = 0
+        for number, line in self.items(len(self)):
+            self._index(number, line)
+
+    # -- searching -------------------------------------------------------------
+
+    def find_prefix(self, prefix: str) -> Optional[int]:
+        """Number of the newest entry starting with prefix (!prefix)"""
+        if not prefix:
+            return None
+        word = prefix.split(None, 1)[0]
+
+        if word == prefix and len(prefix) <= _PREFIX_INDEX_LENGTH:
+            number = self._by_prefix.get(prefix)
+            return number if number is not None \
+                and number >= self._first else None
+
+        if word == prefix:
+            # Long prefix: newest entry of each matching first word
+            candidates = sorted((numbers[-1] for w, numbers
+                                 in self._by_word.items()
+                                 if w.startswith(prefix)), reverse=True)
+        else:
+            candidates = reversed(self._by_word.get(word, ()))
+        for number in candidates:
+            if number < self._first:
+                break
+            if self.get(number).startswith(prefix):
+                return number
+        return None
+
+    def search(self, text: str, limit: Optional[int] = None) -> List[int]:
+        """Numbers of the entries containing text, newest first"""
+        if len(text) < 3:
+            candidates = range(self.last, self._first - 1, -1)
+        else:
+            postings = [self._by_trigram.get(t, ()) for t in _trigrams(text)]
+            candidates = reversed(min(postings, key=len))
+
+        found = []
+        for number in candidates:
+            if number < self._first:
+                break
+            if text in self.get(number):
+                found.append(number)
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    # -- !-expansion -----------------------------------------------------------
+
+    def expand(self, line: str) -> str:
+        """
+        Apply history expansion to line.
+
+        Supports !!, !n, !-n, !prefix, !?text? and !$ (last word of the
+        previous command). A '!' in single quotes, escaped with a backslash,
+        or followed by a blank, '=' or '(' is left alone, and so is '[!'
+        (a negated pattern bracket).
+
+        Raises:
+            EventNotFound: if a reference matches no entry
+        """
+        if "!" not in line:
+            return line
+
+        result = []
+        i = 0
+        quoted = False
+        while i < len(line):
+            char = line[i]
+            if char == "'":
+                quoted = not quoted
+            elif char == "\\" and i + 1 < len(line) and not quoted:
+                result.append(line[i:i + 2])
+                i += 2
+                continue
+            elif char == "!" and not quoted and i + 1 < len(line) \
+                    and line[i + 1] not in " \t=(" \
+                    and (i == 0 or line[i - 1] != "["):
+                text, i = self._event(line, i + 1)
+                result.append(text)
+                continue
+            result.append(char)
+            i += 1
+        return "".join(result)
+
+    def _event(self, line: str, i: int) -> Tuple[str, int]:
+        """Resolve the event starting after '!' at line[i:]"""
+        char = line[i]
+        if char == "!":
+            return self._entry(self.last, "!!"), i + 1
+
+        if char == "$":
+            words = self._entry(self.last, "!$").split()
+            return (words[-1] if words else ""), i + 1
+
+        if char == "?":
+            end = line.find("?", i + 1)
+            stop = len(line) if end == -1 else end
+            text = line[i + 1:stop]
+            found = self.search(text, limit=1) if text else []
+            if not found:
+                raise EventNotFound(f"!?{text}: event not found")
+            return self.get(found[0]), (len(line) if end == -1 else end + 1)
+
+        end = i
+        if char == "-":
+            end += 1
+        while end < len(line) and line[end].isdigit():
+            end += 1
+        digits = line[i:end]
+        if digits.lstrip("-").isdigit():
+            number = int(digits)
+            if number < 0:
+                number = self.last + 1 + number
+            return self._entry(number, "!" + digits), end
+
+        end = i
+        while end < len(line) and not line[end].isspace() \
+                and line[end] not in ";|&<>()":
+            end += 1
+        prefix = line[i:end]
+        number = self.find_prefix(prefix)
+        if number is None:
+            raise EventNotFound(f"!{prefix}: event not found")
+        return self.get(number), end
+
+    def _entry(self, number: int, event: str) -> str:
+        line = self.get(number)
+        if line is None:
+            raise EventNotFound(f"{event}: event not found")
+        return line
+
+    # -- persistence -----------------------------------------------------------
+
+    def load(self):
+        """Read the newest size entries from HISTFILE (compacting it)"""
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r", errors="replace") as stream:
+                lines = stream.read().splitlines()
+        except FileNotFoundError:
+            return
+        except OSError:
+            return
+
+        for line in lines[-self.size:] if self.size else ():
+            self.add(_decode(line), save=False)
+
+        # The file is append-only while we run; keep it bounded across runs
+        if len(lines) > 2 * max(self.size, 1):
+            self._write_all()
+
+    def flush(self):
+        """Append the pending entries to HISTFILE in one write"""
+        if self.path is None or not self._unsaved:
+            return
+        data = "".join(_encode(line) + "\n" for line in self._unsaved)
+        self._unsaved = []
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o600)
+            try:
+                os.write(fd, data.encode(errors="replace"))
+            finally:
+                os.close(fd)
+        except OSError:
+            pass  # History is best effort
+
+    def _write_all(self):
+        """Replace HISTFILE with the live entries"""
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "w") as stream:
+                for _, line in self.items(len(self)):
+                    stream.write(_encode(line) + "\n")
+            os.replace(temporary, self.path)
+        except OSError:
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+
+def history_from_environment() -> History:
+    """A History configured from $HISTSIZE and $HISTFILE"""
+    size = os.environ.get("HISTSIZE", "")
+    path = os.environ.get("HISTFILE", DEFAULT_HISTFILE)
+    return History(int(size) if size.isdigit() else DEFAULT_HISTSIZE,
+                   os.path.expanduser(path) if path else None)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Job Table Module for Custom Shell
+
+Background pipelines are tracked as jobs. The table is indexed both by
+job number (for 'jobs', '%n') and by PID (for the reaper), so looking up,
+adding and retiring a job are O(1) regardless of how many are running.
+Under job control every job runs in its own process group (pgid).
+"""
+
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+# Job states
+RUNNING = "Running"
+STOPPED = "Stopped"
+DONE = "Done"
+
+
+class Job:
+    """One background pipeline"""
+
+    __slots__ = ("job_id", "pids", "pgid", "command", "started", "state",
+                 "exit_status", "term_signal", "remaining")
+
+    def __init__(self, job_id: int, pids: List[int], command: str,
+                 pgid: Optional[int] = None, state: str = RUNNING):
+        self.job_id = job_id
+        self.pids = pids                  # every stage, last one last
+        self.pgid = pgid                  # process group (job control only)
+        self.command = command            # command line shown by 'jobs'
+        self.started = time.time()
+        self.state = state
+        self.exit_status = None           # exit status of the last stage
+        self.term_signal = None           # set if the last stage was killed
+        self.remaining = len(pids)        # stages not reaped yet
+
+    def __repr__(self):
+        return f"Job({self.job_id}, {self.pids!r}, {self.state})"
+
+
+class JobTable:
+    """Background jobs indexed by job number and by PID"""
+
+    def __init__(self):
+        self.by_id: Dict[int, Job] = {}
+        self.by_pid: Dict[int, Job] = {}
+        self._next_id = 1
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __iter__(self) -> Iterator[Job]:
+        """Iterate jobs in job number order"""
+        return iter(list(self.by_id.values()))
+
+    def add(self, pids: List[int], command: str,
+            pgid: Optional[int] = None, state: str = RUNNING) -> Job:
+        """Register a new job and return it"""
+        job = Job(self._next_id, list(pids), command, pgid, state)
+        self._next_id += 1
+        self.by_id[job.job_id] = job
+        for pid in job.pids:
+            self.by_pid[pid] = job
+        return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        """Look up a job by number"""
+        return self.by_id.get(job_id)
+
+    def job_for_pid(self, pid: int) -> Optional[Job]:
+        """Look up the job a process belongs to"""
+        return self.by_pid.get(pid)
+
+    def current(self) -> Optional[Job]:
+        """The most recently started job (the default for fg/bg/wait)"""
+        if not self.by_id:
+            return None
+        return next(reversed(self.by_id.values()))
+
+    def live_pids(self, job: Job) -> List[int]:
+        """Processes of job that have not been reaped yet"""
+        return [pid for pid in job.pids if self.by_pid.get(pid) is job]
+
+    def pids(self) -> List[int]:
+        """PIDs of every process still tracked"""
+        return list(self.by_pid)
+
+    def child_exited(self, pid: int, status: int) -> Optional[Job]:
+        """
+        Record the wait status of a reaped process.
+
+        Returns:
+            The job if this was its last running process (now DONE),
+            otherwise None
+        """
+        job = self.by_pid.pop(pid, None)
+        if job is None:
+            return None
+
+        if pid == job.pids[-1]:
+            if os.WIFSIGNALED(status):
+                job.term_signal = os.WTERMSIG(status)
+                job.exit_status = 128 + job.term_signal
+            elif os.WIFEXITED(status):
+                job.exit_status = os.WEXITSTATUS(status)
+            else:
+                job.exit_status = 1
+
+        job.remaining -= 1
+        if job.remaining > 0:
+            return None
+
+        job.state = DONE
+        return job
+
+    def child_stopped(self, pid: int) -> Optional[Job]:
+        """
+        Record that a process was stopped (Ctrl+Z, SIGSTOP, SIGTTIN).
+
+        Returns:
+            The job if it just went from running to stopped, otherwise None
+        """
+        job = self.by_pid.get(pid)
+        if job is None or job.state == STOPPED:
+            return None
+        job.state = STOPPED
+        return job
+
+    def child_continued(self, pid: int):
+        """Record that a stopped process was resumed with SIGCONT"""
+        job = self.by_pid.get(pid)
+        if job is not None:
+            job.state = RUNNING
+
+    def remove(self, job: Job):
+        """Forget a job (and any of its processes still listed)"""
+        self.by_id.pop(job.job_id, None)
+        for pid in job.pids:
+            if self.by_pid.get(pid) is job:
+                del self.by_pid[pid]
+        if not self.by_id:
+            # Numbering restarts once every job has finished, as in bash
+            self._next_id = 1
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""
+Lexer Module for Custom Shell
+
+A single-pass tokenizer for command lines. One scan over the line:
+- splits words on blanks and on operators, even without spaces around
+  them (a>b, a|b): |  ||  &  &&  ;  <  >  >>  >&  <&  &>  &>>  <<<
+  <<  <<-  and fd-prefixed redirections such as 2> or 2>&
+- removes quotes while remembering which text was quoted: '...' is
+  literal, "..." still expands $VAR, a backslash quotes one character
+- records expansion sites ($VAR, ${...}, $?, $(...), $((...)), a
+  leading ~) as
+  separate word parts, so expansion never re-scans the text
+- drops '#' comments that start a word (up to the end of that line)
+- reads here-document bodies (<<EOF) from the lines after the command
+  and puts them in place of the delimiter word
+
+Words come out as Word objects made of (kind, text, quoted) parts;
+operators come out as plain strings. Input that stops in the middle of a
+command (open quote, trailing backslash, here-document without its
+delimiter line) raises IncompleteInput, so the caller can read more lines.
+"""
+
+import functools
+import re
+from typing import List, Optional, Tuple, Union
+
+# Word part kinds
+LITERAL = "literal"     # text as written (quotes removed)
+PARAM = "param"         # $NAME, $?, $1, ${...}: text is what's inside
+COMMAND = "command"     # $(...): text is the command inside
+ARITH = "arith"         # $((...)): text is the expression inside
+TILDE = "tilde"         # leading ~ or ~user (unquoted only)
+
+# Operators, longest first so '>>' wins over '>'
+OPERATORS = ("&>>", "<<<", "<<-", "&&", "||", ">>", "<<", ">&", "<&", "&>",
+             "|", "&", ";", "<", ">")
+HEREDOC_OPERATORS = ("<<", "<<-")
+
+# Operators after which a newline does not end the command
+_CONTINUING_OPERATORS = frozenset(("|", "&&", "||", ";", "&"))
+_OPERATOR_CHARS = frozenset("|&;<>")
+_BLANKS = " \t\n"
+
+# Runs of characters with no special meaning in each context
+_PLAIN = re.compile(r"[^\s'\"\\$|&;<>]+")
+_DQUOTED_PLAIN = re.compile(r'[^"\\$]+')
+_OPERAND_PLAIN = re.compile(r"[^'\"\\$]+")
+_NAME = re.compile(r"\w+")
+_SPECIAL_PARAMETERS = frozenset("?#@*0123456789")
+_TILDE_PREFIX = re.compile(r"~[\w.-]*")
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+# Characters a backslash escapes inside double quotes
+_DQUOTE_ESCAPES = '$`"\\\n'
+
+Part = Tuple[str, str, bool]
+
+
+class ParseError(ValueError):
+    """Raised for syntactically invalid command lines"""
+
+
+class IncompleteInput(ParseError):
+    """Raised when a command continues on the next input line"""
+
+
+class Word:
+    """
+    One shell word as a sequence of (kind, text, quoted) parts.
+
+    static is the word's final value when it has nothing to expand (the
+    common case), so the executor can skip expansion entirely. keyword is
+    the text of a plain unquoted word (for aliases and reserved words).
+    glob is set if the word has unquoted *, ? or [ (a pathname pattern).
+    """
+
+    __slots__ = ("parts", "static", "keyword", "glob")
+
+    def __init__(self, parts: List[Part]):
+        self.parts = parts = tuple(parts)
+        self.static = self.keyword = None
+        self.glob = any(kind is LITERAL and not quoted
+                        and _GLOB_CHARS.search(text) is not None
+                        for kind, text, quoted in parts)
+
+        if len(parts) == 1:
+            # Most words are one plain or one quoted run
+            kind, text, quoted = parts[0]
+            if kind is LITERAL:
+                if not self.glob:
+                    self.static = text
+                if not quoted:
+                    self.keyword = text
+        elif not self.glob and all(kind is LITERAL for kind, _, _ in parts):
+            self.static = "".join(text for _, text, _ in parts)
+
+    @property
+    def text(self) -> str:
+        """The word as written, minus quotes (for messages and listings)"""
+        out = []
+        for kind, text, _ in self.parts:
+            if kind is PARAM:
+                simple = text in _SPECIAL_PARAMETERS or (
+                    _NAME.fullmatch(text) and not text[0].isdigit())
+                out.append("$" + text if simple else "${" + text + "}")
+            elif kind is COMMAND:
+                out.append("$(" + text + ")")
+            elif kind is ARITH:
+                out.append("$((" + text + "))")
+            else:
+                out.append(text)
+        return "".join(out)
+
+    def __repr__(self):
+        return f"Word({self.text!r})"
+
+
+class HereDoc(Word):
+    """The body of a here-document, standing in for its delimiter word"""
+
+    __slots__ = ("delimiter",)
+
+    def __init__(self, parts: List[Part], delimiter: str):
+        super().__init__(parts)
+        self.delimiter = delimiter      # as written, for listings
+
+    def __repr__(self):
+        return f"HereDoc({self.delimiter!r}, {self.text!r})"
+
+
+Token = Union[Word, str]
+
+
+def _parameter(line: str, i: int, parts: List[Part], quoted: bool) -> int:
+    """Scan the expansion starting at the '$' at line[i]; return the end"""
+    nxt = line[i + 1:i + 2]
+
+    if nxt == "{":
+        depth = 1
+        j = i + 2
+        while j < len(line):
+            if line.startswith("${", j):
+                depth += 1
+                j += 1
+            elif line[j] == "}":
+                depth -= 1
+                if depth == 0:
+                    break
+            j += 1
+        else:
+            raise ParseError("unexpected end of line looking for '}'")
+        if j == i + 2:
+            raise ParseError("${}: bad substitution")
+        parts.append((PARAM, line[i + 2:j], quoted))
+        return j + 1
+
+    if nxt and nxt in _SPECIAL_PARAMETERS:
+        # $? $# $@ $*, and $1..$9 (one digit: $10 is ${1}0)
+        parts.append((PARAM, nxt, quoted))
+        return i + 2
+
+    if nxt == "(":
+        if line.startswith("((", i + 1):
+            end = _arithmetic_end(line, i + 3)
+            if end != -1:
+                parts.append((ARITH, line[i + 3:end], quoted))
+                return end + 2
+        end = _command_end(line, i + 2)
+        parts.append((COMMAND, line[i + 2:end], quoted))
+        return end + 1
+
+    match = _NAME.match(line, i + 1)
+    if match:
+        parts.append((PARAM, match.group(), quoted))
+        return match.end()
+
+    parts.append((LITERAL, "$", quoted))
+    return i + 1
+
+
+def _arithmetic_end(line: str, i: int) -> int:
+    """
+    Find the '))' closing a $(( whose expression starts at line[i].
+
+    Returns -1 if the parentheses don't close with '))' (then it is a
+    $( ( ...) ) command substitution holding a subshell).
+    """
+    depth = 0
+    for j in range(i, len(line)):
+        char = line[j]
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            if depth == 0:
+                return j if line.startswith("))", j) else -1
+            depth -= 1
+    return -1
+
+
+def _command_end(line: str, i: int) -> int:
+    """Find the ')' closing a $( whose command starts at line[i]"""
+    depth = 1
+    n = len(line)
+    while i < n:
+        char = line[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                break
+            i = end + 1
+            continue
+        if char == '"':
+            i = _double_quoted(line, i + 1, [])
+            continue
+        if char == "$" and line.startswith("$(", i):
+            i = _command_end(line, i + 2) + 1
+            continue
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise IncompleteInput("unexpected end of line looking for ')'")
+
+
+def _double_quoted(line: str, i: int, parts: List[Part],
+                   closing: Optional[str] = '"') -> int:
+    """
+    Scan "..." starting after the opening quote; return the end.
+
+    With closing=None, scan to the end of line instead (the expanding
+    form of a here-document body, where '"' has no special meaning).
+    """
+    n = len(line)
+    while i < n:
+        char = line[i]
+        if char == closing:
+            return i + 1
+        if char == "$":
+            i = _parameter(line, i, parts, True)
+        elif char == "\\":
+            if line[i + 1:i + 2] and line[i + 1] in _DQUOTE_ESCAPES:
+                if line[i + 1] != "\n":
+                    parts.append((LITERAL, line[i + 1], True))
+                i += 2
+            else:
+                parts.append((LITERAL, "\\", True))
+                i += 1
+        elif char == '"':
+            parts.append((LITERAL, char, True))
+            i += 1
+        else:
+            match = _DQUOTED_PLAIN.match(line, i)
+            parts.append((LITERAL, match.group(), True))
+            i = match.end()
+    if closing is None:
+        return i
+    raise IncompleteInput("unexpected end of line looking for '\"'")
+
+
+def _merge(parts: List[Part]) -> List[Part]:
+    """Join neighbouring literal parts with the same quoting"""
+    if len(parts) == 1:
+        return parts
+    merged: List[Part] = []
+    for part in parts:
+        if merged and part[0] is LITERAL and merged[-1][0] is LITERAL \
+                and merged[-1][2] == part[2]:
+            merged[-1] = (LITERAL, merged[-1][1] + part[1], part[2])
+        else:
+            merged.append(part)
+    return merged
+
+
+def _heredoc_body(line: str, i: int, delimiter: Word,
+                  strip_tabs: bool) -> Tuple[HereDoc, int]:
+    """
+    Read a here-document body from the lines starting at line[i:] up to
+    the delimiter line; return the body and the position after it.
+
+    A quoted delimiter ('EOF', "EOF", \\EOF) keeps the body literal;
+    otherwise $-expansions in it are recorded as for "...".
+    """
+    end_text = "".join(text for _, text, _ in delimiter.parts)
+    body = []
+    n = len(line)
+    while True:
+        if i >= n:
+            raise IncompleteInput(
+                f"here-document: missing delimiter line '{end_text}'")
+        newline = line.find("\n", i)
+        stop = n if newline == -1 else newline
+        text = line[i:stop]
+        if strip_tabs:
+            text = text.lstrip("\t")
+        i = stop + 1
+        if text == end_text:
+            break
+        body.append(text + "\n")
+
+    body_text = "".join(body)
+    parts: List[Part] = [(LITERAL, body_text, True)]
+    if body_text and not any(quoted for _, _, quoted in delimiter.parts):
+        parts = []
+        _double_quoted(body_text, 0, parts, closing=None)
+        parts = _merge(parts)
+    return HereDoc(parts, delimiter.text), min(i, n)
+
+
+def _read_heredocs(line: str, i: int, tokens: List[Token],
+                   start: int) -> int:
+    """
+    Replace the delimiter of every here-document in tokens[start:] with
+    its body, read from line[i:]; return the position after the bodies.
+    """
+    for index in range(max(start, 1), len(tokens)):
+        operator = tokens[index - 1]
+        if isinstance(operator, str) and \
+                operator.lstrip("0123456789") in HEREDOC_OPERATORS and \
+                type(tokens[index]) is Word:
+            body, i = _heredoc_body(line, i, tokens[index],
+                                    operator.endswith("-"))
+            tokens[index] = body
+    return i
+
+
+def tokenize(line: str) -> List[Token]:
+    """
+    Split a command line into Words and operator strings in one scan.
+
+    line may span several input lines (here-documents, quotes continued
+    on the next line); a newline outside quotes ends a command like ';'.
+
+    Raises:
+        IncompleteInput: on an unterminated quote, a trailing backslash or
+                         a here-document missing its delimiter line
+        ParseError: on an unterminated ${
+    """
+    tokens: List[Token] = []
+    parts: Optional[List[Part]] = None     # word being built
+    heredocs = 0        # tokens before this have had their bodies read
+    i = 0
+    n = len(line)
+
+    while i < n:
+        char = line[i]
+
+        if char in _BLANKS:
+            if parts is not None:
+                tokens.append(Word(_merge(parts)))
+                parts = None
+            i += 1
+            if char == "\n":
+                # A newline ends a command, unless the line ended with an
+                # operator that needs more (|, &&) or there is no command
+                if tokens and tokens[-1] not in _CONTINUING_OPERATORS:
+                    tokens.append(";")
+                # Here-document bodies start on the line after their <<
+                i = _read_heredocs(line, i, tokens, heredocs)
+                heredocs = len(tokens)
+            continue
+
+        if char in _OPERATOR_CHARS:
+            operator = next(op for op in OPERATORS if line.startswith(op, i))
+            i += len(operator)
+            if parts is not None:
+                # All-digit word right before < or >: an fd number (2>)
+                if char in "<>" and len(parts) == 1 and not parts[0][2] \
+                        and parts[0][0] is LITERAL and parts[0][1].isdigit():
+                    operator = parts[0][1] + operator
+                else:
+                    tokens.append(Word(_merge(parts)))
+                parts = None
+            tokens.append(operator)
+            continue
+
+        if parts is None:
+            if char == "#":
+                # Comment to the end of the line
+                newline = line.find("\n", i)
+                i = n if newline == -1 else newline
+                continue
+            parts = []
+            if char == "~":
+                match = _TILDE_PREFIX.match(line, i)
+                end = match.end()
+                if end == n or line[end] in _BLANKS or line[end] == "/" \
+                        or line[end] in _OPERATOR_CHARS:
+                    parts.append((TILDE, match.group(), False))
+                    i = end
+                    continue
+
+        if char == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                raise IncompleteInput(
+                    "unexpected end of line looking for \"'\"")
+            parts.append((LITERAL, line[i + 1:end], True))
+            i = end + 1
+        elif char == '"':
+            i = _double_quoted(line, i + 1, parts)
+        elif char == "\\":
+            if i + 1 >= n:
+                raise IncompleteInput("unexpected end of line after '\\'")
+            if line[i + 1] != "\n":        # Backslash-newline joins lines
+                parts.append((LITERAL, line[i + 1], True))
+            i += 2
+        elif char == "$":
+            i = _parameter(line, i, parts, False)
+        else:
+            match = _PLAIN.match(line, i)
+            parts.append((LITERAL, match.group(), False))
+            i = match.end()
+
+    if parts is not None:
+        tokens.append(Word(_merge(parts)))
+    _read_heredocs(line, n, tokens, heredocs)
+    return tokens
+
+
+@functools.lru_cache(maxsize=256)
+def parse_operand(text: str) -> Word:
+    """
+    Lex the word of a ${VAR:-word}-style operation or a $((...))
+    expression: quotes and expansions as in a word, but blanks and
+    operator characters are plain text.
+
+    Raises:
+        ParseError: on an unterminated quote or ${
+    """
+    parts: List[Part] = []
+    i = 0
+    n = len(text)
+    while i < n:
+        char = text[i]
+        if char == "'":
+            end = text.find("'", i + 1)
+            if end == -1:
+                raise ParseError("unexpected end of word looking for \"'\"")
+            parts.append((LITERAL, text[i + 1:end], True))
+            i = end + 1
+        elif char == '"':
+            i = _double_quoted(text, i + 1, parts)
+        elif char == "\\" and i + 1 < n:
+            parts.append((LITERAL, text[i + 1], True))
+            i += 2
+        elif char == "$":
+            i = _parameter(text, i, parts, False)
+        else:
+            match = _OPERAND_PLAIN.match(text, i) if char != "\\" else None
+            if match is None:
+                parts.append((LITERAL, char, False))
+                i += 1
+            else:
+                parts.append((LITERAL, match.group(), False))
+                i = match.end()
+    return Word(_merge(parts))
@@ -0,0 +1,721 @@
+#!/usr/bin/env python3
+"""
+Command Tree Module for Custom Shell
+
+This module turns a tokenized command line into the tree the executor runs:
+- CommandList: and-or lists separated by ';' or '&', run in order
+- AndOrList: pipelines joined by '&&' / '||', run left to right only
+  while the exit statuses allow it
+- Pipeline: one or more commands joined by '|', optionally '&'
+- SimpleCommand: argument words plus the redirections attached to them,
+  and the NAME=value assignments in front of the command name
+- Redirect: a file (<, >, >>, &>, &>>), a copy of another fd (2>&1,
+  <&3, >&- to close) or inline input (<<EOF here-documents, <<< word),
+  optionally on an explicit fd (2>), with its target word
+- If, WhileLoop (while/until), ForLoop, BraceGroup ({ list; }) and
+  FunctionDef (name() { list; }): compound commands, whose bodies are
+  command trees themselves; they take the place of a SimpleCommand in a
+  Pipeline, with the redirections written after their closing word
+
+A leading 'time' keyword marks the pipeline for resource accounting.
+Aliases are spliced into the token stream at command positions before
+the tree is built (see expand_aliases).
+
+Tokens come from lexer.tokenize(): Word objects and operator strings.
+Plain strings are accepted as words too (dispatch_command() callers).
+Words are stored unexpanded, so a tree can be cached per line and executed
+many times; a loop body or function is parsed once however often it runs.
+The executor expands variables on every run, one pipeline at a time (the
+right side of a failed '&&' is never expanded). A line with a single
+pipeline parses to just that Pipeline.
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from lexer import ParseError, IncompleteInput, HereDoc, Word, LITERAL
+
+# Tokens with a meaning of their own (everything else is a word)
+REDIRECT_OPERATORS = {"<", ">", ">>", "&>", "&>>", ">&", "<&",
+                      "<<", "<<-", "<<<"}
+PIPE = "|"
+BACKGROUND = "&"
+SEQUENCE = ";"
+AND = "&&"
+OR = "||"
+TIME = "time"
+
+# Reserved words: only recognized unquoted, where a command starts
+IF, THEN, ELIF, ELSE, FI = "if", "then", "elif", "else", "fi"
+WHILE, UNTIL, FOR, IN, DO, DONE = "while", "until", "for", "in", "do", "done"
+LBRACE, RBRACE, FUNCTION = "{", "}", "function"
+
+# Operators that end a command
+_CONTROL_OPERATORS = {PIPE, BACKGROUND, SEQUENCE, AND, OR}
+
+# A redirection operator with an optional fd number: > 2> 2>&1 0<<<
+# (&> and &>> always redirect both stdout and stderr)
+_REDIRECT_TOKEN = re.compile(r"(\d*)(>>|>&|>|<<<|<<-|<<|<&|<)\Z|(&>>?)\Z")
+
+# Tokens after which a new command (and so a possible alias) starts
+COMMAND_SEPARATORS = _CONTROL_OPERATORS
+
+# Reserved words after which the next word starts a command (aliases)
+_COMMAND_WORDS = {IF, THEN, ELIF, ELSE, WHILE, UNTIL, DO, LBRACE}
+
+# Reserved words that close a compound command, invalid anywhere else
+_CLOSING_WORDS = {THEN, ELIF, ELSE, FI, DO, DONE, RBRACE}
+
+# Start of an assignment word (NAME=value)
+_ASSIGNMENT = re.compile(r"[A-Za-z_]\w*=")
+
+_NAME = re.compile(r"[A-Za-z_]\w*")
+
+# A function name glued to its parentheses: name() or name(){
+_FUNCTION_NAME = re.compile(r"([A-Za-z_]\w*)\(\)(\{)?\Z")
+
+
+class Redirect:
+    """A single I/O redirection: op is one of REDIRECT_OPERATORS"""
+
+    __slots__ = ("op", "target", "fd")
+
+    def __init__(self, op: str, target, fd: Optional[int] = None):
+        self.op = op
+        self.target = target
+        self.fd = fd            # explicit fd (2>), None for the default
+
+    def __repr__(self):
+        return f"Redirect({self.op!r}, {self.target!r}, fd={self.fd})"
+
+
+class SimpleCommand:
+    """A command name with its arguments, redirections and assignments"""
+
+    __slots__ = ("words", "redirects", "assignments")
+
+    def __init__(self, words: List, redirects: List[Redirect],
+                 assignments: Sequence[Tuple[str, Word]] = ()):
+        self.words = words
+        self.redirects = redirects
+        # (name, value word): shell variables if there are no words,
+        # otherwise the environment of this command only
+        self.assignments = assignments
+
+    def __repr__(self):
+        if self.assignments:
+            return (f"SimpleCommand({self.words!r}, {self.redirects!r}, "
+                    f"{self.assignments!r})")
+        return f"SimpleCommand({self.words!r}, {self.redirects!r})"
+
+
+class Pipeline:
+    """Commands connected stdout-to-stdin, run in the foreground or not"""
+
+    __slots__ = ("commands", "background", "timed")
+
+    def __init__(self, commands: List[SimpleCommand], background: bool,
+                 timed: bool = False):
+        self.commands = commands
+        self.background = background
+        self.timed = timed      # prefixed with the 'time' keyword
+
+    def __repr__(self):
+        return (f"Pipeline({self.commands!r}, background={self.background}, "
+                f"timed={self.timed})")
+
+
+class AndOrList:
+    """Pipelines joined by '&&' / '||', optionally run in the background"""
+
+    __slots__ = ("first", "rest", "background")
+
+    def __init__(self, first: Pipeline, rest: List[Tuple[str, Pipeline]],
+                 background: bool):
+        self.first = first
+        self.rest = rest                # (AND or OR, pipeline) pairs
+        self.background = background    # the whole list runs in a subshell
+
+    def __repr__(self):
+        return (f"AndOrList({self.first!r}, {self.rest!r}, "
+                f"background={self.background})")
+
+
+class CommandList:
+    """Commands separated by ';' or '&', run one after another"""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items: List[Union[Pipeline, AndOrList]]):
+        self.items = items
+
+    @property
+    def background(self) -> bool:
+        """True if the line ends with '&' (its status is not waited for)"""
+        return self.items[-1].background
+
+    def __repr__(self):
+        return f"CommandList({self.items!r})"
+
+
+Node = Union[Pipeline, AndOrList, CommandList]
+
+
+class If:
+    """if/elif clauses, tried in order, and the optional else body"""
+
+    __slots__ = ("clauses", "else_body", "redirects")
+
+    def __init__(self, clauses: List[Tuple[Node, Node]],
+                 else_body: Optional[Node], redirects: List[Redirect]):
+        self.clauses = clauses          # (condition, body) pairs
+        self.else_body = else_body
+        self.redirects = redirects      # after 'fi', for the whole command
+
+    def __repr__(self):
+        return f"If({self.clauses!r}, {self.else_body!r})"
+
+
+class WhileLoop:
+    """while (or until) condition; do body; done"""
+
+    __slots__ = ("condition", "body", "until", "redirects")
+
+    def __init__(self, condition: Node, body: Node, until: bool,
+                 redirects: List[Redirect]):
+        self.condition = condition
+        self.body = body
+        self.until = until              # loop while the condition fails
+        self.redirects = redirects
+
+    def __repr__(self):
+        return (f"WhileLoop({self.condition!r}, {self.body!r}, "
+                f"until={self.until})")
+
+
+class ForLoop:
+    """for name in words; do body; done"""
+
+    __slots__ = ("name", "words", "body", "redirects")
+
+    def __init__(self, name: str, words: Optional[List], body: Node,
+                 redirects: List[Redirect]):
+        self.name = name
+        self.words = words      # None without 'in': the positional params
+        self.body = body
+        self.redirects = redirects
+
+    def __repr__(self):
+        return f"ForLoop({self.name!r}, {self.words!r}, {self.body!r})"
+
+
+class BraceGroup:
+    """{ list; }: commands grouped without a subshell"""
+
+    __slots__ = ("body", "redirects")
+
+    def __init__(self, body: Node, redirects: List[Redirect]):
+        self.body = body
+        self.redirects = redirects
+
+    def __repr__(self):
+        return f"BraceGroup({self.body!r})"
+
+
+class FunctionDef:
+    """name() compound-command: defines a function when executed"""
+
+    __slots__ = ("name", "body", "redirects")
+
+    def __init__(self, name: str, body):
+        self.name = name
+        self.body = body        # the compound command, parsed once
+        self.redirects: List[Redirect] = []
+
+    def __repr__(self):
+        return f"FunctionDef({self.name!r}, {self.body!r})"
+
+
+# Commands that hold command lists of their own; they appear as the
+# commands of a Pipeline, like SimpleCommand
+Compound = Union[If, WhileLoop, ForLoop, BraceGroup, FunctionDef]
+Command = Union[SimpleCommand, Compound]
+COMPOUND_COMMANDS = (If, WhileLoop, ForLoop, BraceGroup, FunctionDef)
+
+
+def command_text(node: Union[Node, Command]) -> str:
+    """The command line a tree was parsed from (unexpanded, for 'jobs')"""
+    if isinstance(node, CommandList):
+        return " ".join(command_text(item) + (" &" if item.background
+                                              else ";")
+                        for item in node.items).rstrip(";")
+    if isinstance(node, AndOrList):
+        return " ".join([command_text(node.first)] +
+                        [f"{op} {command_text(pipeline)}"
+                         for op, pipeline in node.rest])
+
+    if not isinstance(node, Pipeline):
+        return _command_text(node)      # One command of a pipeline
+    stages = [_command_text(command) for command in node.commands]
+    return ("time " if node.timed else "") + " | ".join(stages)
+
+
+def _command_text(command: Command) -> str:
+    if isinstance(command, SimpleCommand):
+        words = [f"{name}={_word_text(value)}"
+                 for name, value in command.assignments]
+        words.extend(_word_text(word) for word in command.words)
+    elif isinstance(command, If):
+        words = []
+        for keyword, (condition, body) in zip(
+                [IF] + [ELIF] * (len(command.clauses) - 1), command.clauses):
+            words.append(f"{keyword} {_body_text(condition)} then "
+                         f"{_body_text(body)}")
+        if command.else_body is not None:
+            words.append(f"else {_body_text(command.else_body)}")
+        words.append(FI)
+    elif isinstance(command, WhileLoop):
+        words = [UNTIL if command.until else WHILE,
+                 f"{_body_text(command.condition)} do",
+                 f"{_body_text(command.body)} done"]
+    elif isinstance(command, ForLoop):
+        words = [FOR, command.name]
+        if command.words is not None:
+            words.append(IN)
+            words.extend(_word_text(word) for word in command.words)
+            words[-1] += ";"
+        words.append(f"do {_body_text(command.body)} done")
+    elif isinstance(command, BraceGroup):
+        words = [f"{{ {_body_text(command.body)} }}"]
+    else:
+        words = [f"{command.name}() {_command_text(command.body)}"]
+
+    for redirect in command.redirects:
+        fd = "" if redirect.fd is None else str(redirect.fd)
+        space = "" if redirect.op in (">&", "<&") else " "
+        words.append(f"{fd}{redirect.op}{space}"
+                     f"{_word_text(redirect.target)}")
+    return " ".join(words)
+
+
+def _body_text(node: Node) -> str:
+    """A nested command list, terminated for the reserved word after it"""
+    text = command_text(node)
+    return text if text.endswith("&") else text + ";"
+
+
+def _word_text(word) -> str:
+    if isinstance(word, HereDoc):
+        return word.delimiter
+    return word.text if isinstance(word, Word) else word
+
+
+class Alias:
+    """An alias with its value tokenized once, when it is defined"""
+
+    __slots__ = ("value", "tokens", "trailing_blank")
+
+    def __init__(self, value: str, tokens: Sequence[str]):
+        self.value = value                  # text shown by 'alias'
+        self.tokens = tuple(tokens)         # spliced in on every use
+        # A value ending in a blank makes the next word a command
+        # position too (alias sudo='sudo ')
+        self.trailing_blank = value[-1:].isspace()
+
+    def __repr__(self):
+        return f"Alias({self.value!r})"
+
+
+def _splice_aliases(tokens: Sequence[str], aliases: Dict[str, Alias],
+                    active: Set[str], out: List[str]) -> bool:
+    """
+    Append tokens to out, replacing aliases at command positions.
+
+    Aliases in active are being expanded already and are left alone, which
+    both allows alias ls='ls -F' and stops alias cycles.
+
+    Returns:
+        True if the word following these tokens is in command position
+    """
+    command_start = True
+    for token in tokens:
+        name = _keyword(token)
+        if command_start and name in aliases and name not in active:
+            alias = aliases[name]
+            active.add(name)
+            try:
+                ends_command = _splice_aliases(alias.tokens, aliases,
+                                               active, out)
+            finally:
+                active.discard(name)
+            command_start = ends_command or alias.trailing_blank
+            continue
+
+        out.append(token)
+        command_start = _is_operator(token, COMMAND_SEPARATORS) or \
+            (command_start and (name == TIME or name in _COMMAND_WORDS))
+
+    return command_start and bool(tokens)
+
+
+def _assignment(token) -> Optional[Tuple[str, Word]]:
+    """(name, value word) if token is an assignment word (NAME=value)"""
+    if not isinstance(token, Word):
+        return None
+    kind, text, quoted = token.parts[0]
+    if kind is not LITERAL or quoted:
+        return None
+    match = _ASSIGNMENT.match(text)
+    if match is None:
+        return None
+    rest = text[match.end():]
+    parts = ([(LITERAL, rest, False)] if rest else []) + list(token.parts[1:])
+    return match.group()[:-1], Word(parts)
+
+
+def _keyword(token) -> Optional[str]:
+    """Text of a plain unquoted word (aliases, 'time'); None otherwise"""
+    if isinstance(token, Word):
+        return token.keyword
+    return token
+
+
+def _is_operator(token, operators) -> bool:
+    """True if token is one of operators (a Word never is, even if quoted)"""
+    return isinstance(token, str) and token in operators
+
+
+def _redirect_operator(token) -> Optional[Tuple[Optional[int], str]]:
+    """(fd or None, op) if token is a redirection operator"""
+    if not isinstance(token, str):
+        return None
+    match = _REDIRECT_TOKEN.match(token)
+    if match is None:
+        return None
+    fd, op, both = match.groups()
+    if both:
+        return None, both
+    return (int(fd) if fd else None), op
+
+
+def expand_aliases(tokens: Sequence[str],
+                   aliases: Dict[str, Alias]) -> Tuple[str, ...]:
+    """
+    Replace the first word of every command with its alias, if any.
+
+    Each lookup is one dict probe, so the cost per command does not depend
+    on how many aliases are defined.
+    """
+    if not aliases or not tokens:
+        return tuple(tokens)
+    out: List[str] = []
+    _splice_aliases(tokens, aliases, set(), out)
+    return tuple(out)
+
+
+def parse_tokens(tokens: Sequence[str]) -> Optional[Node]:
+    """
+    Build a command tree from a token sequence.
+
+    Args:
+        tokens: Tokens as produced by lexer.tokenize()
+
+    Returns:
+        A Pipeline, AndOrList or CommandList (the smallest one that holds
+        the line), or None for an empty line
+
+    Raises:
+        IncompleteInput: if the line ends with '|', '&&' or '||', or
+                         inside an if/while/until/for/{ } without its end
+        ParseError: for misplaced operators, reserved words or missing
+                    redirection targets
+    """
+    if not tokens:
+        return None
+    if _is_operator(tokens[-1], (PIPE, AND, OR)):
+        raise IncompleteInput(f"syntax error: missing command after "
+                              f"'{tokens[-1]}'")
+    return _Parser(tokens).command_list()
+
+
+def _token_text(token) -> str:
+    return token.text if isinstance(token, Word) else token
+
+
+class _Parser:
+    """
+    Recursive-descent parser over the tokens of one line.
+
+    Compound commands nest command lists, which end at a reserved word
+    (then, fi, done, ...) instead of at the end of the line. Inside them
+    a ';' standing for a newline may follow a reserved word ("do\n").
+    """
+
+    def __init__(self, tokens: Sequence[str]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self, offset: int = 0):
+        position = self.position + offset
+        return self.tokens[position] if position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def unexpected(self, token) -> ParseError:
+        return ParseError(f"syntax error near unexpected token "
+                          f"'{_token_text(token)}'")
+
+    def expect(self, word: str):
+        token = self.take()
+        if token is None:
+            raise IncompleteInput(f"syntax error: unexpected end of file "
+                                  f"(expecting '{word}')")
+        if _keyword(token) != word:
+            raise self.unexpected(token)
+
+    def skip_separators(self):
+        while _is_operator(self.peek(), (SEQUENCE,)):
+            self.position += 1
+
+    # -- lists -------------------------------------------------------------
+
+    def command_list(self, terminators: Tuple[str, ...] = ()
+                     ) -> Optional[Node]:
+        """
+        Parse and-or lists separated by ';' / '&' up to one of the
+        reserved words in terminators (left unconsumed), or to the end of
+        the line if there are none
+        """
+        nested = bool(terminators)
+        items: List[Union[Pipeline, AndOrList]] = []
+        while True:
+            if nested:
+                self.skip_separators()
+            token = self.peek()
+            if token is None:
+                if nested:
+                    raise IncompleteInput(
+                        f"syntax error: unexpected end of file "
+                        f"(expecting '{terminators[-1]}')")
+                break
+            if nested and _keyword(token) in terminators:
+                if not items:
+                    raise self.unexpected(token)
+                break
+
+            item = self._and_or()
+            items.append(item)
+            token = self.peek()
+            if _is_operator(token, (SEQUENCE, BACKGROUND)):
+                self.position += 1
+                item.background = token == BACKGROUND
+            elif token is not None and not (
+                    nested and _keyword(token) in terminators):
+                raise self.unexpected(token)
+
+        if not items:
+            return None
+        return items[0] if len(items) == 1 else CommandList(items)
+
+    def _and_or(self) -> Union[Pipeline, AndOrList]:
+        """Parse pipelines joined by '&&' / '||'"""
+        first = self._pipeline()
+        rest: List[Tuple[str, Pipeline]] = []
+        while _is_operator(self.peek(), (AND, OR)):
+            operator = self.take()
+            rest.append((operator, self._pipeline()))
+        if not rest:
+            return first
+        return AndOrList(first, rest, False)
+
+    def _pipeline(self) -> Pipeline:
+        """Parse commands joined by '|', optionally prefixed with 'time'"""
+        timed = _keyword(self.peek()) == TIME
+        if timed:
+            self.position += 1
+            token = self.peek()
+            if token is None or _is_operator(token, _CONTROL_OPERATORS):
+                # Bare 'time' reports the (zero) cost of an empty command
+                return Pipeline([SimpleCommand([], [])], False, timed)
+
+        commands = [self._command()]
+        while _is_operator(self.peek(), (PIPE,)):
+            self.position += 1
+            commands.append(self._command())
+        return Pipeline(commands, False, timed)
+
+    # -- commands ----------------------------------------------------------
+
+    def _command(self) -> Command:
+        token = self.peek()
+        if token is None:
+            raise IncompleteInput("syntax error: unexpected end of file")
+        if _is_operator(token, _CONTROL_OPERATORS):
+            raise self.unexpected(token)
+
+        name = _keyword(token)
+        if name == IF:
+            return self._if()
+        if name in (WHILE, UNTIL):
+            return self._while()
+        if name == FOR:
+            return self._for()
+        if name == LBRACE:
+            self.position += 1
+            return self._brace_group()
+        if name == FUNCTION:
+            self.position += 1
+            return self._function(self.take(), explicit=True)
+        if name is not None and (
+                _FUNCTION_NAME.match(name) or (
+                    _NAME.fullmatch(name)
+                    and _keyword(self.peek(1)) == "()")):
+            self.position += 1
+            return self._function(token)
+        if name in _CLOSING_WORDS:
+            raise self.unexpected(token)
+        return self._simple_command()
+
+    def _simple_command(self) -> SimpleCommand:
+        words: List = []
+        redirects: List[Redirect] = []
+        assignments: List[Tuple[str, Word]] = []
+        while True:
+            token = self.peek()
+            if token is None or _is_operator(token, _CONTROL_OPERATORS):
+                break
+            if _redirect_operator(token) is not None:
+                self._redirect(redirects)
+                continue
+            self.position += 1
+            assignment = None if words else _assignment(token)
+            if assignment is None:
+                words.append(token)
+            else:
+                assignments.append(assignment)
+        return SimpleCommand(words, redirects, assignments)
+
+    def _redirect(self, redirects: List[Redirect]):
+        token = self.take()
+        fd, op = _redirect_operator(token)
+        target = self.peek()
+        if target is None or _redirect_operator(target) is not None \
+                or _is_operator(target, _CONTROL_OPERATORS):
+            raise ParseError(f"syntax error: missing target for '{token}'")
+        self.position += 1
+        redirects.append(Redirect(op, target, fd))
+
+    def _trailing_redirects(self) -> List[Redirect]:
+        """Redirections after the end of a compound command (done > file)"""
+        redirects: List[Redirect] = []
+        while True:
+            token = self.peek()
+            if token is None or _is_operator(token, _CONTROL_OPERATORS):
+                return redirects
+            if _redirect_operator(token) is None:
+                raise self.unexpected(token)
+            self._redirect(redirects)
+
+    # -- compound commands -------------------------------------------------
+
+    def _if(self) -> If:
+        clauses = []
+        keyword = IF
+        while keyword in (IF, ELIF):
+            self.position += 1
+            condition = self.command_list((THEN,))
+            self.expect(THEN)
+            body = self.command_list((ELIF, ELSE, FI))
+            clauses.append((condition, body))
+            keyword = _keyword(self.peek())
+
+        else_body = None
+        if keyword == ELSE:
+            self.position += 1
+            else_body = self.command_list((FI,))
+        self.expect(FI)
+        return If(clauses, else_body, self._trailing_redirects())
+
+    def _while(self) -> WhileLoop:
+        until = _keyword(self.take()) == UNTIL
+        condition = self.command_list((DO,))
+        self.expect(DO)
+        body = self.command_list((DONE,))
+        self.expect(DONE)
+        return WhileLoop(condition, body, until, self._trailing_redirects())
+
+    def _for(self) -> ForLoop:
+        self.position += 1
+        token = self.take()
+        name = _keyword(token)
+        if token is None:
+            raise IncompleteInput("syntax error: unexpected end of file")
+        if name is None or not _NAME.fullmatch(name):
+            raise ParseError(f"'{_token_text(token)}': not a valid "
+                             f"identifier")
+
+        words = None        # for NAME; do ...: the positional parameters
+        self.skip_separators()
+        if _keyword(self.peek()) == IN:
+            self.position += 1
+            words = []
+            while True:
+                token = self.peek()
+                if token is None:
+                    raise IncompleteInput("syntax error: unexpected end "
+                                          "of file (expecting 'do')")
+                if _is_operator(token, _CONTROL_OPERATORS) or \
+                        _redirect_operator(token) is not None:
+                    if token != SEQUENCE:
+                        raise self.unexpected(token)
+                    break
+                words.append(token)
+                self.position += 1
+        self.skip_separators()
+        if self.peek() is None:
+            raise IncompleteInput("syntax error: unexpected end of file "
+                                  "(expecting 'do')")
+        self.expect(DO)
+        body = self.command_list((DONE,))
+        self.expect(DONE)
+        return ForLoop(name, words, body, self._trailing_redirects())
+
+    def _brace_group(self) -> BraceGroup:
+        """{ list; } (the '{' is consumed already)"""
+        body = self.command_list((RBRACE,))
+        self.expect(RBRACE)
+        return BraceGroup(body, self._trailing_redirects())
+
+    def _function(self, token, explicit: bool = False) -> FunctionDef:
+        """
+        name() compound-command, or 'function name [()] compound-command'
+        (token, the name word, is consumed already)
+        """
+        if token is None:
+            raise IncompleteInput("syntax error: unexpected end of file")
+        text = _keyword(token) or ""
+        match = _FUNCTION_NAME.match(text)
+        if match is not None:
+            name, brace = match.groups()
+        elif _NAME.fullmatch(text) and (
+                explicit or _keyword(self.peek()) == "()"):
+            name, brace = text, None
+            if _keyword(self.peek()) == "()":
+                self.position += 1
+        else:
+            raise ParseError(f"'{_token_text(token)}': not a valid "
+                             f"function name")
+
+        if brace is not None:
+            return FunctionDef(name, self._brace_group())
+        self.skip_separators()
+        token = self.peek()
+        if token is None:
+            raise IncompleteInput("syntax error: unexpected end of file "
+                                  "(expecting function body)")
+        if _keyword(token) not in (LBRACE, IF, WHILE, UNTIL, FOR):
+            raise self.unexpected(token)
+        return FunctionDef(name, self._command())
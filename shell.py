@@ -14,52 +14,182 @@ STEP 2: Test basic commands
     cd ~
     jobs
     exit
-"""
-
-import os
-import sys
-import signal
-from typing import List, Dict, Any
-from utils import *
-from signals_mod import setup_signal_handlers
-
-
-class ShellState:
-    """Global shell state management"""
-
-    def __init__(self):
-        self.running = True
-        self.current_directory = os.getcwd()
-        self.previous_directory = None
-        self.aliases = {}
-        self.prompt = ""
-        self.last_exit_status = 0
-        self.background_processes = []
-        self.command_history = []
-
-
-# Global shell state instance
-shell_state = ShellState()
 
+NON-INTERACTIVE (SCRIPT) MODE:
+    python3 shell.py -c "echo hello; pwd"
+    python3 shell.py script.sh
+"""
 
-def main():
+import time
+_startup_clock = time.perf_counter()    # --startup-profile counts from here
+
+# The imports come after the clock so that their load time is measured
+import os  # noqa: E402
+import sys  # noqa: E402
+from typing import List  # noqa: E402
+from state import shell_state, DEFAULT_SHUTDOWN_TIMEOUT  # noqa: E402
+from utils import *  # noqa: E402
+from signals_mod import setup_signal_handlers, wait_for_input  # noqa: E402
+from signals_mod import init_job_control, shutdown_jobs  # noqa: E402
+from history import EventNotFound, history_from_environment  # noqa: E402
+from parser_mod import IncompleteInput  # noqa: E402
+
+# Startup timings for --startup-profile: (label, seconds) per step
+_startup_steps = []
+
+
+def startup_step(label: str):
+    """Record the time since the previous step under label"""
+    global _startup_clock
+    now = time.perf_counter()
+    _startup_steps.append((label, now - _startup_clock))
+    _startup_clock = now
+
+
+startup_step("import modules")
+
+# Prompt for the rest of a command continued on the next line
+CONTINUATION_PROMPT = "> "
+
+
+def print_startup_profile():
+    """Print the steps recorded by startup_step() and their total"""
+    total = sum(seconds for _, seconds in _startup_steps)
+    lines = ["startup profile (ms):"]
+    lines += [f"  {label:<32}{seconds * 1000:8.2f}"
+              for label, seconds in _startup_steps]
+    lines.append(f"  {'total':<32}{total * 1000:8.2f}")
+    lines.append("  (interpreter start-up not included; for per-module "
+                 "import times run: python3 -X importtime shell.py ...)")
+    print("\n".join(lines), file=sys.stderr)
+
+
+def _simple_arguments(argv: List[str]):
+    """
+    The options for the common command lines (none, -c COMMAND, SCRIPT
+    [ARG...], optionally after --startup-profile) without loading
+    argparse, or None for anything else.
+    """
+    profile = argv[:1] == ["--startup-profile"]
+    if profile:
+        argv = argv[1:]
+    if argv and argv[0] == "-c":
+        if len(argv) != 2 or argv[1].startswith("-"):
+            return None
+        command, script, args = argv[1], None, []
+    elif any(arg.startswith("-") for arg in argv):
+        return None
+    else:
+        command, script, args = None, (argv[0] if argv else None), argv[1:]
+
+    import types
+    return types.SimpleNamespace(
+        command=command, script=script, args=args, spawn_backend=None,
+        pipeline_stderr="inherit", shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT,
+        substitution_limit=DEFAULT_SUBSTITUTION_LIMIT, startup_profile=profile)
+
+
+def parse_arguments(argv: List[str]):
+    """Parse the shell's command line options"""
+    options = _simple_arguments(argv)
+    if options is not None:
+        return options
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="shell.py", description="Command-Line Interpreter")
+    parser.add_argument("-c", dest="command", metavar="COMMAND",
+                        help="run COMMAND non-interactively and exit")
+    parser.add_argument("script", nargs="?",
+                        help="run the commands in SCRIPT and exit")
+    parser.add_argument("args", nargs="*",
+                        help="positional parameters ($1, $2, ...) of SCRIPT")
+    parser.add_argument("--spawn-backend", choices=SPAWN_BACKENDS,
+                        default=None,
+                        help="how external commands are started "
+                             "(default: spawn where posix_spawn exists)")
+    parser.add_argument("--pipeline-stderr", choices=PIPELINE_STDERR_MODES,
+                        default="inherit",
+                        help="pass pipeline stderr through (inherit) or "
+                             "collect it per stage and report it (capture)")
+    parser.add_argument("--shutdown-timeout", type=float, metavar="SECONDS",
+                        default=DEFAULT_SHUTDOWN_TIMEOUT,
+                        help="on exit, how long background jobs get to "
+                             "finish after SIGTERM before being killed "
+                             "(default: %(default)s)")
+    parser.add_argument("--substitution-limit", type=int, metavar="BYTES",
+                        default=DEFAULT_SUBSTITUTION_LIMIT,
+                        help="most output a $(...) command substitution "
+                             "keeps (default: %(default)s)")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="print how long imports and initialization "
+                             "took (to stderr) before running commands")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
     """Main entry point for the shell"""
-    print("=== CLI (Python) ===")
-    print("Team: Bilash, Max, Jake")
-    print("Type 'help' for commands or 'exit' to quit.")
-    print()
+    options = parse_arguments(sys.argv[1:] if argv is None else argv)
+    startup_step("parse arguments")
+
+    if options.spawn_backend is not None:
+        try:
+            set_spawn_backend(options.spawn_backend)
+        except ValueError as e:
+            print_error(str(e))
+            return 2
+    shell_state.pipeline_stderr = options.pipeline_stderr
+    shell_state.shutdown_timeout = max(0.0, options.shutdown_timeout)
+    shell_state.substitution_limit = max(0, options.substitution_limit)
+
+    script_lines = None
+    if options.command is not None:
+        script_lines = options.command.splitlines()
+    elif options.script is not None:
+        shell_state.positional = list(options.args)
+        script_lines = read_script(options.script)
+        if script_lines is None:
+            return 127
+
+    shell_state.interactive = script_lines is None
+
+    if shell_state.interactive:
+        print("=== CLI (Python) ===")
+        print("Team: Bilash, Max, Jake")
+        print("Type 'help' for commands or 'exit' to quit.")
+        print()
 
     # Initialize shell state
     shell_state.current_directory = get_current_directory()
 
     # Setup signal handlers
-    setup_signal_handlers()
+    setup_signal_handlers(interactive=shell_state.interactive)
+    startup_step("signal handlers")
+
+    if shell_state.interactive:
+        # Own process group and terminal so jobs can be stopped and resumed
+        init_job_control()
+        startup_step("job control")
+
+        # History persists across interactive sessions ($HISTFILE)
+        shell_state.history = history_from_environment()
+        shell_state.history.load()
+        startup_step("load history")
 
-    # Set initial prompt
-    set_prompt()
+        # Set initial prompt (user/host/home are looked up only here)
+        refresh_prompt_identity()
+        set_prompt()
+        startup_step("prompt identity")
 
-    # Enter main shell loop
-    shell_loop()
+    if options.startup_profile:
+        print_startup_profile()
+
+    if shell_state.interactive:
+        # Enter main shell loop
+        shell_loop()
+    else:
+        run_script(script_lines)
 
     # Cleanup and exit
     cleanup_shell()
@@ -82,50 +212,25 @@ def shell_loop():
             if not user_input.strip():
                 continue
 
-            # Add to history
-            shell_state.command_history.append(user_input)
-
-            # Parse command
-            args = parse_command(user_input)
-            if not args:
+            # Expand !-references
+            line = expand_history(user_input)
+            if line is None:
                 continue
 
-            # Check for background execution
-            background = False
-            if args and args[-1] == "&":
-                background = True
-                args.pop()
-
-            if not args:
+            # Quotes, here-documents, a trailing | or && continue below;
+            # the whole command is one history entry, so !! recalls it all
+            line = read_continuation(line)
+            if line is None:
                 continue
+            shell_state.history.add(line)
 
-            # Handle exit command specially
-            if args[0] == "exit":
-                if len(args) > 1:
-                    try:
-                        shell_state.last_exit_status = int(args[1])
-                    except ValueError:
-                        print_error(f"Invalid exit code: {args[1]}")
-                        shell_state.last_exit_status = 1
-                shell_state.running = False
+            # Parse and execute (cd refreshes the prompt itself)
+            execute_line(line)
+            if not shell_state.running:
                 break
 
-            # Execute command (built-in or external)
-            if is_builtin_command(args[0]):
-                status = execute_builtin(args)
-                shell_state.last_exit_status = status
-            else:
-                status = execute_command(args, background)
-                if not background:
-                    shell_state.last_exit_status = status
-
-            # Update current directory and prompt
-            shell_state.current_directory = get_current_directory()
-            set_prompt()
-
         except KeyboardInterrupt:
-            # Handle Ctrl+C gracefully
-            print()
+            # Ctrl+C at the prompt (reported by wait_for_input): new prompt
             continue
         except EOFError:
             # Handle Ctrl+D
@@ -136,6 +241,113 @@ def shell_loop():
             print_error(f"Shell error: {e}")
 
 
+def expand_history(user_input: str):
+    """
+    Apply !-expansion to an input line.
+
+    Returns:
+        The line to execute, or None if a reference matched nothing
+    """
+    try:
+        line = shell_state.history.expand(user_input)
+    except EventNotFound as e:
+        print_error(str(e))
+        shell_state.last_exit_status = 1
+        return None
+
+    if line != user_input:
+        print(line)     # Show the command that will run, as bash does
+    return line
+
+
+def is_incomplete(line: str) -> bool:
+    """True if line stops in the middle of a command (see IncompleteInput)"""
+    try:
+        parse_line(line)
+    except IncompleteInput:
+        return True
+    except ValueError:
+        pass    # Reported when the line is executed
+    return False
+
+
+def read_continuation(line: str):
+    """
+    Read more lines at the "> " prompt until the command is complete.
+
+    Returns:
+        The whole command, or None if input ended first (Ctrl+D; what was
+        read is still added to the history)
+    """
+    while is_incomplete(line):
+        print(CONTINUATION_PROMPT, end="", flush=True)
+        try:
+            more = read_input()
+        except EOFError:
+            print()
+            try:
+                parse_line(line)
+            except IncompleteInput as e:
+                print_error(f"Parse error: {e}")
+            shell_state.history.add(line)
+            shell_state.last_exit_status = 2
+            return None
+        line += "\n" + more
+    return line
+
+
+def execute_line(line: str):
+    """Parse and execute a single command line"""
+    try:
+        tree = parse_line(line)
+    except ValueError as e:
+        print_error(f"Parse error: {e}")
+        shell_state.last_exit_status = 2
+        return
+
+    if tree is None:
+        return
+
+    status = execute_tree(tree)
+    if not tree.background:
+        shell_state.last_exit_status = status
+
+
+def read_script(path: str):
+    """Read a whole script file up front; returns None if it can't be read"""
+    try:
+        with open(path, "r") as script:
+            return script.read().splitlines()
+    except OSError as e:
+        print_error(f"{path}: {e.strerror}")
+        return None
+
+
+def run_script(lines: List[str]):
+    """Execute script lines in order without prompting (non-interactive mode)"""
+    i = 0
+    while i < len(lines):
+        if not shell_state.running:
+            break
+
+        handle_background_processes()
+
+        line = lines[i]
+        i += 1
+        if not line.strip():
+            continue
+
+        # A command continued on the next lines (quotes, here-documents)
+        while i < len(lines) and is_incomplete(line):
+            line += "\n" + lines[i]
+            i += 1
+
+        try:
+            execute_line(line)
+        except Exception as e:
+            print_error(f"Shell error: {e}")
+
+
 def display_prompt():
     """Display the shell prompt"""
     print(shell_state.prompt, end=" ", flush=True)
@@ -143,6 +355,11 @@ def display_prompt():
 
 def read_input() -> str:
     """Read user input from stdin"""
+    # On a terminal, wait in the signal event loop so Ctrl+C and finished
+    # children are handled while the user is typing
+    if sys.stdin.isatty():
+        wait_for_input(sys.stdin.fileno())
+
     try:
         return input()
     except (KeyboardInterrupt, EOFError):
@@ -151,25 +368,24 @@ def read_input() -> str:
 
 def cleanup_shell():
     """Clean up shell resources before exit"""
-    print("Cleaning up shell resources...")
-
-    # Terminate background processes
-    if shell_state.background_processes:
-        print("Terminating background processes...")
-        for pid in shell_state.background_processes[:]:
-            try:
-                os.kill(pid, signal.SIGTERM)
-                # Give processes time to terminate gracefully
-                import time
-                time.sleep(0.1)
-                try:
-                    os.kill(pid, signal.SIGKILL)
-                except ProcessLookupError:
-                    pass  # Process already terminated
-            except (ProcessLookupError, PermissionError):
-                pass  # Process already gone or not ours
-
-    print(f"Shell exited with status: {shell_state.last_exit_status}")
+    if shell_state.interactive:
+        print("Cleaning up shell resources...")
+
+    # Write out history entries not saved yet
+    shell_state.history.flush()
+
+    # Terminate background processes: all at once, one shared deadline
+    if shell_state.jobs:
+        if shell_state.interactive:
+            print("Terminating background processes...")
+        timeout = shell_state.shutdown_timeout
+        for job in shutdown_jobs(timeout):
+            print_error(f"[{job.job_id}] {' '.join(map(str, job.pids))} "
+                        f"still running after {timeout:g}s, killed: "
+                        f"{job.command}")
+
+    if shell_state.interactive:
+        print(f"Shell exited with status: {shell_state.last_exit_status}")
 
 
 if __name__ == "__main__":
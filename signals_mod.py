@@ -7,120 +7,493 @@ This module handles POSIX signals for the shell:
 - SIGINT (Ctrl+C): Interrupt current operation but don't exit shell
 - SIGTSTP (Ctrl+Z): Show message but don't suspend shell  
 - SIGCHLD: Handle background process completion
+- SIGTTOU/SIGTTIN: Ignored by an interactive shell doing job control
+
+With job control (interactive shell on a terminal) every job gets its own
+process group; the foreground job is given the terminal, so Ctrl+C and
+Ctrl+Z reach the whole job instead of the shell.
+
+Signal handlers do no work themselves: every handled signal only makes
+Python write its number to a non-blocking wakeup pipe
+(signal.set_wakeup_fd). The shell reacts in ordinary code through
+wait_for_events(), a selector loop over that pipe which reaps children
+with waitpid(-1, WNOHANG) and dispatches the signals. All reaping happens
+there, so foreground waits can't lose statuses to a handler and nothing
+is printed or mutated from signal context.
 """
 
 import os
 import signal
 import sys
-from typing import List
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from state import shell_state
+
+# Read end of the signal wakeup pipe and the selector watching it
+_wakeup_read: Optional[int] = None
+_selector = None
+
+# PIDs the executor is waiting for in the foreground, and their results
+_waiting: Set[int] = set()
+_exited: Dict[int, Tuple[int, object, float]] = {}
+
+# Background jobs that finished or stopped and were not reported yet
+_job_reports: deque = deque()
+
+# Set by Ctrl+C, cleared by take_interrupt()
+_interrupt_pending = False
 
-# Global signal flags (will be set by shell.py)
-shell_state = None
+# Children are reaped when they exit, stop or are continued
+_WAIT_FLAGS = os.WUNTRACED | os.WCONTINUED
 
 
-def setup_signal_handlers():
-    """Setup custom signal handlers for the shell"""
-    # Import here to avoid circular imports
-    global shell_state
-    from shell import shell_state as ss
-    shell_state = ss
+def setup_signal_handlers(interactive: bool = True):
+    """
+    Setup custom signal handlers for the shell.
+
+    A non-interactive shell (script mode) keeps the default SIGINT/SIGTSTP
+    behaviour so Ctrl+C aborts the script; only SIGCHLD is handled.
+    """
+    global _wakeup_read, _selector
+
+    if _wakeup_read is None:
+        _open_wakeup_pipe()
+
+    # Handle SIGCHLD - clean up background processes
+    signal.signal(signal.SIGCHLD, _wake)
+
+    if not interactive:
+        return
 
     # Handle SIGINT (Ctrl+C) - don't terminate shell
-    signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGINT, _wake)
 
     # Handle SIGTSTP (Ctrl+Z) - don't suspend shell
-    signal.signal(signal.SIGTSTP, sigtstp_handler)
+    signal.signal(signal.SIGTSTP, _wake)
 
-    # Handle SIGCHLD - clean up background processes
-    signal.signal(signal.SIGCHLD, sigchld_handler)
 
+def _open_wakeup_pipe():
+    """Create the signal wakeup pipe and the selector watching it"""
+    global _wakeup_read, _selector
+    import selectors
+
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    os.set_blocking(write_fd, False)
+    old_write_fd = signal.set_wakeup_fd(write_fd, warn_on_full_buffer=False)
+    if old_write_fd != -1:
+        os.close(old_write_fd)
+    _selector = selectors.DefaultSelector()
+    _selector.register(read_fd, selectors.EVENT_READ)
+    _wakeup_read = read_fd
+
+
+def reinit_after_fork():
+    """
+    Reset signal state in a forked subshell (a builtin pipeline stage).
+
+    The subshell gets its own wakeup pipe, so parent and child can't steal
+    each other's signals, an empty job table, and no job control.
+    """
+    global _wakeup_read
+    from jobs import JobTable
+
+    _waiting.clear()
+    _exited.clear()
+    _job_reports.clear()
+    shell_state.jobs = JobTable()
+    shell_state.job_control = False
+
+    if _wakeup_read is not None:
+        _selector.close()
+        os.close(_wakeup_read)
+        _open_wakeup_pipe()
+
+
+def init_job_control():
+    """
+    Put the shell in its own process group in the foreground of its
+    terminal so jobs can be given the terminal and taken back.
+    """
+    if not sys.stdin.isatty():
+        return
+
+    terminal = sys.stdin.fileno()
+
+    # If started in the background, wait until we are in the foreground
+    while os.tcgetpgrp(terminal) != os.getpgrp():
+        os.killpg(os.getpgrp(), signal.SIGTTIN)
 
-def sigint_handler(sig, frame):
+    # Terminal-control signals must not stop the shell itself
+    signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+
+    try:
+        os.setpgid(0, 0)
+    except PermissionError:
+        pass  # Already a session/group leader
+    os.tcsetpgrp(terminal, os.getpgrp())
+
+    shell_state.job_control = True
+    shell_state.terminal_fd = terminal
+    shell_state.shell_pgid = os.getpgrp()
+
+
+def give_terminal_to(pgid: Optional[int]):
+    """Make pgid the terminal's foreground process group"""
+    if not shell_state.job_control or pgid is None:
+        return
+    try:
+        os.tcsetpgrp(shell_state.terminal_fd, pgid)
+    except OSError:
+        pass  # The group may already be gone
+
+
+def reclaim_terminal():
+    """Take the terminal back after a foreground job stopped or finished"""
+    if not shell_state.job_control:
+        return
+    try:
+        os.tcsetpgrp(shell_state.terminal_fd, shell_state.shell_pgid)
+    except OSError:
+        pass
+
+
+def _wake(sig, frame):
+    """
+    Python-level handler for every signal the shell handles.
+
+    The interpreter has already written the signal number to the wakeup
+    pipe before calling this; the work happens in wait_for_events().
+    Ctrl+C is also noted for loops that only run builtins, which never
+    wait for events (see take_interrupt()).
+    """
+    global _interrupt_pending
+    if sig == signal.SIGINT:
+        _interrupt_pending = True
+
+
+def take_interrupt() -> bool:
+    """True if Ctrl+C was pressed since the last call"""
+    global _interrupt_pending
+    pending = _interrupt_pending
+    _interrupt_pending = False
+    return pending
+
+
+def sigint_handler():
     """Handle SIGINT (Ctrl+C) - interrupt but don't exit"""
     print("\nUse 'exit' to quit the shell.")
     # Don't terminate the shell, just return to prompt
 
 
-def sigtstp_handler(sig, frame):
+def sigtstp_handler():
     """Handle SIGTSTP (Ctrl+Z) - show message but don't suspend"""
     print("\nShell suspension disabled. Use 'exit' to quit.")
 
 
-def sigchld_handler(sig, frame):
-    """Handle SIGCHLD - clean up terminated background processes"""
-    if shell_state is None:
+def _drain_wakeup_pipe() -> Set[int]:
+    """Read all pending signal numbers from the wakeup pipe"""
+    signals: Set[int] = set()
+    while True:
+        try:
+            data = os.read(_wakeup_read, 512)
+        except (BlockingIOError, InterruptedError):
+            break
+        if not data:
+            break
+        signals.update(data)
+    return signals
+
+
+def wait_for_events(fds: Iterable[int] = (),
+                    timeout: Optional[float] = None) -> Tuple[Set[int],
+                                                              Set[int]]:
+    """
+    Central event loop step: wait for a signal or for one of fds.
+
+    Finished children are reaped and SIGTSTP is reported here.
+
+    Returns:
+        (fds that are readable, signal numbers received)
+    """
+    import selectors
+
+    if _selector is None:
+        # Signal handlers not installed (library use): poll instead
+        events = _poll_selector(fds, 0.05 if timeout is None else timeout)
+        reap_children()
+        return events, set()
+
+    registered = []
+    for fd in fds:
+        _selector.register(fd, selectors.EVENT_READ)
+        registered.append(fd)
+
+    try:
+        events = _selector.select(timeout)
+    finally:
+        for fd in registered:
+            _selector.unregister(fd)
+
+    ready = {key.fd for key, _ in events if key.fd != _wakeup_read}
+    signals = _drain_wakeup_pipe() if len(ready) < len(events) else set()
+
+    if signal.SIGCHLD in signals:
+        reap_children()
+    if signal.SIGTSTP in signals:
+        sigtstp_handler()
+
+    return ready, signals
+
+
+def _poll_selector(fds: Iterable[int], timeout: float) -> Set[int]:
+    """Readable fds among fds, for when there is no wakeup pipe"""
+    import selectors
+
+    with selectors.DefaultSelector() as selector:
+        for fd in fds:
+            selector.register(fd, selectors.EVENT_READ)
+        if not selector.get_map():
+            time.sleep(timeout)
+            return set()
+        return {key.fd for key, _ in selector.select(timeout)}
+
+
+def wait_for_input(fd: int):
+    """
+    Block until fd (the terminal) is readable, handling signals meanwhile.
+
+    Raises:
+        KeyboardInterrupt: if Ctrl+C was pressed while waiting
+    """
+    if _selector is None:
         return
 
-    # Reap terminated child processes
+    while True:
+        ready, signals = wait_for_events([fd])
+        if signal.SIGINT in signals:
+            sigint_handler()
+            raise KeyboardInterrupt
+        if ready:
+            return
+
+
+def reap_children() -> bool:
+    """
+    Reap every finished (or stopped/continued) child with one
+    wait4(-1, WNOHANG) loop.
+
+    Returns:
+        False if the shell has no children left at all
+    """
     while True:
         try:
-            pid, status = os.waitpid(-1, os.WNOHANG)
-            if pid == 0:
-                break  # No more children to reap
+            pid, status, rusage = os.wait4(-1, os.WNOHANG | _WAIT_FLAGS)
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            return False  # No more children
+        if pid == 0:
+            return True  # No more children to reap
+
+        _record_exit(pid, status, rusage)
+
+
+def _record_exit(pid: int, status: int, rusage):
+    """Hand a reaped child to the foreground waiter or to the job table"""
+    if pid in _waiting:
+        if not os.WIFCONTINUED(status):
+            _exited[pid] = (status, rusage, time.perf_counter())
+    else:
+        note_child_exit(pid, status)
+
+
+def watch_children(pids: Iterable[int]):
+    """Route the statuses of pids to collect_children(), not the job table"""
+    _waiting.update(pids)
+
+
+def collect_children(pids: Iterable[int]) -> Dict[int, tuple]:
+    """
+    Reap without blocking and return the results of the watched pids that
+    exited or stopped since the last call (they are no longer watched).
+
+    Returns:
+        {pid: (wait status, rusage, time.perf_counter() when reaped)}
+    """
+    reap_children()
+    done = {pid: _exited.pop(pid) for pid in pids if pid in _exited}
+    _waiting.difference_update(done)
+    return done
+
+
+def wait_for_children(pids: Iterable[int],
+                      interruptible: bool = False) -> Dict[int, tuple]:
+    """
+    Wait until every process in pids has exited, or one of them stopped.
 
-            # Remove from background process list
-            if pid in shell_state.background_processes:
-                shell_state.background_processes.remove(pid)
+    Children are reaped as they finish (in any order) by the central
+    reaper; background jobs that finish meanwhile go to the job table.
+    A stopped process is returned with its WIFSTOPPED status and no rusage.
 
-                # Print completion message (if not in signal context)
-                if os.WIFEXITED(status):
-                    exit_status = os.WEXITSTATUS(status)
-                    print(
-                        f"\n[Process {pid}] Done (exit status: {exit_status})")
-                elif os.WIFSIGNALED(status):
-                    sig_num = os.WTERMSIG(status)
-                    print(f"\n[Process {pid}] Terminated by signal {sig_num}")
+    Args:
+        pids: Processes to wait for
+        interruptible: Raise KeyboardInterrupt on SIGINT (the wait builtin)
 
-        except OSError:
-            break  # No more children
+    Returns:
+        {pid: (wait status, rusage, time.perf_counter() when reaped)}
+    """
+    pids = list(pids)
+    pending = set(pids)
+    _waiting.update(pending)
+
+    try:
+        while True:
+            have_children = reap_children()
+            stopped = any(os.WIFSTOPPED(_exited[pid][0])
+                          for pid in pending if pid in _exited)
+            pending.difference_update(_exited)
+            if not pending or not have_children or stopped:
+                break
+
+            if _selector is None or \
+                    signal.getsignal(signal.SIGCHLD) is not _wake:
+                # No wakeups will arrive (library use): block in wait4
+                try:
+                    pid, status, rusage = os.wait4(-1, _WAIT_FLAGS)
+                except InterruptedError:
+                    continue
+                except ChildProcessError:
+                    break
+                _record_exit(pid, status, rusage)
+            else:
+                _, signals = wait_for_events()
+                if interruptible and signal.SIGINT in signals:
+                    raise KeyboardInterrupt
+
+        return {pid: _exited.pop(pid) for pid in pids if pid in _exited}
+    finally:
+        _waiting.difference_update(pids)
+
+
+def _report_job(job):
+    """Print the message for a job that finished or stopped"""
+    from jobs import STOPPED
+
+    if job.state == STOPPED:
+        print(f"[{job.job_id}] Stopped  {job.command}")
+    elif job.term_signal is not None:
+        print(f"[{job.job_id}] Terminated by signal "
+              f"{job.term_signal}  {job.command}")
+    else:
+        print(f"[{job.job_id}] Done (exit status: "
+              f"{job.exit_status})  {job.command}")
 
 
 def handle_background_processes():
-    """Check and clean up background processes (called from main loop)"""
-    if shell_state is None:
-        return
+    """Reap finished jobs and report them (called before each prompt)"""
+    if shell_state.jobs:
+        reap_children()
+
+    while _job_reports:
+        _report_job(_job_reports.popleft())
+
+
+def note_child_exit(pid: int, status: int):
+    """
+    Record a reaped background child; once every process of its job has
+    finished the job is retired and queued for reporting. Jobs that stop
+    are reported too.
+    """
+    jobs = shell_state.jobs
+    if os.WIFSTOPPED(status):
+        job = jobs.child_stopped(pid)
+        if job is not None:
+            _job_reports.append(job)
+    elif os.WIFCONTINUED(status):
+        jobs.child_continued(pid)
+    else:
+        job = jobs.child_exited(pid, status)
+        if job is not None:
+            jobs.remove(job)
+            _job_reports.append(job)
 
-    # Check for completed background processes
-    # Copy list for safe iteration
-    for pid in shell_state.background_processes[:]:
-        try:
-            result_pid, status = os.waitpid(pid, os.WNOHANG)
-            if result_pid == pid:
-                # Process has completed
-                shell_state.background_processes.remove(pid)
-
-                if os.WIFEXITED(status):
-                    exit_status = os.WEXITSTATUS(status)
-                    print(f"[Process {pid}] Done (exit status: {exit_status})")
-                elif os.WIFSIGNALED(status):
-                    sig_num = os.WTERMSIG(status)
-                    print(f"[Process {pid}] Terminated by signal {sig_num}")
-        except OSError:
-            # Process doesn't exist anymore
-            if pid in shell_state.background_processes:
-                shell_state.background_processes.remove(pid)
-
-
-def add_background_process(pid: int):
-    """Add a process to the background process list"""
-    if shell_state is None:
-        return
 
-    shell_state.background_processes.append(pid)
-    print(f"[Process {pid}] Started in background")
+def add_background_job(pids: List[int], command: str,
+                       pgid: Optional[int] = None, announce: bool = True):
+    """Register the processes of a background pipeline as one job"""
+    if not pids:
+        return None
+
+    job = shell_state.jobs.add(pids, command, pgid)
+    if announce:
+        print(f"[{job.job_id}] {pids[-1]} Started in background")
+    return job
+
+
+def shutdown_jobs(timeout: float) -> List:
+    """
+    Terminate every job at once and reap them together.
+
+    All jobs get SIGTERM at the same time (stopped ones also SIGCONT so
+    they can act on it); the shell then reaps them as they exit until a
+    single deadline, timeout seconds away. Jobs still running then are
+    killed with SIGKILL.
+
+    Returns:
+        The jobs that had to be killed
+    """
+    if not shell_state.jobs:
+        return []
+
+    from jobs import STOPPED
+    from utils import signal_job
+
+    jobs = shell_state.jobs
+    for job in jobs:
+        signal_job(job, signal.SIGTERM)
+        if job.state == STOPPED:
+            signal_job(job, signal.SIGCONT)
+
+    pids = set(jobs.pids())
+    watch_children(pids)
+    deadline = time.monotonic() + timeout
+    try:
+        while pids:
+            for pid, (status, _, _) in collect_children(pids).items():
+                if os.WIFSTOPPED(status) or os.WIFCONTINUED(status):
+                    watch_children([pid])
+                    continue
+                pids.discard(pid)
+                job = jobs.child_exited(pid, status)
+                if job is not None:
+                    jobs.remove(job)
+
+            remaining = deadline - time.monotonic()
+            if not pids or remaining <= 0:
+                break
+            wait_for_events(timeout=remaining)
+    finally:
+        _waiting.difference_update(pids)
+
+    stragglers = list(jobs)
+    for job in stragglers:
+        signal_job(job, signal.SIGKILL)
+    if stragglers:
+        wait_for_children(jobs.pids())
+        for job in stragglers:
+            jobs.remove(job)
+    return stragglers
 
 
 def print_background_jobs():
     """Print current background jobs"""
-    if shell_state is None or not shell_state.background_processes:
+    if not shell_state.jobs:
         print("No active background jobs.")
         return
 
     print("Active background jobs:")
-    for i, pid in enumerate(shell_state.background_processes):
-        try:
-            # Check if process still exists
-            os.kill(pid, 0)  # Signal 0 checks existence without sending signal
-            print(f"[{i + 1}] {pid} Running")
-        except (ProcessLookupError, PermissionError):
-            print(f"[{i + 1}] {pid} Done")
+    for job in shell_state.jobs:
+        print(f"[{job.job_id}] {job.pids[-1]} {job.state:<8} {job.command}")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Shell State Module for Custom Shell
+
+The one ShellState of the process. Modules bind it once at import time
+(from state import shell_state) instead of importing the shell module
+inside every function: shell.py imports utils, so utils could not
+import shell at the top. This module imports none of the others'
+executors, so anything can depend on it.
+"""
+
+import os
+
+from history import History
+from jobs import JobTable
+from variables import Variables
+
+# Seconds background jobs get to exit after SIGTERM when the shell exits
+DEFAULT_SHUTDOWN_TIMEOUT = 1.0
+
+# Most bytes of output a $(...) keeps (shell_state.substitution_limit);
+# the command is cut off (its pipe closed) once it writes more
+DEFAULT_SUBSTITUTION_LIMIT = 64 * 1024 * 1024
+
+
+class ShellState:
+    """Global shell state management"""
+
+    def __init__(self):
+        self.running = True
+        self.current_directory = os.getcwd()
+        self.previous_directory = None
+        self.aliases = {}          # name -> parser_mod.Alias
+        self.prompt = ""
+        self.prompt_user = None    # resolved once by refresh_prompt_identity()
+        self.prompt_host = None
+        self.prompt_home = None
+        self.interactive = True
+        self.last_exit_status = 0
+        self.jobs = JobTable()     # background jobs by number and PID
+        self.history = History()   # see history_from_environment()
+        self.variables = Variables()   # shell variables, from os.environ
+        self.positional = []       # $1, $2, ...: script or function args
+        self.functions = {}        # name -> parser_mod.FunctionDef
+        self.loop_depth = 0        # loops being run (for break/continue)
+        self.function_depth = 0    # function calls being run (for return)
+        self.command_hash = {}     # command name -> [path, hits]
+        self.pipeline_stderr = "inherit"   # see PIPELINE_STDERR_MODES
+        self.pipestatus = []       # StageStatus of the last pipeline
+        self.options = set()       # enabled 'set -o' options
+        self.job_control = False   # see signals_mod.init_job_control()
+        self.terminal_fd = None    # controlling terminal under job control
+        self.shell_pgid = None     # the shell's own process group
+        self.shutdown_timeout = DEFAULT_SHUTDOWN_TIMEOUT
+        self.substitution_limit = DEFAULT_SUBSTITUTION_LIMIT  # $(...) bytes
+
+
+# Global shell state instance
+shell_state = ShellState()
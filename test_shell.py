@@ -11,6 +11,7 @@ import os
 import sys
 import tempfile
 import subprocess
+import time
 from typing import List, Any
 
 # Add current directory to path for imports
@@ -117,6 +118,56 @@ def test_builtin_detection():
     return True
 
 
+def test_builtin_registry():
+    """Test registering a plug-in builtin"""
+    import shell
+    import utils
+
+    calls = []
+
+    def greet(args):
+        calls.append(args)
+        print("hello", *args[1:])
+        return 3
+
+    utils.register_builtin("tb_greet", greet, "tb_greet [name]",
+                           "Say hello", on_thread=True)
+    try:
+        if not utils.is_builtin_command("tb_greet") or \
+                utils.execute_builtin(["tb_greet", "x"]) != 3 or \
+                calls[-1] != ["tb_greet", "x"]:
+            print("Registered builtin not dispatched")
+            return False
+
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "out")
+            # On a thread of the shell in a pipeline, in-process in $(...)
+            shell.execute_line(f"tb_greet pipe | cat > {out}; "
+                               f"echo $(tb_greet sub) >> {out}; "
+                               f"help >> {out}")
+            with open(out) as f:
+                lines = f.read().splitlines()
+        if lines[:2] != ["hello pipe", "hello sub"] or \
+                not any(line.startswith("  tb_greet [name]") and
+                        line.endswith("- Say hello") for line in lines):
+            print(f"Registered builtin output wrong: {lines[:3]}")
+            return False
+        if len(calls) != 3 or utils._runs_on_thread(["cd"]) or \
+                utils._runs_on_thread(["history", "-c"]) or \
+                not utils._runs_on_thread(["export"]):
+            print("Builtin thread metadata wrong")
+            return False
+    finally:
+        utils.BUILTINS.pop("tb_greet", None)
+
+    if utils.is_builtin_command("tb_greet"):
+        print("Removed builtin still detected")
+        return False
+
+    print("Builtin registry works correctly")
+    return True
+
+
 def test_shell_state():
     """Test shell state management"""
     import shell
@@ -178,23 +229,35 @@ def test_background_process_management():
     """Test background process management framework"""
     import shell
     import signals_mod
+    from jobs import JobTable
 
-    # Initialize empty background process list
-    shell.shell_state.background_processes = []
+    # Start from an empty job table
+    shell.shell_state.jobs = JobTable()
 
     # Test empty jobs list
     signals_mod.print_background_jobs()
 
-    # Test adding background process (simulate)
+    # Test adding background job (simulate)
     test_pid = 12345  # Fake PID for testing
-    shell.shell_state.background_processes.append(test_pid)
+    job = shell.shell_state.jobs.add([test_pid], "sleep 100")
 
-    if test_pid not in shell.shell_state.background_processes:
+    if shell.shell_state.jobs.job_for_pid(test_pid) is not job or \
+            shell.shell_state.jobs.get(job.job_id) is not job:
         print("Failed to add background process")
         return False
 
-    # Clean up
-    shell.shell_state.background_processes.clear()
+    signals_mod.print_background_jobs()
+
+    # Reaping the last process completes and retires the job
+    finished = shell.shell_state.jobs.child_exited(test_pid, 3 << 8)
+    if finished is not job or job.exit_status != 3:
+        print("Job did not complete with the reaped status")
+        return False
+    shell.shell_state.jobs.remove(job)
+
+    if shell.shell_state.jobs:
+        print("Job was not removed")
+        return False
 
     print("Background process management framework works")
     return True
@@ -217,16 +280,20 @@ def test_signal_setup():
 
 def test_environment_commands():
     """Test environment variable commands"""
+    import shell
     import utils
 
+    variables = shell.shell_state.variables
+
     # Test export command
     result = utils.execute_builtin(["export", "TEST_VAR=test_value"])
     if result != 0:
         print("export command failed")
         return False
 
-    # Check if variable was set
-    if os.environ.get("TEST_VAR") != "test_value":
+    # Check if variable was set (and is passed to commands)
+    if variables.get("TEST_VAR") != "test_value" or \
+            variables.environment().get(b"TEST_VAR") != b"test_value":
         print("export didn't set environment variable")
         return False
 
@@ -237,7 +304,7 @@ def test_environment_commands():
         return False
 
     # Check if variable was removed
-    if "TEST_VAR" in os.environ:
+    if "TEST_VAR" in variables or b"TEST_VAR" in variables.environment():
         print("unset didn't remove environment variable")
         return False
 
@@ -271,6 +338,17 @@ def test_cd_command():
             print("cd didn't change directory correctly")
             return False
 
+        # The argument arrives expanded: a quoted '$HOME' is a name
+        with tempfile.TemporaryDirectory() as tmp:
+            literal = os.path.join(os.path.realpath(tmp), "$HOME")
+            os.mkdir(literal)
+            shell.execute_line(f"cd {tmp} && cd '$HOME'")
+            landed = os.getcwd()
+            utils.execute_builtin(["cd", original_dir])
+        if landed != literal:
+            print(f"cd '$HOME' went to {landed}")
+            return False
+
         print("cd command works correctly")
         return True
 
@@ -302,6 +380,1219 @@ def test_error_handling():
     return True
 
 
+def test_script_mode():
+    """Test non-interactive -c / script execution and the parse cache"""
+    import shell
+    import utils
+
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+
+    # -c runs each line without prompts and exits with the last status
+    result = subprocess.run(
+        [sys.executable, shell_path, "-c", "echo one\necho two $?\nexit 5"],
+        capture_output=True, text=True, timeout=10)
+    if result.stdout != "one\ntwo 0\n" or result.returncode != 5:
+        print(f"-c failed: {result.stdout!r} (exit {result.returncode})")
+        return False
+
+    # Script file mode reads the whole file up front
+    with tempfile.NamedTemporaryFile("w", suffix=".sh", delete=False) as f:
+        f.write("echo from script\n\necho done\n")
+        script_path = f.name
+    try:
+        result = subprocess.run([sys.executable, shell_path, script_path],
+                                capture_output=True, text=True, timeout=10)
+    finally:
+        os.unlink(script_path)
+    if result.stdout != "from script\ndone\n" or result.returncode != 0:
+        print(f"script failed: {result.stdout!r} (exit {result.returncode})")
+        return False
+
+    # Repeated lines are parsed once; expansion still runs every time
+    utils.parse_line.cache_clear()
+    variables = shell.shell_state.variables
+    variables.set("TEST_CACHE_VAR", "first")
+    first = utils.expand_tokens(
+        utils.parse_line("echo $TEST_CACHE_VAR").commands[0].words)
+    variables.set("TEST_CACHE_VAR", "second")
+    second = utils.expand_tokens(
+        utils.parse_line("echo $TEST_CACHE_VAR").commands[0].words)
+    variables.unset("TEST_CACHE_VAR")
+    if first != ["echo", "first"] or second != ["echo", "second"]:
+        print(f"Cached parse expanded wrongly: {first}, {second}")
+        return False
+    if utils.parse_line.cache_info().hits != 1:
+        print("Repeated line was not served from the parse cache")
+        return False
+
+    print("Script mode works correctly")
+    return True
+
+
+def test_spawn_backends():
+    """Test external command execution with both spawn backends"""
+    import utils
+
+    original = utils.spawn_backend
+    try:
+        for backend in utils.SPAWN_BACKENDS:
+            utils.set_spawn_backend(backend)
+
+            result = utils.execute_command(["sh", "-c", "exit 3"])
+            if result != 3:
+                print(f"{backend}: expected exit 3, got {result}")
+                return False
+
+            result = utils.execute_command(["no_such_command_xyz"])
+            if result != 127:
+                print(f"{backend}: expected 127 for missing command, "
+                      f"got {result}")
+                return False
+            print(f"{backend} backend works")
+    finally:
+        utils.spawn_backend = original
+
+    try:
+        utils.set_spawn_backend("teleport")
+        print("Unknown backend was accepted")
+        return False
+    except ValueError:
+        pass
+
+    print("Spawn backends work correctly")
+    return True
+
+
+def test_command_hash():
+    """Test the PATH lookup cache and the hash builtin"""
+    import utils
+    import shell
+
+    original_path = shell.shell_state.variables.get("PATH", "")
+    with tempfile.TemporaryDirectory() as tmp:
+        tool = os.path.join(tmp, "hash_test_tool")
+        with open(tool, "w") as f:
+            f.write("#!/bin/sh\nexit 4\n")
+        os.chmod(tool, 0o755)
+
+        try:
+            utils.execute_builtin(["export", f"PATH={tmp}:{original_path}"])
+            if shell.shell_state.command_hash:
+                print("export PATH did not clear the hash table")
+                return False
+
+            for _ in range(3):
+                if utils.execute_command(["hash_test_tool"]) != 4:
+                    print("hashed command did not run")
+                    return False
+            if shell.shell_state.command_hash.get("hash_test_tool") != \
+                    [tool, 3]:
+                print(f"Unexpected hash entry: "
+                      f"{shell.shell_state.command_hash}")
+                return False
+
+            # A stale location is searched again instead of failing
+            shell.shell_state.command_hash["hash_test_tool"] = \
+                ["/nonexistent/hash_test_tool", 1]
+            if utils.execute_command(["hash_test_tool"]) != 4:
+                print("stale hash entry was not refreshed")
+                return False
+
+            if utils.execute_builtin(["hash", "-r"]) != 0 or \
+                    shell.shell_state.command_hash:
+                print("hash -r did not clear the table")
+                return False
+            if utils.execute_builtin(["hash", "no_such_command_xyz"]) == 0:
+                print("hash accepted an unknown command")
+                return False
+        finally:
+            utils.set_variable("PATH", original_path)
+
+    print("Command hash table works correctly")
+    return True
+
+
+def test_prompt_cache():
+    """Test that the prompt reuses cached identity and follows cd"""
+    import utils
+    import shell
+
+    state = shell.shell_state
+    original_dir = os.getcwd()
+    saved = (state.prompt_user, state.prompt_host, state.prompt_home)
+    try:
+        state.prompt_user, state.prompt_host = "tester", "testhost"
+        state.prompt_home = original_dir
+        state.current_directory = original_dir
+        utils.set_prompt()
+        if state.prompt != "tester@testhost:~$":
+            print(f"Cached identity not used: {state.prompt}")
+            return False
+
+        with tempfile.TemporaryDirectory() as tmp:
+            utils.execute_builtin(["cd", tmp])
+            expected = f"tester@testhost:{os.path.realpath(tmp)}$"
+            if state.prompt != expected:
+                print(f"cd did not refresh prompt: {state.prompt}")
+                return False
+            utils.execute_builtin(["cd", original_dir])
+
+        if state.prompt != "tester@testhost:~$":
+            print(f"cd back did not refresh prompt: {state.prompt}")
+            return False
+    finally:
+        os.chdir(original_dir)
+        state.current_directory = original_dir
+        state.prompt_user, state.prompt_host, state.prompt_home = saved
+
+    print("Prompt cache works correctly")
+    return True
+
+
+def test_pipelines_and_redirection():
+    """Test pipes and redirections through the shell's executor"""
+    import shell
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "out.txt")
+
+        shell.execute_line(f"echo hello world | tr a-z A-Z > {out}")
+        shell.execute_line(f"echo again >> {out}")
+        with open(out) as f:
+            content = f.read()
+        if content != "HELLO WORLD\nagain\n":
+            print(f"Pipeline/redirection output wrong: {content!r}")
+            return False
+
+        count = os.path.join(tmp, "count.txt")
+        shell.execute_line(f"cat < {out} | grep -c again > {count}")
+        with open(count) as f:
+            if f.read().strip() != "1":
+                print("Input redirection into a pipeline failed")
+                return False
+
+        # Exit status of a pipeline is the status of its last stage
+        shell.execute_line("echo x | grep -q nomatch")
+        if shell.shell_state.last_exit_status != 1:
+            print(f"Wrong pipeline status: "
+                  f"{shell.shell_state.last_exit_status}")
+            return False
+
+        shell.execute_line(f"cat < {os.path.join(tmp, 'missing')}")
+        if shell.shell_state.last_exit_status != 1:
+            print("Missing input file did not fail")
+            return False
+
+    print("Pipelines and redirection work correctly")
+    return True
+
+
+def test_pipeline_stderr_capture():
+    """Test that chatty stderr in a pipeline is drained, not deadlocked"""
+    import io
+    import shell
+    import utils
+
+    state = shell.shell_state
+    original_stderr = sys.stderr
+    captured = io.StringIO()
+    try:
+        state.pipeline_stderr = "capture"
+        sys.stderr = captured
+        # 200 KB of stderr is far more than a pipe buffer holds
+        shell.execute_line(
+            "sh -c 'head -c 200000 /dev/zero | tr \"\\\\0\" e >&2; "
+            "echo out' | sh -c 'cat >/dev/null; echo tail-err >&2'")
+    finally:
+        sys.stderr = original_stderr
+        state.pipeline_stderr = "inherit"
+
+    if state.last_exit_status != 0:
+        print(f"Pipeline failed: {state.last_exit_status}")
+        return False
+    report = captured.getvalue()
+    if "stage 1" not in report or "tail-err" not in report:
+        print(f"Stage stderr not reported: {report[:200]!r}")
+        return False
+    if report.count("e") > 2 * utils.PIPELINE_STDERR_LIMIT:
+        print("Captured stderr was not bounded")
+        return False
+
+    ring = utils.StderrRing(8)
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"0123456789ab")
+    os.close(write_fd)
+    while ring.fill_from(read_fd):
+        pass
+    os.close(read_fd)
+    if ring.getvalue() != b"456789ab" or ring.dropped != 4:
+        print(f"Ring buffer kept {ring.getvalue()!r}")
+        return False
+
+    print("Pipeline stderr capture works correctly")
+    return True
+
+
+def test_pipestatus_and_pipefail():
+    """Test per-stage statuses and 'set -o pipefail'"""
+    import shell
+    import utils
+
+    state = shell.shell_state
+    try:
+        shell.execute_line("sh -c 'exit 2' | sleep 0.2 | true")
+        if state.last_exit_status != 0:
+            print("Pipeline status should come from the last stage")
+            return False
+        if utils.parse_command("echo $PIPESTATUS ${PIPESTATUS[0]}") != \
+                ["echo", "2 0 0", "2"]:
+            print(f"Unexpected PIPESTATUS: {state.pipestatus}")
+            return False
+        if state.pipestatus[1].real < 0.15:
+            print("Stage wall time was not recorded")
+            return False
+        if len(utils.parse_command("echo $PIPETIMES")[1].split()) != 3:
+            print("PIPETIMES should have one entry per stage")
+            return False
+
+        if utils.execute_builtin(["set", "-o", "pipefail"]) != 0:
+            print("set -o pipefail failed")
+            return False
+        shell.execute_line("sh -c 'exit 2' | sh -c 'exit 3' | true")
+        if state.last_exit_status != 3:
+            print(f"pipefail status wrong: {state.last_exit_status}")
+            return False
+
+        if utils.execute_builtin(["set", "-o", "nosuchoption"]) == 0:
+            print("Unknown option accepted")
+            return False
+
+        # A child whose status is lost counts as a failure, not success
+        real_wait = utils.wait_for_pids
+
+        def lose_statuses(pids, interruptible=False):
+            real_wait(pids, interruptible)
+            return {}
+
+        utils.wait_for_pids = lose_statuses
+        try:
+            shell.execute_line("sh -c true")
+            single = state.last_exit_status
+            shell.execute_line("sh -c true | sh -c true")
+            piped = [stage.status for stage in state.pipestatus]
+        finally:
+            utils.wait_for_pids = real_wait
+        if single == 0 or piped != [1, 1]:
+            print(f"Lost child reported as success: {single}, {piped}")
+            return False
+    finally:
+        state.options.discard("pipefail")
+
+    print("PIPESTATUS and pipefail work correctly")
+    return True
+
+
+def test_time_keyword():
+    """Test the 'time' prefix and TIMEFORMAT"""
+    import io
+    import shell
+    import utils
+
+    original_stderr = sys.stderr
+    captured = io.StringIO()
+    shell.shell_state.variables.set(
+        "TIMEFORMAT", "real=%2R cpu=%P rss=%M faults=%f %%")
+    try:
+        sys.stderr = captured
+        shell.execute_line("time sleep 0.2 | sh -c 'exit 4'")
+        status = shell.shell_state.last_exit_status
+        shell.execute_line("time pwd > /dev/null")
+    finally:
+        sys.stderr = original_stderr
+        shell.shell_state.variables.unset("TIMEFORMAT")
+
+    if status != 4:
+        print(f"time changed the pipeline status: {status}")
+        return False
+    reports = captured.getvalue().splitlines()
+    if len(reports) != 2 or not all(r.endswith(" %") for r in reports):
+        print(f"Unexpected time reports: {reports}")
+        return False
+    real = float(reports[0].split()[0].split("=")[1])
+    if not 0.15 < real < 5:
+        print(f"Implausible real time: {real}")
+        return False
+
+    text = utils.format_times("%lR|%1U|%S|%M", {
+        "R": 75.5, "U": 0.25, "S": 0.125, "M": 2048})
+    if text != "1m15.500s|0.2|0.125|2048":
+        print(f"format_times produced {text!r}")
+        return False
+
+    print("time keyword works correctly")
+    return True
+
+
+def test_job_table_reaping():
+    """Test that background jobs are tracked and reaped in one pass"""
+    import io
+    import shell
+    import signals_mod
+
+    state = shell.shell_state
+    original_stdout = sys.stdout
+    output = io.StringIO()
+    try:
+        sys.stdout = output
+        shell.execute_line("sh -c 'exit 7' | true &")
+        shell.execute_line("sh -c 'exit 5' &")
+        if len(state.jobs) != 2:
+            print("Background pipelines were not registered as jobs",
+                  file=original_stdout)
+            return False
+
+        deadline = time.time() + 5
+        while state.jobs and time.time() < deadline:
+            time.sleep(0.05)
+            signals_mod.handle_background_processes()
+    finally:
+        sys.stdout = original_stdout
+
+    if state.jobs:
+        print(f"Jobs were not reaped: {list(state.jobs)}")
+        return False
+    text = output.getvalue()
+    if "Done (exit status: 0)  sh -c exit 7 | true" not in text or \
+            "Done (exit status: 5)  sh -c exit 5" not in text:
+        print(f"Unexpected job reports: {text!r}")
+        return False
+
+    print("Job table reaping works correctly")
+    return True
+
+
+def test_job_control_builtins():
+    """Test stopping and continuing jobs with kill, bg, fg and wait"""
+    import io
+    import shell
+    import signals_mod
+    from jobs import RUNNING, STOPPED
+
+    state = shell.shell_state
+    original_stdout = sys.stdout
+    output = io.StringIO()
+    try:
+        sys.stdout = output
+        shell.execute_line("sleep 30 &")
+        job = state.jobs.current()
+        shell.execute_line("kill -STOP %1")
+
+        deadline = time.time() + 5
+        while job.state != STOPPED and time.time() < deadline:
+            time.sleep(0.05)
+            signals_mod.handle_background_processes()
+        stopped = job.state
+
+        shell.execute_line("bg %1")
+        resumed = job.state
+        shell.execute_line("kill %1")
+        shell.execute_line("wait %1")
+        killed_status = state.last_exit_status
+
+        shell.execute_line("sh -c 'sleep 0.2; exit 4' &")
+        shell.execute_line("fg")
+        fg_status = state.last_exit_status
+    finally:
+        sys.stdout = original_stdout
+
+    if stopped != STOPPED or resumed != RUNNING:
+        print(f"Job states were {stopped} / {resumed}: {output.getvalue()!r}")
+        return False
+    if killed_status != 128 + 15 or fg_status != 4:
+        print(f"Unexpected statuses: wait={killed_status}, fg={fg_status}")
+        return False
+    if state.jobs:
+        print(f"Jobs left in the table: {list(state.jobs)}")
+        return False
+    if "[1] Stopped  sleep 30" not in output.getvalue():
+        print(f"Stopped job was not reported: {output.getvalue()!r}")
+        return False
+
+    print("Job control builtins work correctly")
+    return True
+
+
+def test_parallel_builtin():
+    """Test the parallel builtin's ordering, limits and failure summary"""
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+
+    def run(command, lines):
+        return subprocess.run([sys.executable, shell_path, "-c", command],
+                              input="".join(f"{line}\n" for line in lines),
+                              capture_output=True, text=True, timeout=20)
+
+    # -k keeps input order even though later lines finish first
+    delays = ["6", "2", "4", "0"]
+    result = run("parallel -j 4 -k sh -c 'sleep 0.{}; echo {}'", delays)
+    if result.stdout.split() != delays:
+        print(f"Ordered output wrong: {result.stdout!r}")
+        return False
+
+    # Without -k each block is written when its command finishes
+    result = run("parallel -j 4 sh -c 'sleep 0.{}; echo {}'", delays)
+    if result.stdout.split() != sorted(delays):
+        print(f"Unordered output wrong: {result.stdout!r}")
+        return False
+
+    # The line is appended when the command has no {}
+    result = run("parallel -k echo item", ["a", "b"])
+    if result.stdout != "item a\nitem b\n":
+        print(f"Appended argument wrong: {result.stdout!r}")
+        return False
+
+    # -j 1 runs one at a time; failures are summarised on stderr
+    start = time.perf_counter()
+    result = run("parallel -j 1 sh -c 'sleep 0.2; exit {}'", ["0", "3", "0"])
+    elapsed = time.perf_counter() - start
+    if elapsed < 0.6 or result.returncode != 1 or \
+            "1 of 3 jobs failed" not in result.stderr or \
+            "exit 3:" not in result.stderr:
+        print(f"Failure summary wrong ({elapsed:.2f}s, exit "
+              f"{result.returncode}): {result.stderr!r}")
+        return False
+
+    print("Parallel builtin works correctly")
+    return True
+
+
+def test_shutdown_deadline():
+    """Test that exit terminates jobs together and kills only stragglers"""
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+
+    # 40 jobs that exit on SIGTERM plus one that ignores it; the shell
+    # exits (and shuts the jobs down) only once that one's trap is set
+    script = "sleep 100 &\n" * 40 + \
+        "sh -c 'trap \"\" TERM; touch \"$READY\"; exec sleep 100' &\n" \
+        "until [ -e \"$READY\" ]; do sleep 0.01; done\n"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = dict(os.environ, READY=os.path.join(tmpdir, "ready"))
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, shell_path, "--shutdown-timeout", "0.3",
+             "-c", script],
+            env=env, capture_output=True, text=True, timeout=20)
+        elapsed = time.perf_counter() - start
+
+    if elapsed > 2.5:
+        print(f"Shutdown took {elapsed:.2f}s")
+        return False
+    reports = [line for line in result.stderr.splitlines() if "killed" in line]
+    if len(reports) != 1 or not reports[0].startswith("shell: error: [41] ") \
+            or "after 0.3s" not in reports[0]:
+        print(f"Unexpected straggler report: {result.stderr!r}")
+        return False
+
+    print("Shutdown deadline works correctly")
+    return True
+
+
+def test_history_store():
+    """Test the bounded history, !-expansion, search and persistence"""
+    from history import History, EventNotFound, HISTORY_FLUSH_BATCH
+
+    history = History(size=3)
+    for line in ["make all", "echo one", "git status", "echo two"]:
+        history.add(line)
+    if len(history) != 3 or history.first != 2 or history.get(1) is not None:
+        print(f"Size cap not applied: {list(history)}")
+        return False
+
+    expected = {
+        "!!": "echo two",
+        "!3": "git status",
+        "!-3": "echo one",
+        "!git --short": "git status --short",
+        "!ec": "echo two",
+        "!?stat?": "git status",
+        "echo !$": "echo two",
+        "echo '!!' \\!x a!": "echo '!!' \\!x a!",
+    }
+    for line, result in expected.items():
+        if history.expand(line) != result:
+            print(f"{line!r} expanded to {history.expand(line)!r}")
+            return False
+    for line in ("!1", "!make", "!?zzz"):
+        try:
+            history.expand(line)
+            print(f"{line!r} should not match an evicted/missing entry")
+            return False
+        except EventNotFound:
+            pass
+
+    if history.search("echo") != [4, 2] or history.search("t") != [4, 3]:
+        print(f"Search results wrong: {history.search('echo')}")
+        return False
+
+    # Entries are appended to HISTFILE in batches, not one write per line
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "history")
+        history = History(size=100, path=path)
+        for i in range(HISTORY_FLUSH_BATCH - 1):
+            history.add(f"cmd {i}")
+        written_early = os.path.exists(path)
+        history.add("last of batch")
+        history.add("pending")
+        history.flush()
+
+        reloaded = History(size=10, path=path)
+        reloaded.load()
+        if written_early or len(reloaded) != 10 or \
+                reloaded.get(reloaded.last) != "pending":
+            print(f"Persistence wrong: early={written_early}, "
+                  f"{list(reloaded)}")
+            return False
+
+    # A command continued over several lines is one entry: !! reruns it all
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+    result = subprocess.run(
+        [sys.executable, shell_path],
+        input="if true\nthen echo one\nfi\n!!\nexit\n",
+        env=dict(os.environ, HISTFILE=""),
+        capture_output=True, text=True, timeout=10)
+    if result.stdout.count("one\n") != 3:    # echoed by !!, then run twice
+        print(f"Multi-line command not recalled whole: {result.stdout!r}")
+        return False
+
+    # ... also after being saved to HISTFILE and read back by a new shell
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = dict(os.environ, HISTFILE=os.path.join(tmpdir, "history"))
+        subprocess.run([sys.executable, shell_path],
+                       input="if true\nthen echo 'a\\nb'\nfi\nexit\n",
+                       env=env, capture_output=True, text=True, timeout=10)
+        result = subprocess.run([sys.executable, shell_path],
+                                input="history\n!if\nexit\n", env=env,
+                                capture_output=True, text=True, timeout=10)
+    if "1  if true\nthen echo 'a\\nb'\nfi\n" not in result.stdout or \
+            "then echo 'a\\nb'\nfi\na\\nb\n" not in result.stdout:
+        print(f"Multi-line entry not kept in HISTFILE: {result.stdout!r}")
+        return False
+
+    print("History store works correctly")
+    return True
+
+
+def test_alias_expansion():
+    """Test alias expansion at command positions, recursion and unalias"""
+    import shell
+    import utils
+
+    aliases = shell.shell_state.aliases
+    saved = dict(aliases)
+
+    def words(line):
+        return [utils.expand_tokens(command.words)
+                for command in utils.parse_line(line).commands]
+
+    try:
+        aliases.clear()
+        utils.alias_command(["ll=ls -l", "ls=ls -F", "loop1=loop2",
+                             "loop2=loop1 x", "run=env ", "grep=grep -n"])
+        if utils.expand_tokens(aliases["ll"].tokens) != ["ls", "-l"]:
+            print(f"Alias not pre-tokenized: {aliases['ll'].tokens}")
+            return False
+
+        expected = {
+            "ll /tmp | grep x": [["ls", "-F", "-l", "/tmp"],
+                                 ["grep", "-n", "x"]],
+            "echo ll": [["echo", "ll"]],
+            "loop1": [["loop1", "x"]],
+            "run ll": [["env", "ls", "-F", "-l"]],
+            "time ll": [["ls", "-F", "-l"]],
+        }
+        for line, result in expected.items():
+            if words(line) != result:
+                print(f"{line!r} expanded to {words(line)}")
+                return False
+
+        # Redefining or removing an alias invalidates cached parse trees
+        utils.alias_command(["ll=ls -la"])
+        redefined = words("ll")
+        utils.unalias_command(["ll"])
+        if redefined != [["ls", "-F", "-la"]] or words("ll") != [["ll"]]:
+            print(f"Stale alias after redefinition: {words('ll')}")
+            return False
+        if utils.unalias_command(["ll"]) != 1:
+            print("unalias of an unknown name should fail")
+            return False
+    finally:
+        aliases.clear()
+        aliases.update(saved)
+        utils.parse_line.cache_clear()
+
+    print("Alias expansion works correctly")
+    return True
+
+
+def test_lexer():
+    """Test quoting context, operator splitting and comments in the lexer"""
+    import shell
+    import utils
+    from lexer import tokenize, ParseError
+
+    variables = shell.shell_state.variables
+    variables.set("TEST_LEXER_VAR", "value")
+    try:
+        expanded = utils.parse_command(
+            """echo '$TEST_LEXER_VAR' "$TEST_LEXER_VAR" \\$TEST_LEXER_VAR"""
+            """ a$TEST_LEXER_VAR"b c" # comment""")
+    finally:
+        variables.unset("TEST_LEXER_VAR")
+    if expanded != ["echo", "$TEST_LEXER_VAR", "value", "$TEST_LEXER_VAR",
+                    "avalueb c"]:
+        print(f"Quoting context wrong: {expanded}")
+        return False
+
+    operators = [token for token in tokenize("a>b|c 2>>err && d || e; f &")
+                 if isinstance(token, str)]
+    if operators != [">", "|", "2>>", "&&", "||", ";", "&"]:
+        print(f"Operators split wrongly: {operators}")
+        return False
+
+    # Quoted operators and keywords stay words
+    words = tokenize("echo '|' \\> \"time\"")
+    if any(isinstance(token, str) for token in words) or \
+            words[3].keyword is not None:
+        print(f"Quoted operator treated as operator: {words}")
+        return False
+
+    for line in ("echo 'open", 'echo "open', "echo ${open"):
+        try:
+            tokenize(line)
+            print(f"No error for {line!r}")
+            return False
+        except ParseError:
+            pass
+
+    print("Lexer works correctly")
+    return True
+
+
+def test_command_lists():
+    """Test ';', '&&' and '||' lists, short-circuiting and $? in between"""
+    import utils
+    from parser_mod import CommandList, AndOrList, Pipeline
+    from lexer import ParseError
+
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+
+    def run(command):
+        return subprocess.run([sys.executable, shell_path, "-c", command],
+                              capture_output=True, text=True, timeout=20)
+
+    expected = {
+        "false && echo no || echo yes $?": "yes 1\n",
+        "true && echo a; echo b": "a\nb\n",
+        "false; echo $?; true || echo skipped": "1\n",
+        # The skipped side is never expanded, so its variables are unset
+        "export A=1 && export B=$A; echo $B": "1\n",
+        "false && export C=set; echo C=$C": "C=\n",
+        "sleep 0.1 && echo bg & echo fg; wait": "fg\nbg\n",
+    }
+    for command, output in expected.items():
+        result = run(command)
+        # Drop the "[n] pid Started in background" notice
+        if "".join(line for line in result.stdout.splitlines(True)
+                   if "Started" not in line) != output:
+            print(f"{command!r} printed {result.stdout!r}")
+            return False
+
+    result = run("exit 3; echo unreachable")
+    if result.returncode != 3 or result.stdout:
+        print(f"exit did not end the list: {result.stdout!r}")
+        return False
+
+    # A single pipeline stays a bare Pipeline; lists nest by precedence
+    tree = utils.parse_line("a | b && c; d &")
+    if not isinstance(utils.parse_line("a | b"), Pipeline) or \
+            not isinstance(tree, CommandList) or \
+            not isinstance(tree.items[0], AndOrList) or \
+            not tree.items[1].background:
+        print(f"Unexpected tree: {tree!r}")
+        return False
+
+    for line in ("; a", "a && ", "a ;; b", "|| b", "a | && b"):
+        try:
+            utils.parse_line(line)
+            print(f"No error for {line!r}")
+            return False
+        except ParseError:
+            pass
+
+    print("Command lists work correctly")
+    return True
+
+
+def test_builtin_pipeline_threads():
+    """Test builtins in pipelines running on threads instead of forking"""
+    import shell
+    import utils
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "out")
+        shell.shell_state.variables.set("TEST_THREAD_VAR", "threaded")
+        try:
+            utils.execute_tree(utils.parse_line(
+                f"echo $TEST_THREAD_VAR | tr a-z A-Z > {out}"))
+        finally:
+            shell.shell_state.variables.unset("TEST_THREAD_VAR")
+        with open(out) as f:
+            content = f.read()
+        first = shell.shell_state.pipestatus[0]
+        if content != "THREADED\n":
+            print(f"Threaded echo output wrong: {content!r}")
+            return False
+        # A thread stage has no child process (and so no wait4 rusage)
+        if first.status != 0 or first.rusage is not None:
+            print(f"echo stage should run on a thread: {first!r}")
+            return False
+
+        # Builtins that change state still run in a subshell
+        utils.execute_tree(utils.parse_line(
+            "export TEST_THREAD_LEAK=1 | cat"))
+        if "TEST_THREAD_LEAK" in shell.shell_state.variables:
+            print("export in a pipeline leaked into the shell")
+            return False
+
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+    result = subprocess.run([sys.executable, shell_path, "-c",
+                             "echo a | echo b; pwd | cat"],
+                            capture_output=True, text=True, timeout=20)
+    if result.stdout != f"b\n{os.getcwd()}\n":
+        print(f"Builtin-only pipeline output wrong: {result.stdout!r}")
+        return False
+
+    print("Builtin pipeline stages work correctly")
+    return True
+
+
+def test_fd_redirections():
+    """Test 2>&1, &>, >&-, here-strings and here-documents"""
+    import tempfile
+    from lexer import tokenize, IncompleteInput
+    from utils import parse_line
+
+    shell_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "shell.py")
+    emit = ("python3 -c \"import sys; print('out'); sys.stdout.flush(); "
+            "sys.stderr.write('err\\\\n')\"")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log = os.path.join(tmp, "log")
+        big = "x" * 100_000
+        script = "\n".join([
+            f"{emit} > {log} 2>&1; cat {log}",
+            f"{emit} 2>&1 >/dev/null",          # only stderr, to stdout
+            f"{emit} &> {log}; {emit} &>> {log}; wc -l < {log}",
+            "/bin/echo closed >&- || echo failed",
+            "export WHO=world",
+            "cat <<EOF | tr a-z A-Z",
+            "hello $WHO",
+            "EOF",
+            "cat <<'EOF'",
+            "kept $WHO",
+            "EOF",
+            "cat <<-EOF",
+            "\t\ttabs stripped",
+            "\tEOF",
+            "tr a-z A-Z <<< \"$WHO\"",
+            "wc -c <<EOF",
+            big,        # larger than a pipe buffer: goes through a memfd
+            "EOF",
+        ])
+        path = os.path.join(tmp, "script.sh")
+        with open(path, "w") as f:
+            f.write(script + "\n")
+        result = subprocess.run([sys.executable, shell_path, path],
+                                capture_output=True, text=True, timeout=20)
+
+    expected = ["out", "err", "err", "4", "failed", "HELLO WORLD",
+                "kept $WHO", "tabs stripped", "WORLD", str(len(big) + 1)]
+    if result.stdout.split("\n")[:-1] != expected:
+        print(f"Redirection output wrong: {result.stdout!r} "
+              f"(stderr {result.stderr!r})")
+        return False
+
+    # A here-document or quote without its end asks for more input
+    for line in ("cat <<EOF\nbody", "echo 'open", "echo a |"):
+        try:
+            parse_line(line)
+            print(f"{line!r} should be incomplete")
+            return False
+        except IncompleteInput:
+            pass
+    if tokenize("cat <<EOF\nbody\nEOF")[2].text != "body\n":
+        print("Here-document body not attached to its operator")
+        return False
+
+    print("Fd-level redirections work correctly")
+    return True
+
+
+def test_command_substitution():
+    """Test $(...) capture, field splitting, limits and the builtin path"""
+    import shell
+    import utils
+
+    shell.shell_state.variables.set("TEST_SUBST_VAR", "a  b")
+    try:
+        words = utils.parse_command(
+            'x $(printf "1 2\\n3\\n\\n") "$(printf "1 2\\n\\n")" '
+            'p$(echo $TEST_SUBST_VAR)q "$(echo $(echo nested))"')
+    finally:
+        shell.shell_state.variables.unset("TEST_SUBST_VAR")
+    # Unquoted results split into words; quoted ones lose only the
+    # trailing newlines
+    if words != ["x", "1", "2", "3", "1 2", "pa", "bq", "nested"]:
+        print(f"Substitution expanded wrongly: {words}")
+        return False
+
+    # A printing builtin is captured in-process, without forking
+    real_fork = os.fork
+    os.fork = None
+    try:
+        output = utils.command_substitution("echo in process")
+    finally:
+        os.fork = real_fork
+    if output != "in process":
+        print(f"In-process substitution wrong: {output!r}")
+        return False
+
+    # State changes inside $(...) stay in its subshell
+    cwd = os.getcwd()
+    if utils.command_substitution("cd /; pwd") != "/" or os.getcwd() != cwd:
+        print("cd inside $(...) leaked into the shell")
+        return False
+
+    limit = shell.shell_state.substitution_limit
+    shell.shell_state.substitution_limit = 100
+    try:
+        output = utils.command_substitution("yes")
+    finally:
+        shell.shell_state.substitution_limit = limit
+    if output != "y\n" * 49 + "y":
+        print(f"Capped output wrong: {len(output)} characters")
+        return False
+
+    print("Command substitution works correctly")
+    return True
+
+
+def test_globbing():
+    """Test pathname expansion, quoting and the directory listing cache"""
+    import glob_mod
+    import utils
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("a.gz", "b.gz", "c.txt", ".hidden.gz", "sub/x.gz",
+                     "sub/deep/y.gz"):
+            path = os.path.join(directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        # Old mtimes, so the listings are cached
+        for path in (directory, f"{directory}/sub", f"{directory}/sub/deep"):
+            os.utime(path, (time.time() - 60, time.time() - 60))
+
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            cases = [
+                ("echo *.gz", ["echo", "a.gz", "b.gz"]),
+                ('echo "*.gz" \\*.gz', ["echo", "*.gz", "*.gz"]),
+                ("echo [!a].* ?.txt", ["echo", "b.gz", "c.txt", "c.txt"]),
+                ("echo .*.gz", ["echo", ".hidden.gz"]),
+                ("echo **/*.gz", ["echo", "a.gz", "b.gz", "sub/deep/y.gz",
+                                  "sub/x.gz"]),
+                ("echo */ none* a[b", ["echo", "sub/", "none*", "a[b"]),
+                ("echo $(echo '*.txt') s*/x.gz", ["echo", "*.txt",
+                                                  "sub/x.gz"]),
+            ]
+            for line, expected in cases:
+                words = utils.parse_command(line)
+                if words != expected:
+                    print(f"{line!r} expanded to {words}")
+                    return False
+
+            glob_mod.directory_cache.clear()
+            glob_mod.glob("*.gz")
+            misses = glob_mod.directory_cache.misses
+            glob_mod.glob("*.gz")
+            if glob_mod.directory_cache.misses != misses:
+                print("Unchanged directory was listed again")
+                return False
+
+            # A change to the directory shows up in the next expansion
+            open("d.gz", "w").close()
+            if glob_mod.glob("*.gz") != ["a.gz", "b.gz", "d.gz"]:
+                print("Cached listing was not refreshed")
+                return False
+        finally:
+            os.chdir(cwd)
+            glob_mod.directory_cache.clear()
+
+    print("Globbing works correctly")
+    return True
+
+
+def test_shell_variables():
+    """Test shell variables, export flags, ${...} operations and $((...))"""
+    import shell
+    import utils
+
+    variables = shell.shell_state.variables
+    names = ("TV_PLAIN", "TV_SAME", "TV_FILE", "TV_SET", "TV_N", "TV_OUT")
+
+    def run(line: str) -> str:
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "out")
+            shell.execute_line(f"{line} > {out}")
+            with open(out) as f:
+                return f.read()
+
+    try:
+        # A plain assignment stays in the shell; export passes it on
+        variables.environment()
+        rebuilds = variables.rebuilds
+        shell.execute_line("TV_PLAIN=local")
+        if run("sh -c 'echo \"[$TV_PLAIN]\"'") != "[]\n" or \
+                variables.get("TV_PLAIN") != "local":
+            print("Unexported variable reached a command")
+            return False
+        if variables.rebuilds != rebuilds:
+            print("Unexported assignment rebuilt the environment")
+            return False
+        shell.execute_line("export TV_PLAIN")
+        if run("sh -c 'echo \"[$TV_PLAIN]\"'") != "[local]\n":
+            print("export did not pass the variable on")
+            return False
+
+        # Exporting with the value it already has still passes it on
+        shell.execute_line("TV_SAME=1")
+        run("true")
+        shell.execute_line("export TV_SAME=1")
+        if run("sh -c 'echo \"[$TV_SAME]\"'") != "[1]\n":
+            print("export VAR=value with an unchanged value not passed on")
+            return False
+
+        # VAR=value before a command is for that command only
+        if run("TV_OUT=once sh -c 'echo $TV_OUT'") != "once\n" or \
+                "TV_OUT" in variables:
+            print("Command prefix assignment wrong")
+            return False
+
+        # Only words before the command name are assignments
+        words = utils.parse_command("x TV_FILE=a.tar.gz ${#TV_FILE}")
+        if words != ["x", "TV_FILE=a.tar.gz", "0"]:
+            print(f"Assignment-looking argument expanded wrongly: {words}")
+            return False
+
+        shell.execute_line("TV_FILE=archive.tar.gz TV_N=6")
+        expansions = [
+            ("${TV_FILE%.gz} ${TV_FILE%%.*} ${TV_FILE#*.} ${TV_FILE##*.}",
+             ["archive.tar", "archive", "tar.gz", "gz"]),
+            ("${#TV_FILE} ${TV_NONE:-de fault} ${TV_N:+set} ${TV_NONE+x}",
+             ["14", "de fault", "set", ""]),
+            ("${TV_SET:=new} $TV_SET", ["new", "new"]),
+            ("$((TV_N * 7)) $((TV_N++ + 1, TV_N)) $((2 ** 64)) $((-7 / 2))",
+             ["42", "7", "0", "-3"]),
+            ('"$((1 + 2))"$(echo $((TV_N << 1)))', ["314"]),
+        ]
+        for line, expected in expansions:
+            words = utils.parse_command(line)
+            if words != expected:
+                print(f"{line!r} expanded to {words}")
+                return False
+
+        # Assignments in $((...)) have the effects of VAR=value
+        history = shell.shell_state.history
+        size = history.size
+        try:
+            if utils.parse_command("$((HISTSIZE = 7))") != ["7"] or \
+                    history.size != 7:
+                print("$((HISTSIZE = 7)) did not resize the history")
+                return False
+        finally:
+            variables.unset("HISTSIZE")
+            history.resize(size)
+
+        # Expansion errors stop the command, not the rest of the list
+        if run("echo ${TV_NONE:?unset} ran; echo next") != "next\n" or \
+                run("echo $((1 / 0)) ran; echo next") != "next\n":
+            print("Expansion error did not stop its command")
+            return False
+    finally:
+        for name in names:
+            variables.unset(name)
+
+    print("Shell variables work correctly")
+    return True
+
+
+def test_control_flow():
+    """Test if/while/until/for, { }, functions and test / ["""
+    import shell
+    import parser_mod
+    import utils
+
+    state = shell.shell_state
+    names = ("CF_I", "CF_N", "CF_OUT")
+
+    def run(line: str) -> str:
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "out")
+            shell.execute_line(f"{{ {line}; }} > {out}")
+            with open(out) as f:
+                return f.read()
+
+    try:
+        cases = [
+            ("for CF_I in a b c; do echo $CF_I; done", "a\nb\nc\n"),
+            ("CF_N=0; while [ $CF_N -lt 3 ]; do CF_N=$((CF_N + 1)); done; "
+             "echo $CF_N", "3\n"),
+            ("until [ $CF_N -eq 0 ]; do CF_N=$((CF_N - 1)); done; echo $CF_N",
+             "0\n"),
+            ("if false; then echo 1; elif [ -d / -a ! -f / ]; then echo 2; "
+             "else echo 3; fi", "2\n"),
+            ("for CF_I in 1 2 3 4; do [ $CF_I = 2 ] && continue; "
+             "[ $CF_I = 4 ] && break; echo $CF_I; done", "1\n3\n"),
+            ("for CF_I in 1 2; do for CF_N in 1 2; do continue 2; done; "
+             "echo no; done; echo $CF_I$CF_N", "21\n"),
+            ("for CF_I in 3 1 2; do echo $CF_I; done | sort", "1\n2\n3\n"),
+            ("if true\nthen\n  echo multi\nfi", "multi\n"),
+        ]
+        for line, expected in cases:
+            output = run(line)
+            if output != expected:
+                print(f"{line!r} printed {output!r}")
+                return False
+
+        # Functions: positional parameters, return, recursion, "$@"
+        shell.execute_line("cf_args() { echo \"$# $1 $2\"; return 7; }")
+        shell.execute_line("cf_each() { for CF_I in \"$@\"; do "
+                           "echo \"[$CF_I]\"; done; }")
+        shell.execute_line("cf_fact() { if [ $1 -le 1 ]; then echo 1; else "
+                           "echo $(( $1 * $(cf_fact $(( $1 - 1 ))) )); fi; }")
+        if run("cf_args 'a b' c; echo $?") != "2 a b c\n7\n":
+            print("Function arguments or return status wrong")
+            return False
+        if run("cf_each 'x y' z") != "[x y]\n[z]\n" or \
+                run("cf_fact 5") != "120\n":
+            print("Function with \"$@\" or recursion wrong")
+            return False
+        if state.positional or state.function_depth or state.loop_depth:
+            print("Function call left its state behind")
+            return False
+
+        # Redirected compound commands run in the shell itself
+        if run("{ CF_OUT=kept; echo grouped; } > /dev/null; echo $CF_OUT") \
+                != "kept\n":
+            print("Redirected group ran in a subshell")
+            return False
+
+        # Syntax: incomplete input asks for more, misplaced words fail
+        if not shell.is_incomplete("while true; do") or \
+                not shell.is_incomplete("f() {"):
+            print("Unfinished compound command not incomplete")
+            return False
+        for line in ("fi", "if; then :; fi", "for 1 in a; do :; done",
+                     "{ echo a; } b"):
+            try:
+                utils.parse_line(line)
+            except ValueError:
+                continue
+            print(f"{line!r} parsed")
+            return False
+
+        # A loop body is parsed once, however often it runs
+        tree = utils.parse_line("for CF_I in 1 2 3; do echo $CF_I; done")
+        loop = tree.commands[0]
+        if not isinstance(loop, parser_mod.ForLoop) or \
+                utils.parse_line("for CF_I in 1 2 3; do echo $CF_I; done") \
+                is not tree:
+            print("Loop not compiled to a cached tree")
+            return False
+
+        # test / [ edge cases
+        checks = [("[ a = a ]", 0), ("[ -n '' ]", 1), ("test 3 -gt 2", 0),
+                  ("[ ! -e /nonexistent ]", 0), ("[ a ]", 0), ("[ ]", 1),
+                  ("[ 1 -eq x ]", 2), ("[ a = a", 2)]
+        for line, expected in checks:
+            shell.execute_line(line + " 2> /dev/null")
+            if state.last_exit_status != expected:
+                print(f"{line!r} returned {state.last_exit_status}")
+                return False
+    finally:
+        for name in names:
+            state.variables.unset(name)
+        for name in ("cf_args", "cf_each", "cf_fact"):
+            state.functions.pop(name, None)
+
+    print("Control flow works correctly")
+    return True
+
+
+def test_startup():
+    """Test lazy imports, the argparse-free path and --startup-profile"""
+    import shell
+    import state
+
+    if shell.shell_state is not state.shell_state:
+        print("shell and state hold different shell states")
+        return False
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    shell_path = os.path.join(here, "shell.py")
+
+    # A plain -c run loads none of the modules only some commands need
+    lazy = ("argparse", "socket", "pwd", "arithmetic")
+    probe = ("import sys, shell; shell.main(['-c', 'echo ok']); "
+             f"print([m for m in {lazy!r} if m in sys.modules])")
+    result = subprocess.run([sys.executable, "-c", probe], cwd=here,
+                            capture_output=True, text=True, timeout=10)
+    if result.stdout != "ok\n[]\n":
+        print(f"-c loaded lazy modules: {result.stdout!r} {result.stderr!r}")
+        return False
+
+    # The fast path gives the same options argparse would
+    for argv in ([], ["-c", "true"], ["script.sh", "a", "b"]):
+        fast = vars(shell._simple_arguments(argv))
+        if fast != vars(shell.parse_arguments(argv + ["--shutdown-timeout",
+                                                      "1.0"])):
+            print(f"Fast argument path differs for {argv}: {fast}")
+            return False
+    if shell._simple_arguments(["--pipeline-stderr", "capture"]) is not None:
+        print("Fast argument path accepted an option it doesn't know")
+        return False
+
+    result = subprocess.run(
+        [sys.executable, shell_path, "--startup-profile", "-c", "echo ok"],
+        capture_output=True, text=True, timeout=10)
+    if result.stdout != "ok\n" or "startup profile (ms):" not in \
+            result.stderr or "parse arguments" not in result.stderr or \
+            "  total " not in result.stderr:
+        print(f"--startup-profile output wrong: {result.stderr!r}")
+        return False
+
+    print("Startup works correctly")
+    return True
+
+
 def main():
     """Run all tests and report results"""
     print("=" * 60)
@@ -314,6 +1605,7 @@ def main():
         ("Utility Functions", test_utility_functions),
         ("Command Parsing", test_command_parsing),
         ("Built-in Detection", test_builtin_detection),
+        ("Builtin Registry", test_builtin_registry),
         ("Shell State Management", test_shell_state),
         ("Built-in Commands", test_builtin_commands),
         ("Background Process Management", test_background_process_management),
@@ -321,6 +1613,29 @@ def main():
         ("Environment Commands", test_environment_commands),
         ("Directory Commands", test_cd_command),
         ("Error Handling", test_error_handling),
+        ("Script Mode", test_script_mode),
+        ("Spawn Backends", test_spawn_backends),
+        ("Command Hash", test_command_hash),
+        ("Prompt Cache", test_prompt_cache),
+        ("Pipelines and Redirection", test_pipelines_and_redirection),
+        ("Pipeline Stderr Capture", test_pipeline_stderr_capture),
+        ("PIPESTATUS and pipefail", test_pipestatus_and_pipefail),
+        ("Time Keyword", test_time_keyword),
+        ("Job Table Reaping", test_job_table_reaping),
+        ("Job Control Builtins", test_job_control_builtins),
+        ("Parallel Builtin", test_parallel_builtin),
+        ("Shutdown Deadline", test_shutdown_deadline),
+        ("History Store", test_history_store),
+        ("Alias Expansion", test_alias_expansion),
+        ("Lexer", test_lexer),
+        ("Command Lists", test_command_lists),
+        ("Builtin Pipeline Threads", test_builtin_pipeline_threads),
+        ("Fd Redirections", test_fd_redirections),
+        ("Command Substitution", test_command_substitution),
+        ("Globbing", test_globbing),
+        ("Shell Variables", test_shell_variables),
+        ("Control Flow", test_control_flow),
+        ("Startup", test_startup),
     ]
 
     passed = 0
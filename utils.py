@@ -6,13 +6,33 @@ Utility Functions Module for CLI
 
 import os
 import sys
-import pwd
-import socket
-import subprocess
-import shlex
+import errno
+import fcntl
+import io
+import select
 import re
 import signal
-from typing import List, Optional
+import functools
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, \
+    Iterable, Union
+import glob_mod
+from lexer import Word, LITERAL, PARAM, COMMAND, ARITH, TILDE, tokenize, \
+    parse_operand, ParseError
+from variables import ExpansionError
+from parser_mod import Pipeline, SimpleCommand, AndOrList, CommandList, \
+    Node, Redirect, ParseError, Alias, AND, expand_aliases, parse_tokens, \
+    command_text, If, WhileLoop, ForLoop, BraceGroup, FunctionDef, Compound
+from state import shell_state, DEFAULT_SUBSTITUTION_LIMIT
+
+# pwd, socket and arithmetic are imported where they are first needed: a
+# "shell.py -c" run usually never looks up the user or host name or
+# evaluates $((...)), and loading them is a noticeable part of startup
+
+# Child fd -> shell fd to dup2 there, or None to close it (>&-)
+FdMap = Dict[int, Optional[int]]
 
 
 def print_error(message: str):
@@ -34,88 +54,477 @@ def get_current_directory() -> str:
         return "/"
 
 
-def set_prompt():
-    """Set the shell prompt in format: user@hostname:path$"""
-    # Import here to avoid circular import
-    from shell import shell_state
-
-    cwd = shell_state.current_directory
+def refresh_prompt_identity():
+    """
+    Resolve the user, host and home directory shown in the prompt.
 
-    # Get home directory for path shortening
-    home = os.path.expanduser("~")
-    if cwd == home:
-        cwd = "~"
-    elif cwd.startswith(home + "/"):
-        cwd = "~" + cwd[len(home):]
+    These need NSS/DNS lookups (pwd.getpwuid can go to LDAP), so they are
+    resolved once at startup and cached on shell_state; call this again to
+    pick up changes.
+    """
+    import pwd
+    import socket
 
     # Get username
     try:
-        username = pwd.getpwuid(os.getuid()).pw_name
+        shell_state.prompt_user = pwd.getpwuid(os.getuid()).pw_name
     except (KeyError, OSError):
-        username = os.getenv("USER", "user")
+        shell_state.prompt_user = os.getenv("USER", "user")
 
     # Get hostname
     try:
-        hostname = socket.gethostname()
+        shell_state.prompt_host = socket.gethostname()
     except OSError:
-        hostname = "localhost"
+        shell_state.prompt_host = "localhost"
+
+    # Get home directory for path shortening
+    shell_state.prompt_home = home_directory()
+
+
+def set_prompt():
+    """
+    Set the shell prompt in format: user@hostname:path$
+
+    Only the path part is recomputed; call it when current_directory changes.
+    """
+    if shell_state.prompt_user is None:
+        refresh_prompt_identity()
+
+    cwd = shell_state.current_directory
+    home = shell_state.prompt_home
+    if cwd == home:
+        cwd = "~"
+    elif cwd.startswith(home + "/"):
+        cwd = "~" + cwd[len(home):]
 
     # Create prompt
-    shell_state.prompt = f"{username}@{hostname}:{cwd}$"
+    shell_state.prompt = \
+        f"{shell_state.prompt_user}@{shell_state.prompt_host}:{cwd}$"
+
+
+def home_directory() -> str:
+    """$HOME, or the user's home directory from the password database"""
+    home = shell_state.variables.get("HOME")
+    if home is not None:
+        return home
+    import pwd
+    try:
+        return pwd.getpwuid(os.getuid()).pw_dir
+    except KeyError:
+        return "/"
 
 
 # Regex for $VAR, ${VAR}, and $?
 _VAR_PATTERN = re.compile(r"\$(\w+|\{[^}]+\}|\?)")
 
 
-def _expand_variables(token: str) -> str:
+# Read-only variables describing the stages of the last pipeline
+_PIPE_VARIABLES = ("PIPESTATUS", "PIPETIMES")
+_INDEXED_NAME = re.compile(r"(\w+)\[(\d+)\]$")
+
+
+def _expand_pipe_variable(name: str) -> str:
+    """
+    Expand PIPESTATUS / PIPETIMES, optionally indexed like ${PIPESTATUS[1]}.
+
+    PIPESTATUS holds each stage's exit status; PIPETIMES holds each stage's
+    "wall/cpu" seconds, to spot the slow stage of a pipeline.
+    """
+    index = None
+    match = _INDEXED_NAME.match(name)
+    if match:
+        name, index = match.group(1), int(match.group(2))
+    if name not in _PIPE_VARIABLES:
+        return shell_state.variables.get(name, "")
+
+    if name == "PIPESTATUS":
+        values = [str(stage.status) for stage in shell_state.pipestatus]
+    else:
+        values = [f"{stage.real:.3f}/{stage.cpu:.3f}"
+                  for stage in shell_state.pipestatus]
+
+    if index is None:
+        return " ".join(values)
+    return values[index] if index < len(values) else ""
+
+
+def _parameter_value(name: str) -> str:
     """
-    Expand shell-style variables in a single token.
+    Value of one parameter reference.
 
     Supports:
-      - $VAR
-      - ${VAR}
-      - $?  (last exit status from shell_state)
+      - VAR (from $VAR or ${VAR}), a shell variable
+      - ?  (last exit status from shell_state)
+      - 1, 2, ... (positional parameters), # (their count), @ and *
+      - PIPESTATUS, PIPESTATUS[n], PIPETIMES (last pipeline's stages)
+      - the operations of ${...} (see _parameter_operation)
     """
-    # Import here to avoid circular import
-    from shell import shell_state
+    value = shell_state.variables.get(name)
+    if value is not None:
+        return value
 
-    def repl(match: re.Match) -> str:
-        name = match.group(1)
+    value = _special_parameter(name)
+    if value is not None:
+        return value
+
+    if name.startswith(_PIPE_VARIABLES):
+        return _expand_pipe_variable(name)
+
+    if _NAME.fullmatch(name):
+        return ""
+    return _parameter_operation(name)
+
+
+def _special_parameter(name: str) -> Optional[str]:
+    """
+    $?, $#, $@, $* and the positional parameters $0, $1, ...; None for
+    other names and for positional parameters that are not set
+    """
+    if name == "?":
+        return str(shell_state.last_exit_status)
+    positional = shell_state.positional
+    if name.isdigit():
+        index = int(name)
+        if index == 0:
+            return sys.argv[0]
+        return positional[index - 1] if index <= len(positional) else None
+    if name == "#":
+        return str(len(positional))
+    if name in ("@", "*"):
+        return " ".join(positional)
+    return None
+
+
+# Variables the shell itself reacts to (see _variable_changed)
+_SPECIAL_VARIABLES = frozenset(("PATH", "HOME", "HISTSIZE", "HISTFILE"))
+
+
+def set_variable(name: str, value: str, export: bool = False):
+    """Assign a shell variable (VAR=value, export, ${VAR:=word})"""
+    shell_state.variables.set(name, value, export)
+    if name in _SPECIAL_VARIABLES:
+        _variable_changed(name)
+
+
+def _variable_changed(name: str):
+    """Apply a new value (None: unset) of PATH, HOME, HISTSIZE or HISTFILE"""
+    value = shell_state.variables.get(name)
+    if name == "PATH":
+        clear_command_hash()
+    elif name == "HOME":
+        shell_state.prompt_home = home_directory()
+        set_prompt()
+    elif name == "HISTSIZE":
+        if value is None:
+            from history import DEFAULT_HISTSIZE
+            shell_state.history.resize(DEFAULT_HISTSIZE)
+        elif value.isdigit():
+            shell_state.history.resize(int(value))
+    elif name == "HISTFILE":
+        shell_state.history.flush()
+        shell_state.history.path = \
+            os.path.expanduser(value) if value else None
+
+
+_NAME = re.compile(r"\w+")
+
+# ${NAME<operator>word}
+_PARAMETER_OPERATION = re.compile(r"(\w+|[?#@*])(:?[-=+?]|##?|%%?)(.*)\Z",
+                                  re.DOTALL)
+
+
+def _parameter_operation(text: str) -> str:
+    """
+    Expand ${#VAR} (length) and ${VAR<op>word}:
+
+      - ${VAR:-word} / ${VAR-word}: word if VAR is unset or empty / unset
+      - ${VAR:=word} / ${VAR=word}: the same, also assigning it to VAR
+      - ${VAR:+word} / ${VAR+word}: word if VAR is set (and not empty)
+      - ${VAR:?word} / ${VAR?word}: fail with word as the message if not
+      - ${VAR#pat} / ${VAR##pat}: remove the shortest / longest prefix
+        matching the pattern pat (*, ?, [...])
+      - ${VAR%pat} / ${VAR%%pat}: the same for a suffix
+
+    Raises:
+        ExpansionError: for ${VAR:?word} and unknown operations
+    """
+    if text.startswith("#") and _NAME.fullmatch(text, 1):
+        return str(len(_parameter_value(text[1:])))
+
+    match = _PARAMETER_OPERATION.match(text)
+    if match is None:
+        raise ExpansionError(f"${{{text}}}: bad substitution")
+    name, operator, operand = match.groups()
+    value = shell_state.variables.get(name)
+    if value is None:
+        value = _special_parameter(name)
+    try:
+        word = parse_operand(operand)
+    except ParseError as e:
+        raise ExpansionError(f"${{{text}}}: {e}") from None
+
+    if operator[-1] in "-=+?":
+        missing = value is None or (operator[0] == ":" and not value)
+        if operator[-1] == "+":
+            return "" if missing else expand_word(word)
+        if not missing:
+            return value
+        if operator[-1] == "-":
+            return expand_word(word)
+        if operator[-1] == "=":
+            if not _NAME.fullmatch(name) or name[0].isdigit():
+                raise ExpansionError(f"${name}: cannot assign in this way")
+            value = expand_word(word)
+            set_variable(name, value)
+            return value
+        message = expand_word(word) or "parameter null or not set"
+        raise ExpansionError(f"{name}: {message}")
+
+    return _remove_affix(value or "", operator,
+                         _expand_pattern(word))
+
+
+def _expand_pattern(word: Word) -> str:
+    """Expand word into a pattern; only its unquoted literal text is active"""
+    out = []
+    for kind, text, quoted in word.parts:
+        if kind is LITERAL:
+            out.append(glob_mod.escape(text) if quoted else text)
+        else:
+            out.append(glob_mod.escape(_part_value(kind, text)))
+    return "".join(out)
+
+
+def _remove_affix(value: str, operator: str, pattern: str) -> str:
+    """Apply ${VAR#pat}, ${VAR##pat}, ${VAR%pat} or ${VAR%%pat}"""
+    prefix = operator[0] == "#"
+    if not glob_mod.has_magic(pattern):
+        text = glob_mod.unescape(pattern)
+        if prefix:
+            return value[len(text):] if value.startswith(text) else value
+        if text and value.endswith(text):
+            return value[:-len(text)]
+        return value
+
+    matches = re.compile(glob_mod.translate(pattern)).match
+    # Shortest prefix / longest suffix first: cut positions from the left
+    cuts = range(len(value) + 1)
+    if operator in ("##", "%"):
+        cuts = reversed(cuts)
+    for cut in cuts:
+        if matches(value[:cut] if prefix else value[cut:]):
+            return value[cut:] if prefix else value[:cut]
+    return value
+
+
+def _expand_variables(token: str) -> str:
+    """
+    Expand shell-style variables ($VAR, ${VAR}, $?) in a plain string.
 
-        # Special case: $?
-        if name == "?":
-            return str(shell_state.last_exit_status)
+    Used for tokens that did not come from the lexer; lexed words carry
+    their expansion sites already (see expand_word).
+    """
+    if "$" not in token:
+        return token
 
-        # Handle ${VAR}
+    def repl(match: re.Match) -> str:
+        name = match.group(1)
         if name.startswith("{") and name.endswith("}"):
             name = name[1:-1]
-
-        return os.environ.get(name, "")
+        return _parameter_value(name)
 
     return _VAR_PATTERN.sub(repl, token)
 
 
 def _expand_tilde(token: str) -> str:
     """
-    Expand ~ and ~user in tokens.
+    Expand ~ ($HOME) and ~user in tokens.
     """
+    if token == "~" or token.startswith("~/"):
+        return home_directory() + token[1:]
     if token.startswith("~"):
         return os.path.expanduser(token)
     return token
 
 
+# Number of distinct command lines whose parsed tree is kept in memory
+PARSE_CACHE_SIZE = 4096
+
+
+def tokenize_command(input_str: str) -> Tuple:
+    """
+    Split a raw command line into unexpanded tokens: lexer.Word objects
+    for words and plain strings for operators (see lexer.tokenize).
+
+    Raises:
+        ValueError: on unbalanced quotes or a dangling escape (ParseError)
+    """
+    return tuple(tokenize(input_str))
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_line(input_str: str) -> Optional[Node]:
+    """
+    Tokenize and parse a command line into an unexpanded command tree.
+
+    The tree depends only on the line text (and the aliases, which clear
+    the cache when they change), so it is cached (LRU-bounded) and scripts
+    that repeat the same lines only pay for tokenizing, alias expansion
+    and parsing once per distinct line. Variable expansion happens on
+    every execution.
+
+    Returns:
+        The tree to run (see parser_mod), or None for an empty/comment-only
+        line
+
+    Raises:
+        ValueError: on unbalanced quotes or misplaced operators (ParseError)
+    """
+    return parse_tokens(expand_aliases(tokenize_command(input_str),
+                                       shell_state.aliases))
+
+
+def _part_value(kind: str, text: str) -> str:
+    """Expand one non-literal word part"""
+    if kind is PARAM:
+        return _parameter_value(text)
+    if kind is COMMAND:
+        return command_substitution(text)
+    if kind is ARITH:
+        try:
+            expression = expand_word(parse_operand(text))
+        except ParseError as e:
+            raise ExpansionError(f"$(({text})): {e}") from None
+        import arithmetic
+        return str(arithmetic.evaluate(expression, shell_state.variables,
+                                       set_variable))
+    return _expand_tilde(text)          # TILDE
+
+
+def expand_word(word: Word) -> str:
+    """
+    Expand the parameter, command, arithmetic and tilde parts of a lexed
+    word
+
+    Raises:
+        ExpansionError: see _parameter_operation and arithmetic.evaluate
+    """
+    if word.static is not None:
+        return word.static
+
+    out = []
+    for kind, text, _ in word.parts:
+        if kind is LITERAL:
+            out.append(text)
+        else:
+            out.append(_part_value(kind, text))
+    return "".join(out)
+
+
+# Characters separating the fields of an unquoted $(...) result
+_FIELD_SEPARATORS = re.compile(r"[ \t\n]+")
+
+
+def expand_fields(word: Word) -> List[str]:
+    """
+    Expand a lexed word into fields: one, unless it has an unquoted
+    $(...) whose output is split on blanks and newlines ("$(...)" is not
+    split, and neither are $VAR values), $@ (one field per positional
+    parameter, quoted or not), or unquoted *, ? or [ that match
+    file names (see glob_mod.py; a pattern matching nothing is kept).
+    Only characters written in the word itself are pattern characters,
+    not those in $VAR or $(...) results.
+    """
+    if word.static is not None or not word.glob and not any(
+            kind is COMMAND and not quoted or kind is PARAM and text == "@"
+            for kind, text, quoted in word.parts):
+        return [expand_word(word)]
+
+    fields: List[str] = []
+    current: List[str] = []
+    pattern: List[str] = []     # current with non-pattern text escaped
+    magic = False               # current has unquoted pattern characters
+    started = False     # current field exists (even if empty: "")
+
+    def finish_field():
+        value = "".join(current)
+        if magic:
+            matches = glob_mod.glob("".join(pattern))
+            if matches:
+                fields.extend(matches)
+                return
+        fields.append(value)
+
+    for kind, text, quoted in word.parts:
+        if kind is PARAM and text == "@":
+            # One field per positional parameter, quoted or not (and
+            # none at all if there are none)
+            pieces = shell_state.positional
+            if not pieces:
+                continue
+            keep = True
+        else:
+            value = text if kind is LITERAL \
+                else _part_value(kind, text)
+            if kind is not COMMAND or quoted:
+                current.append(value)
+                if kind is LITERAL and not quoted and word.glob:
+                    pattern.append(value)
+                    magic = magic or glob_mod.has_magic(value)
+                else:
+                    pattern.append(glob_mod.escape(value))
+                started = started or quoted or bool(value)
+                continue
+            pieces = _FIELD_SEPARATORS.split(value)
+            keep = False
+
+        current.append(pieces[0])
+        pattern.append(glob_mod.escape(pieces[0]))
+        if len(pieces) == 1:
+            started = started or keep or bool(pieces[0])
+            continue
+        if started or keep or pieces[0]:
+            finish_field()
+        fields.extend(pieces[1:-1])
+        current = [pieces[-1]]
+        pattern = [glob_mod.escape(pieces[-1])]
+        magic = False
+        started = keep or bool(pieces[-1])
+
+    if started:
+        finish_field()
+    return fields
+
+
+def _expand_token(token) -> str:
+    """Expand one token into a single string (no field splitting)"""
+    if isinstance(token, Word):
+        return expand_word(token)
+    return _expand_tilde(_expand_variables(token))
+
+
+def expand_tokens(tokens: Iterable) -> List[str]:
+    """Apply variable, command and tilde expansion to tokenized input"""
+    out: List[str] = []
+    for token in tokens:
+        if isinstance(token, Word):
+            out.extend(expand_fields(token))
+        else:
+            out.append(_expand_tilde(_expand_variables(token)))
+    return out
+
+
 def parse_command(input_str: str) -> List[str]:
     """
     Parse command line input into tokens.
 
     Features:
-      - Quote/escape-aware splitting via shlex
+      - Quote/escape-aware splitting (see lexer.py)
       - Support for comments starting with '#'
-      - Variable expansion ($VAR, ${VAR}, $?)
+      - Variable expansion ($VAR, ${VAR}, $?), not inside single quotes
       - Tilde expansion (~, ~user)
-      - Keeps operators (> < >> | &) as tokens so the shell
-        can later implement redirection and pipes.
+      - Keeps operators (> < >> 2> | & && || ;) as tokens, also when
+        written without spaces (a>b)
 
     Args:
         input_str: Raw command line input
@@ -124,61 +533,164 @@ def parse_command(input_str: str) -> List[str]:
         List of command tokens
     """
     try:
-        # shlex handles quotes and escaping similarly to a POSIX shell
-        lexer = shlex.shlex(input_str, posix=True)
-        lexer.whitespace_split = True
-        lexer.commenters = "#"   # ignore comments outside quotes
-
-        tokens = list(lexer)
-
-        expanded_tokens: List[str] = []
-        for tok in tokens:
-            tok = _expand_variables(tok)
-            tok = _expand_tilde(tok)
-            expanded_tokens.append(tok)
-
-        return expanded_tokens
+        return expand_tokens(tokenize_command(input_str))
 
     except ValueError as e:
         print_error(f"Parse error: {e}")
         return []
 
 
-def execute_command(args: List[str], background: bool = False) -> int:
+# Process creation backends for external commands:
+#   "spawn" - os.posix_spawn (vfork-style, no copy of the interpreter)
+#   "fork"  - os.fork + os.execv (portable fallback)
+SPAWN_BACKENDS = ("spawn", "fork")
+spawn_backend = "spawn" if hasattr(os, "posix_spawn") else "fork"
+
+# Signals reset to their default disposition in every child. SIGPIPE is
+# included because Python ignores it and ignored signals survive exec;
+# SIGTTOU/SIGTTIN are ignored by a job-control shell.
+_CHILD_DEFAULT_SIGNALS = (signal.SIGINT, signal.SIGTSTP, signal.SIGPIPE,
+                          signal.SIGTTOU, signal.SIGTTIN)
+
+
+def set_spawn_backend(name: str):
+    """Select how external commands are started ("spawn" or "fork")"""
+    global spawn_backend
+
+    if name not in SPAWN_BACKENDS:
+        raise ValueError(f"unknown spawn backend: {name}")
+    if name == "spawn" and not hasattr(os, "posix_spawn"):
+        raise ValueError("posix_spawn is not available on this platform")
+    spawn_backend = name
+
+
+def command_environment(assignments: Optional[Dict[str, str]] = None
+                        ) -> Dict[bytes, bytes]:
+    """
+    Environment for an external command: the exported shell variables
+    (built once until one of them changes), plus the NAME=value
+    assignments written before this command, if any.
     """
-    Execute external command using fork/exec.
+    env = shell_state.variables.environment()
+    if assignments:
+        env = dict(env)
+        for name, value in assignments.items():
+            env[os.fsencode(name)] = os.fsencode(value)
+    return env
 
-    - Foreground:
-        * Parent waits for the child with waitpid()
-        * Returns the child's exit status.
-    - Background:
-        * Parent does NOT wait.
-        * Registers the PID with add_background_process().
-        * Returns 0 if the process started successfully.
 
-    Errors:
-        127 -> command not found
-        126 -> permission denied
-        1   -> generic failure
+def _search_path(name: str) -> Optional[str]:
+    """Walk $PATH for an executable file called name"""
+    path = shell_state.variables.get("PATH", os.defpath)
+    for directory in path.split(os.pathsep):
+        candidate = os.path.join(directory or ".", name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def find_command(name: str) -> Optional[str]:
     """
-    if not args:
-        return 1
+    Locate an external command, consulting the shell's hash table first.
+
+    Names containing "/" are used as-is. Hits are counted per name; results
+    found through relative $PATH entries are not remembered because they
+    depend on the current directory.
+
+    Returns:
+        Path to execute, or None if the command is not on $PATH
+    """
+    if "/" in name:
+        return name
+
+    entry = shell_state.command_hash.get(name)
+    if entry is not None:
+        entry[1] += 1
+        return entry[0]
+
+    path = _search_path(name)
+    if path is not None and os.path.isabs(path):
+        shell_state.command_hash[name] = [path, 1]
+    return path
+
+
+def forget_command(name: str):
+    """Drop a (stale) hash table entry"""
+    shell_state.command_hash.pop(name, None)
 
+
+def clear_command_hash():
+    """Forget every remembered command location (e.g. after PATH changes)"""
+    shell_state.command_hash.clear()
+
+
+def _join_group(pid: int, pgid: Optional[int]):
+    """
+    Put pid in process group pgid (0: a new group led by pid).
+
+    Called in both the forked child and the parent, so the group exists
+    whichever of them runs first.
+    """
+    if pgid is None:
+        return
     try:
-        pid = os.fork()
-    except OSError as e:
-        print_error(f"fork failed: {e}")
-        return 1
+        os.setpgid(pid, pgid)
+    except OSError:
+        pass  # Already exec'd (parent side) or the group is gone
+
+
+def spawn_process(args: List[str], path: str,
+                  fds: Optional[FdMap] = None,
+                  pgid: Optional[int] = None,
+                  env: Optional[Dict[bytes, bytes]] = None) -> int:
+    """
+    Start the external command at path and return its PID without waiting.
+
+    Args:
+        args: argv for the new program
+        path: Resolved executable path (see find_command)
+        fds: Child fd -> shell fd to dup2 into place (stdin/stdout/pipes),
+             or None to close it
+        pgid: Process group to join, 0 for a new one, None for the shell's
+        env: Environment, by default the exported shell variables (see
+             command_environment)
+
+    With the "spawn" backend exec failures surface here as OSError
+    (FileNotFoundError, PermissionError, ...). With the "fork" backend
+    the child reports them itself and exits with 127/126/1.
+    """
+    fds = fds or {}
+    if env is None:
+        env = command_environment()
+
+    if spawn_backend == "spawn":
+        file_actions = [(os.POSIX_SPAWN_CLOSE, target) if source is None
+                        else (os.POSIX_SPAWN_DUP2, source, target)
+                        for target, source in fds.items()
+                        if source != target]
+        group = {} if pgid is None else {"setpgroup": pgid}
+        return os.posix_spawn(path, args, env,
+                              file_actions=file_actions,
+                              setsigmask=(),
+                              setsigdef=_CHILD_DEFAULT_SIGNALS,
+                              **group)
+
+    pid = os.fork()
 
     if pid == 0:
         # --- Child process ---
+        _join_group(0, pgid)
         # Reset signal handlers so Ctrl+C / Ctrl+Z affect the child normally
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        signal.signal(signal.SIGTSTP, signal.SIG_DFL)
+        for sig in _CHILD_DEFAULT_SIGNALS:
+            signal.signal(sig, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_SETMASK, ())
 
         try:
+            # Wire up pipes/redirections; the sources are close-on-exec
+            _apply_fds(fds)
+
             # Replace the child process image with the requested command
-            os.execvp(args[0], args)
+            os.execve(path, args, env)
         except FileNotFoundError:
             print_error(f"{args[0]}: command not found")
             os._exit(127)
@@ -189,382 +701,2093 @@ def execute_command(args: List[str], background: bool = False) -> int:
             print_error(f"{args[0]}: {e}")
             os._exit(1)
 
-    else:
-        # --- Parent process ---
-        if background:
-            # Track as a background job (signals_mod will manage it)
-            add_background_process(pid)
-            # Don't wait for it; shell returns to prompt immediately
-            return 0
-
-        # Foreground: wait for this specific child
-        while True:
-            try:
-                _, status = os.waitpid(pid, 0)
-                break
-            except InterruptedError:
-                # Interrupted by a signal; retry the wait
-                continue
-            except ChildProcessError:
-                # Child may already have been reaped by SIGCHLD handler
-                return 0
-
-        if os.WIFEXITED(status):
-            return os.WEXITSTATUS(status)
-        elif os.WIFSIGNALED(status):
-            # Typical shell convention: 128 + signal number
-            return 128 + os.WTERMSIG(status)
-        else:
-            return 1
-
+    _join_group(pid, pgid)
+    return pid
 
-def execute_pipeline(tokens: List[str]) -> int:
-    """Execute Piped Commands"""
-    import subprocess
 
-    commands = []
-    current_cmd = []
+def launch_command(args: List[str],
+                   fds: Optional[Dict[int, int]] = None,
+                   pgid: Optional[int] = None,
+                   env: Optional[Dict[bytes, bytes]] = None
+                   ) -> Tuple[Optional[int], int]:
+    """
+    Resolve and start an external command, reporting failures.
 
-    for token in tokens:
-        if token == "|":
-            if current_cmd:
-                commands.append(current_cmd)
-                current_cmd = []
-        else:
-            current_cmd.append(token)
-    if current_cmd:
-        commands.append(current_cmd)
+    Returns:
+        (pid, 0) on success, or (None, exit status) if it could not start:
+        127 -> command not found
+        126 -> permission denied
+        1   -> generic failure
+    """
+    path = find_command(args[0])
+    if path is None:
+        print_error(f"{args[0]}: command not found")
+        return None, 127
 
-    if len(commands) < 2:
-        print_error("Invalid pipeline command")
+    try:
+        try:
+            return spawn_process(args, path, fds, pgid, env), 0
+        except FileNotFoundError:
+            if path == args[0]:
+                raise
+            # Hashed location went away; search $PATH again once
+            forget_command(args[0])
+            path = find_command(args[0])
+            if path is None:
+                raise
+            return spawn_process(args, path, fds, pgid, env), 0
+    except FileNotFoundError:
+        print_error(f"{args[0]}: command not found")
+        return None, 127
+    except PermissionError:
+        print_error(f"{args[0]}: permission denied")
+        return None, 126
+    except OSError as e:
+        print_error(f"{spawn_backend} failed: {args[0]}: {e}")
+        return None, 1
+
+
+def _exit_status(status: int) -> int:
+    """Convert a waitpid() status into a shell exit status"""
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    elif os.WIFSIGNALED(status):
+        # Typical shell convention: 128 + signal number
+        return 128 + os.WTERMSIG(status)
+    elif os.WIFSTOPPED(status):
+        return 128 + os.WSTOPSIG(status)
+    else:
         return 1
 
-    processes = []
-
-    for i, cmd in enumerate(commands):
-        stdin = processes[i-1].stdout if i > 0 else None
-        stdout = subprocess.PIPE if i < len(commands) - 1 else None
-
-        try:
-            proc = subprocess.Popen(
-                cmd, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
-            processes.append(proc)
 
-            if i > 0:
-                processes[-2].stdout.close()
+def _lost_status(pid: int) -> int:
+    """Report a child whose status never reached the shell; returns 1"""
+    print_error(f"process {pid}: exit status lost (reaped elsewhere)")
+    return 1
 
-        except FileNotFoundError:
-            print_error(f"{cmd[0]}: command not found")
-            return 127
 
-    for proc in processes:
-        proc.wait()
+def wait_for_pids(pids: Iterable[int],
+                  interruptible: bool = False) -> Dict[int, tuple]:
+    """
+    Reap the given children in whatever order they finish.
 
-    return processes[-1].returncode if processes else 1
+    Waiting goes through the shell's central reaper (signals_mod), which
+    collects each child with its wait4() resource usage as soon as it
+    exits; background jobs finishing meanwhile are recorded there too.
+    Waiting ends early if one of the children is stopped.
 
+    Returns:
+        {pid: (wait status, rusage, time.perf_counter() when reaped)}
+    """
+    from signals_mod import wait_for_children
+    return wait_for_children(pids, interruptible)
 
-def execute_with_redirection(tokens: List[str]) -> int:
-    """Execute Commands with I/O Redirection"""
-    import subprocess
-
-    cmd_tokens = []
-    stdin_file = None
-    stdout_file = None
-    append_mode = False
-
-    i = 0
-    while i < len(tokens):
-        if tokens[i] == '>':
-            stdout_file = tokens[i+1]
-            append_mode = False
-            i += 2
-        elif tokens[i] == '>>':
-            stdout_file = tokens[i+1]
-            append_mode = True
-            i += 2
-        elif tokens[i] == '<':
-            stdin_file = tokens[i+1]
-            i += 2
-        else:
-            cmd_tokens.append(tokens[i])
-            i += 1
 
-    if not cmd_tokens:
-        print_error("No command specified for redirection")
-        return 1
+def wait_foreground(pids: Iterable[int],
+                    pgid: Optional[int]) -> Dict[int, tuple]:
+    """
+    Wait for a foreground job, giving it the terminal meanwhile (job
+    control only) so Ctrl+C/Ctrl+Z go to the job's process group.
+    """
+    from signals_mod import give_terminal_to, reclaim_terminal
 
+    give_terminal_to(pgid)
     try:
-        stdin_handle = open(stdin_file, 'r') if stdin_file else None
+        results = wait_for_pids(pids)
+    finally:
+        reclaim_terminal()
 
-        if stdout_file:
-            mode = 'a' if append_mode else 'w'
-            stdout_handle = open(stdout_file, mode)
-        else:
-            stdout_handle = None
+    # Like bash, start the next prompt on a fresh line after Ctrl+C
+    if any(os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGINT
+           for status, _, _ in results.values()):
+        print()
+    return results
 
-        if is_builtin_command(cmd_tokens[0]):
-            original_stdout = sys.stdout
-            original_stdin = sys.stdin
 
-            try:
-                if stdout_handle:
-                    sys.stdout = stdout_handle
-                if stdin_handle:
-                    sys.stdin = stdin_handle
+def _job_group(job_control: bool) -> Optional[int]:
+    """Process group for the first process of a new job"""
+    return 0 if job_control else None
 
-                result = execute_builtin(cmd_tokens)
-            finally:
-                sys.stdout = original_stdout
-                sys.stdin = original_stdin
-            return result
-        else:
-            result = subprocess.run(
-                cmd_tokens,
-                stdin=stdin_handle,
-                stdout=stdout_handle,
-                stderr=subprocess.PIPE
-            )
-            return result.returncode
-
-    except FileNotFoundError as e:
-        print_error(f"Redirection error: {e}")
-        return 1
-    finally:
-        if stdin_handle:
-            stdin_handle.close()
-        if stdout_handle:
-            stdout_handle.close()
 
+def wait_for_process(pid: int) -> int:
+    """Wait for a foreground child and return its exit status"""
+    result = wait_for_pids([pid]).get(pid)
+    return _exit_status(result[0]) if result else _lost_status(pid)
 
-def dispatch_command(tokens: List[str]) -> int:
+
+def execute_command(args: List[str], background: bool = False) -> int:
     """
-    Dispatch command to built-in or external executor.
+    Execute external command using posix_spawn (or fork/exec).
 
-    Args:
-        tokens: Parsed command tokens
+    - Foreground:
+        * Parent waits for the child with waitpid()
+        * Returns the child's exit status.
+    - Background:
+        * Parent does NOT wait.
+        * Registers the PID as a job with add_background_job().
+        * Returns 0 if the process started successfully.
+
+    Errors:
+        127 -> command not found
+        126 -> permission denied
+        1   -> generic failure
     """
-    if not tokens:
+    if not args:
         return 1
 
-    background = False
-    if tokens and tokens[-1] == "&":
-        background = True
-        tokens = tokens[:-1]  # Remove '&' from tokens
+    pid, status = launch_command(args,
+                                 pgid=_job_group(shell_state.job_control))
+    if pid is None:
+        return status
+    pgid = pid if shell_state.job_control else None
 
-    if '|' in tokens:
-        return execute_pipeline(tokens)
+    if background:
+        # Track as a background job (signals_mod will manage it)
+        add_background_job([pid], " ".join(args), pgid)
+        # Don't wait for it; shell returns to prompt immediately
+        return 0
 
-    if any(op in tokens for op in ('>', '>>', '<')):
-        return execute_with_redirection(tokens)
+    results = wait_foreground([pid], pgid)
+    if pid in results and os.WIFSTOPPED(results[pid][0]):
+        job = add_background_job([pid], " ".join(args), pgid, announce=False)
+        return settle_job(job, results)
+    if pid not in results:
+        return _lost_status(pid)
+    return _exit_status(results[pid][0])
 
-    if is_builtin_command(tokens[0]):
-        return execute_builtin(tokens)
-    else:
-        return execute_command(tokens, background)
 
+# ===============================================================================
+# COMMAND TREE EXECUTION
+# ===============================================================================
 
-def is_builtin_command(command: str) -> bool:
-    """
-    Check if command is a built-in shell command.
+# File redirection operator -> (fd it replaces, os.open flags);
+# &> and &>> replace fd 2 as well
+_REDIRECT_FLAGS = {
+    "<": (0, os.O_RDONLY),
+    ">": (1, os.O_WRONLY | os.O_CREAT | os.O_TRUNC),
+    ">>": (1, os.O_WRONLY | os.O_CREAT | os.O_APPEND),
+    "&>": (1, os.O_WRONLY | os.O_CREAT | os.O_TRUNC),
+    "&>>": (1, os.O_WRONLY | os.O_CREAT | os.O_APPEND),
+}
+
+# Inline input operators: here-documents and here-strings
+_HERE_OPERATORS = ("<<", "<<-", "<<<")
+
+# Here-documents up to this size are written straight into a pipe (which
+# always holds PIPE_BUF bytes, so nothing has to wait for the reader);
+# larger ones are written to a memfd, or fed by a thread without memfd
+HEREDOC_PIPE_LIMIT = select.PIPE_BUF
+
+
+def _here_document(data: bytes) -> int:
+    """A close-on-exec fd that reads back data (for <<EOF and <<<)"""
+    if len(data) > HEREDOC_PIPE_LIMIT and hasattr(os, "memfd_create"):
+        fd = os.memfd_create("here-document", os.MFD_CLOEXEC)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.lseek(fd, 0, os.SEEK_SET)
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    read_fd, write_fd = os.pipe()
+    if len(data) <= HEREDOC_PIPE_LIMIT:
+        os.write(write_fd, data)
+        os.close(write_fd)
+    else:
+        _thread_fds.add(write_fd)
+        threading.Thread(target=_feed_pipe, args=(write_fd, data),
+                         daemon=True).start()
+    return read_fd
 
-    Args:
-        command: Command name
 
-    Returns:
-        True if it's a built-in command
-    """
-    builtins = {
-        "exit", "cd", "pwd", "help", "jobs", "history",
-        "echo", "export", "unset", "alias"
-    }
-    return command in builtins
+def _feed_pipe(fd: int, data: bytes):
+    """Write data into a pipe, then close it (here-document writer thread)"""
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    except OSError:
+        pass    # The reader exited without reading everything
+    finally:
+        _thread_fds.discard(fd)
+        os.close(fd)
 
 
-def execute_builtin(args: List[str]) -> int:
+def _open_redirects(redirects: List[Redirect], expand: bool,
+                    fds: Optional[FdMap] = None
+                    ) -> Optional[Tuple[FdMap, List[int]]]:
     """
-    Execute built-in shell command.
+    Apply a command's redirections, left to right, on top of fds (the
+    pipe ends of a pipeline stage).
 
-    Args:
-        args: Command and arguments
+    Files are opened with os.open and reach the command as raw fds, so
+    nothing is buffered or decoded on the way. 2>&1 copies whatever fd 1
+    is at that point, as in sh: '> log 2>&1' sends both to log.
 
     Returns:
-        Exit status (0 for success, non-zero for error)
+        (fd map, opened), where opened lists the fds created here (the
+        caller closes them once the command has started); or None after
+        reporting an error
     """
-    if not args:
-        return 1
+    fds = dict(fds or {})
+    opened: List[int] = []
 
-    command = args[0]
-    # Import here to avoid circular import
-    from shell import shell_state
+    for redirect in redirects:
+        op = redirect.op
+        try:
+            target = _expand_token(redirect.target) if expand \
+                else redirect.target
+        except ExpansionError as e:
+            print_error(str(e))
+            _close_fds(opened)
+            return None
+        try:
+            if op in _HERE_OPERATORS:
+                data = target + "\n" if op == "<<<" else target
+                fd = _here_document(data.encode(errors="surrogateescape"))
+                opened.append(fd)
+                fds[0 if redirect.fd is None else redirect.fd] = fd
+                continue
 
-    if command == "pwd":
-        print(get_current_directory())
-        return 0
+            if op in (">&", "<&") and (target == "-" or target.isdigit()):
+                fd = redirect.fd
+                if fd is None:
+                    fd = 1 if op == ">&" else 0
+                fds[fd] = None if target == "-" else \
+                    _duplicate_source(fds, int(target))
+                continue
 
-    elif command == "cd":  # Change directory
-        if len(args) > 2:
-            print_error("cd: too many arguments")
-            return 1
-        if len(args) > 1:
-            target_dir = args[1]
+            if op == "<&" or (op == ">&" and redirect.fd is not None):
+                print_error(f"{target}: ambiguous redirect")
+                _close_fds(opened)
+                return None
+
+            # >&file is &>file
+            default_fd, flags = _REDIRECT_FLAGS["&>" if op == ">&" else op]
+            fd = os.open(target, flags, 0o666)
+            opened.append(fd)
+            if op in ("&>", "&>>", ">&"):
+                fds[1] = fds[2] = fd
+            else:
+                fds[default_fd if redirect.fd is None else redirect.fd] = fd
+        except OSError as e:
+            print_error(f"{target}: {e.strerror}")
+            _close_fds(opened)
+            return None
 
-            if target_dir == "-":
-                if hasattr(shell_state, "previous_directory") and shell_state.previous_directory:
-                    target_dir = shell_state.previous_directory
-                    print(target_dir)
-                else:
-                    print_error("cd: OLDPWD not set")
-                    return 1
-        else:
-            # No argument, go to home directory
-            target_dir = os.path.expanduser("~")
+    return _separate_fds(fds, opened), opened
 
-        try:
-            if hasattr(shell_state, 'previous_directory'):
-                shell_state.previous_directory = shell_state.current_directory
 
-            target_dir = os.path.expanduser(target_dir)
-            target_dir = os.path.expandvars(target_dir)
+def _duplicate_source(fds: FdMap, fd: int) -> int:
+    """The shell fd that child fd 'fd' refers to so far (for n>&fd)"""
+    source = fds[fd] if fd in fds else fd
+    if source is None:
+        raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+    os.fstat(source)    # EBADF if the shell has no such fd
+    return source
 
-            os.chdir(target_dir)
-            shell_state.current_directory = get_current_directory()
 
-            return 0
-        except OSError as e:
-            if e.errno == 2:
-                print_error(f"cd: no such file or directory: {target_dir}")
-            else:
-                print_error(f"cd: {e}")
-            return 1
+def _separate_fds(fds: FdMap, opened: List[int]) -> FdMap:
+    """
+    Make sure no fd is both copied from and replaced in the child.
 
-    elif command == "help":
-        show_help()
-        return 0
+    The child applies the map with one dup2 per entry in any order; if
+    a source were also a target (3<&0 with a pipe on 0, or an fd swap)
+    an earlier dup2 could clobber it. Such sources are first copied
+    above every target fd, in the shell.
+    """
+    clashes = {source for target, source in fds.items()
+               if source is not None and source != target and source in fds}
+    if not clashes:
+        return fds
+    lowest = max(fds) + 1
+    copies = {}
+    for source in clashes:
+        copies[source] = fcntl.fcntl(source, fcntl.F_DUPFD_CLOEXEC, lowest)
+        opened.append(copies[source])
+    return {target: copies.get(source, source) if source != target
+            else source for target, source in fds.items()}
+
+
+def _apply_fds(fds: FdMap):
+    """Wire up a child's fds in the child (fork backends)"""
+    for target, source in fds.items():
+        if source is None:
+            try:
+                os.close(target)
+            except OSError:
+                pass
+        elif source != target:
+            os.dup2(source, target)
 
-    elif command == "jobs":
-        from signals_mod import print_background_jobs
-        print_background_jobs()
-        return 0
 
-    elif command == "history":
-        show_history()
-        return 0
+def _close_fds(fds: Iterable[int]):
+    """Close shell-side copies of pipe/redirection fds"""
+    for fd in fds:
+        os.close(fd)
 
-    elif command == "echo":
-        echo_args = args[1:]
-        newline = True
 
-        if echo_args and echo_args[0] == "-n":
-            newline = False
-            echo_args = echo_args[1:]
+def _run_builtin_redirected(args: List[str], fds: FdMap) -> int:
+    """Run a builtin in the shell process with stdin/stdout/stderr redirected"""
+    original_stdout = sys.stdout
+    original_stdin = sys.stdin
+    original_stderr = sys.stderr
+    streams = []
 
-        output = " ".join(echo_args) if echo_args else ""
+    for fd in (0, 1, 2):
+        if fd in fds and fds[fd] is None:
+            print_error(f"{args[0]}: {fd}: Bad file descriptor")
+            return 1
 
-        if newline:
-            print(output)
-        else:
-            print(output, end="")
+    # One stream per shell fd, so 2>&1 shares stdout's buffer and the
+    # output keeps its order
+    writers = {1: original_stdout, 2: original_stderr}
 
-        return 0
+    def writer(source: int):
+        if source not in writers:
+            writers[source] = open(source, "w", closefd=False)
+            streams.append(writers[source])
+        return writers[source]
 
-    elif command == "export":
-        if len(args) == 1:
-            for key, value in os.environ.items():
-                print(f"export {key}='{value}'")
-            return 0
-        for arg in args[1:]:
-            if "=" not in arg:
-                if arg in os.environ:
+    try:
+        original_stdout.flush()
+        original_stderr.flush()
+        if 1 in fds:
+            sys.stdout = writer(fds[1])
+        if 2 in fds:
+            sys.stderr = writer(fds[2])
+        if 0 in fds:
+            sys.stdin = open(fds[0], "r", closefd=False)
+            streams.append(sys.stdin)
+
+        return execute_builtin(args)
+    finally:
+        sys.stdout = original_stdout
+        sys.stdin = original_stdin
+        sys.stderr = original_stderr
+        for stream in streams:
+            stream.close()
+
+
+def _fork_builtin(args: List[str], fds: FdMap,
+                  close: Iterable[int], pgid: Optional[int] = None,
+                  assignments: Optional[Dict[str, str]] = None) -> int:
+    """
+    Run a builtin or shell function as a pipeline stage in a forked
+    subshell.
+
+    Like sh, state changes made by the builtin (cd, export) stay in the
+    subshell. Returns the PID.
+    """
+    def run() -> int:
+        for name, value in (assignments or {}).items():
+            set_variable(name, value, export=True)
+        function = shell_state.functions.get(args[0])
+        if function is not None:
+            return call_function(function, args)
+        return execute_builtin(args)
+
+    return _fork_subshell(run, args[0], fds, close, pgid)
+
+
+def _fork_subshell(run: Callable[[], int], name: str, fds: FdMap,
+                   close: Iterable[int], pgid: Optional[int] = None) -> int:
+    """Fork a subshell that exits with the status of run(); returns the PID"""
+    pid = os.fork()
+
+    if pid == 0:
+        status = 1
+        try:
+            from signals_mod import reinit_after_fork
+
+            _join_group(0, pgid)
+            reinit_after_fork()
+            for sig in _CHILD_DEFAULT_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_SETMASK, ())
+            _apply_fds(fds)
+            # Drop the shell's pipe/file fds (but not its own 0-2 that a
+            # 2>&1 may have copied)
+            _close_fds({source for source in fds.values()
+                        if source is not None and source > 2
+                        and source not in fds} | set(close) | _thread_fds)
+
+            status = run()
+            sys.stdout.flush()
+        except _Unwind as e:
+            # break/return in a pipeline stage only ends the subshell
+            status = e.status
+        except BrokenPipeError:
+            status = 128 + signal.SIGPIPE
+        except Exception as e:
+            print_error(f"{name}: {e}")
+        finally:
+            os._exit(status)
+
+    _join_group(pid, pgid)
+    return pid
+
+
+def _start_stage(args: List[str], fds: Dict[int, int],
+                 close: Iterable[int], pgid: Optional[int] = None,
+                 assignments: Optional[Dict[str, str]] = None
+                 ) -> Tuple[Optional[int], int]:
+    """
+    Start one pipeline stage; returns (pid, 0) or (None, status).
+
+    assignments are the stage's VAR=value prefixes, exported to it only.
+    """
+    if not args:
+        # Only redirections (e.g. "> file"): the files were opened already;
+        # assignments in a pipeline stage belong to its subshell only
+        return None, 0
+
+    if args[0] in shell_state.functions or is_builtin_command(args[0]):
+        try:
+            return _fork_builtin(args, fds, close, pgid, assignments), 0
+        except OSError as e:
+            print_error(f"fork failed: {e}")
+            return None, 1
+
+    return launch_command(args, fds, pgid,
+                          command_environment(assignments)
+                          if assignments else None)
+
+
+# ===============================================================================
+# COMMAND SUBSTITUTION
+# ===============================================================================
+
+# First read buffer for $(...) output; doubled while it fills up
+SUBSTITUTION_BUFFER_SIZE = 64 * 1024
+
+
+def command_substitution(source: str) -> str:
+    """
+    Run the command of a $(...) and return its output, minus trailing
+    newlines.
+
+    A single builtin that only prints (echo, pwd, ...) runs in the shell
+    itself with stdout captured in memory, and a single external command
+    is spawned directly. Anything else runs through the executor in a
+    forked subshell (so cd or export inside stay inside). Output comes
+    through a pipe read in large chunks straight into a growing bytearray.
+    """
+    try:
+        tree = parse_line(source)
+    except ValueError as e:
+        print_error(f"$({source}): {e}")
+        return ""
+    if tree is None:
+        return ""
+
+    if isinstance(tree, Pipeline) and len(tree.commands) == 1 \
+            and not tree.background and not tree.timed \
+            and isinstance(tree.commands[0], SimpleCommand) \
+            and not tree.commands[0].redirects \
+            and not tree.commands[0].assignments:
+        args = expand_tokens(tree.commands[0].words)
+        if not args:
+            return ""
+        if args[0] in shell_state.functions:
+            pass        # Runs in the subshell below
+        elif not is_builtin_command(args[0]):
+            return _capture(lambda fd, _: launch_command(args, {1: fd})[0],
+                            " ".join(args), shell_state.substitution_limit)
+        if _runs_on_thread(args):
+            return _capture_builtin(args, shell_state.substitution_limit)
+        # Already expanded: run it as is
+        tree = Pipeline([SimpleCommand(args, [])], False)
+        expand = False
+    else:
+        expand = True
+
+    def subshell(fd: int, read_fd: int) -> int:
+        return _fork_subshell(lambda: execute_tree(tree, expand), "$(...)",
+                              {1: fd}, (read_fd,))
+
+    return _capture(subshell, command_text(tree),
+                    shell_state.substitution_limit)
+
+
+def _capture_builtin(args: List[str], limit: int) -> str:
+    """Run a printing builtin in-process, returning what it printed"""
+    original_stdout = sys.stdout
+    sys.stdout = buffer = io.StringIO()
+    try:
+        execute_builtin(args)
+    finally:
+        sys.stdout = original_stdout
+    output = buffer.getvalue()
+    if len(output) > limit:
+        print_error(f"{args[0]}: command substitution output truncated "
+                    f"to {limit} bytes")
+        output = output[:limit]
+    return output.rstrip("\n")
+
+
+def _capture(start: Callable[[int, int], Optional[int]], label: str,
+             limit: int) -> str:
+    """
+    Start a command with stdout on a pipe and return what it writes.
+    start(write fd, read fd) returns the PID, or None if it could not
+    start; forked children must close the read fd.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    read_fd, write_fd = os.pipe()
+    try:
+        pid = start(write_fd, read_fd)
+    except OSError as e:
+        print_error(f"fork failed: {e}")
+        pid = None
+    os.close(write_fd)
+
+    try:
+        output, size = _read_capped(read_fd, limit) if pid is not None \
+            else (bytearray(), 0)
+    finally:
+        os.close(read_fd)
+    if size > limit:
+        print_error(f"$({label}): command substitution output "
+                    f"truncated to {limit} bytes")
+        size = limit
+    if pid is not None:
+        wait_for_pids([pid])
+
+    # Trailing newlines are dropped by moving the end, not by copying
+    while size and output[size - 1] == 0x0A:
+        size -= 1
+    return str(memoryview(output)[:size], "utf-8", "surrogateescape")
+
+
+def _read_capped(fd: int, limit: int) -> Tuple[bytearray, int]:
+    """
+    Read fd to EOF into one bytearray, with readv() filling the free end
+    of the buffer in place (no per-chunk bytes objects).
+
+    Returns:
+        (buffer, bytes read); the count is limit + 1 if the output was
+        longer than limit (reading stops there)
+    """
+    buffer = bytearray(min(SUBSTITUTION_BUFFER_SIZE, limit + 1))
+    size = 0
+    while True:
+        if size == len(buffer):
+            if size > limit:
+                break
+            buffer.extend(bytes(min(len(buffer), limit + 1 - size)))
+        count = os.readv(fd, [memoryview(buffer)[size:]])
+        if count == 0:
+            break
+        size += count
+    return buffer, size
+
+
+# ===============================================================================
+# BUILTIN STAGES ON THREADS
+# ===============================================================================
+
+def _runs_on_thread(args: List[str]) -> bool:
+    """
+    True if a builtin only prints with these arguments, so a pipeline can
+    run it on a thread of the shell process instead of forking a subshell
+    (history | grep foo). Builtins that change shell state keep forking,
+    so their changes stay out of the shell as in sh (see Builtin.on_thread).
+    """
+    builtin = BUILTINS.get(args[0])
+    if builtin is None:
+        return False
+    on_thread = builtin.on_thread
+    return on_thread(args) if callable(on_thread) else on_thread
+
+
+class _StageStreams(threading.local):
+    """The redirected streams of the builtin stage on the current thread"""
+    stdin = stdout = stderr = None
+
+
+_stage_streams = _StageStreams()
+
+# fds held by builtin threads; forked subshells close their copies so a
+# pipe still sees EOF when the thread is done writing
+_thread_fds = set()
+
+
+class _ThreadStream:
+    """
+    Stand-in for sys.stdin/stdout/stderr while builtin stages run: a
+    builtin thread sees its stage's stream, every other thread the
+    original one.
+    """
+
+    def __init__(self, name: str, default):
+        self._name = name
+        self._default = default
+
+    def __getattr__(self, attr: str):
+        stream = getattr(_stage_streams, self._name) or self._default
+        return getattr(stream, attr)
+
+
+@contextlib.contextmanager
+def _thread_streams(enabled: bool):
+    """Install _ThreadStream proxies for the duration (if enabled)"""
+    if not enabled:
+        yield
+        return
+    names = ("stdin", "stdout", "stderr")
+    saved = [getattr(sys, name) for name in names]
+    for name, stream in zip(names, saved):
+        setattr(sys, name, _ThreadStream(name, stream))
+    try:
+        yield
+    finally:
+        for name, stream in zip(names, saved):
+            setattr(sys, name, stream)
+
+
+class BuiltinStage:
+    """A pipeline stage running a builtin on a thread of the shell process"""
+
+    __slots__ = ("args", "fds", "status", "real", "cpu", "thread")
+
+    def __init__(self, args: List[str], fds: FdMap):
+        self.args = args
+        # Private copies (one per shell fd, so 2>&1 stays one stream): the
+        # shell closes its pipe ends as for a process
+        copies = {source: os.dup(source) for source in set(fds.values())}
+        self.fds = {target: copies[source] for target, source in fds.items()}
+        _thread_fds.update(copies.values())
+        self.status = 1
+        self.real = 0.0         # wall-clock seconds the builtin ran
+        self.cpu = 0.0          # CPU seconds of its thread
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name=f"builtin {args[0]}")
+        self.thread.start()
+
+    def _run(self):
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        streams = {}    # (fd, mode) -> stream
+        try:
+            for fd, name, mode in ((0, "stdin", "r"), (1, "stdout", "w"),
+                                   (2, "stderr", "w")):
+                if fd in self.fds:
+                    key = (self.fds[fd], mode)
+                    if key not in streams:
+                        streams[key] = open(key[0], mode, closefd=False)
+                    setattr(_stage_streams, name, streams[key])
+            self.status = execute_builtin(self.args)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reader went away; a process would have died of SIGPIPE
+            self.status = 128 + signal.SIGPIPE
+        except Exception as e:
+            print_error(f"{self.args[0]}: {e}")
+        finally:
+            _stage_streams.stdin = None
+            _stage_streams.stdout = _stage_streams.stderr = None
+            for stream in streams.values():
+                try:
+                    stream.close()
+                except BrokenPipeError:
+                    self.status = 128 + signal.SIGPIPE
+            copies = set(self.fds.values())
+            _thread_fds.difference_update(copies)
+            _close_fds(copies)
+            self.real = time.perf_counter() - started
+            self.cpu = time.thread_time() - cpu_started
+
+    def join(self):
+        """Wait for the builtin to finish"""
+        self.thread.join()
+
+
+class StageStatus:
+    """Outcome of one pipeline stage, as exposed through $PIPESTATUS"""
+
+    __slots__ = ("command", "status", "real", "cpu", "rusage")
+
+    def __init__(self, command: List[str], status: int, real: float = 0.0,
+                 cpu: float = 0.0, rusage=None):
+        self.command = command
+        self.status = status
+        self.real = real        # wall-clock seconds from start to reaping
+        self.cpu = cpu          # user + system CPU seconds
+        self.rusage = rusage    # os.wait4() rusage, None for in-shell work
+
+    def __repr__(self):
+        return (f"StageStatus({self.command!r}, {self.status}, "
+                f"real={self.real:.3f}, cpu={self.cpu:.3f})")
+
+
+def _pipeline_status(stages: List[StageStatus]) -> int:
+    """Exit status of a whole pipeline, honouring 'set -o pipefail'"""
+
+    if "pipefail" in shell_state.options:
+        for stage in reversed(stages):
+            if stage.status:
+                return stage.status
+        return 0
+    return stages[-1].status
+
+
+# How stderr of pipeline stages is handled:
+#   "inherit" - stages write straight to the shell's stderr (no copies)
+#   "capture" - each stage gets a stderr pipe; all pipes are drained
+#               concurrently into a bounded ring buffer and reported per
+#               stage after the pipeline finishes
+PIPELINE_STDERR_MODES = ("inherit", "capture")
+
+# Bytes of stderr kept per stage in "capture" mode (the most recent ones)
+PIPELINE_STDERR_LIMIT = 64 * 1024
+
+
+class StderrRing:
+    """Fixed-size ring buffer that keeps the last bytes read from an fd"""
+
+    __slots__ = ("buffer", "end", "total")
+
+    def __init__(self, capacity: int = PIPELINE_STDERR_LIMIT):
+        self.buffer = bytearray(capacity)
+        self.end = 0        # next write position
+        self.total = 0      # bytes seen, including overwritten ones
+
+    def fill_from(self, fd: int) -> int:
+        """Read once from fd directly into the ring; returns 0 at EOF"""
+        view = memoryview(self.buffer)
+        segments = [view[self.end:]]
+        if self.end:
+            segments.append(view[:self.end])
+        count = os.readv(fd, segments)
+        self.end = (self.end + count) % len(self.buffer)
+        self.total += count
+        return count
+
+    @property
+    def dropped(self) -> int:
+        """Number of oldest bytes that were overwritten"""
+        return max(0, self.total - len(self.buffer))
+
+    def getvalue(self) -> bytes:
+        """Return the retained bytes in order"""
+        if self.total <= len(self.buffer):
+            return bytes(self.buffer[:self.total])
+        return bytes(self.buffer[self.end:] + self.buffer[:self.end])
+
+
+def _drain_stderr(rings: Dict[int, StderrRing]):
+    """Read every stage's stderr pipe until all writers have exited"""
+    import selectors
+
+    with selectors.DefaultSelector() as selector:
+        for fd, ring in rings.items():
+            selector.register(fd, selectors.EVENT_READ, ring)
+
+        remaining = len(rings)
+        while remaining:
+            for key, _ in selector.select():
+                try:
+                    count = key.data.fill_from(key.fd)
+                except InterruptedError:
                     continue
+                if count == 0:
+                    selector.unregister(key.fd)
+                    remaining -= 1
+
+
+def _report_stderr(stages: List[List[str]], rings: Dict[int, StderrRing]):
+    """Print the captured stderr of each stage that wrote any"""
+    for index, ring in enumerate(rings.values()):
+        if not ring.total:
+            continue
+        text = ring.getvalue().decode(errors="replace")
+        print(f"shell: stderr of stage {index + 1} "
+              f"({' '.join(stages[index])}):", file=sys.stderr)
+        if ring.dropped:
+            print(f"  ... {ring.dropped} earlier bytes dropped",
+                  file=sys.stderr)
+        print(text, end="" if text.endswith("\n") else "\n",
+              file=sys.stderr)
+
+
+def _run_processes(pipeline: Pipeline, expand: bool,
+                   stages: Optional[List[List[str]]] = None) -> int:
+    """
+    Run a pipeline as child processes connected with os.pipe().
+
+    Every stage gets its stdin/stdout wired with dup2 in the child; the
+    shell closes its copies right after each stage starts so readers see
+    EOF as soon as their writer exits. Stage stderr follows the shell's
+    pipeline_stderr mode (see PIPELINE_STDERR_MODES). Foreground stages
+    are reaped together and recorded in shell_state.pipestatus; under job
+    control all stages share one process group, and a stopped foreground
+    pipeline becomes a stopped job. Builtins that only print run on
+    threads of the shell instead of in forked subshells (BuiltinStage).
+    stages holds the expanded words of each stage if the caller has
+    expanded them already.
+    """
+    # Don't let buffered builtin output appear after the children's output
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    commands = pipeline.commands
+    last = len(commands) - 1
+    capture_stderr = (last > 0 and not pipeline.background
+                      and shell_state.pipeline_stderr == "capture")
+    simple = [isinstance(command, SimpleCommand) for command in commands]
+    if stages is None:
+        # Compound commands expand their words in their subshell; the
+        # text stands in for their arguments in listings
+        stages = [(expand_tokens(command.words) if expand
+                   else list(command.words)) if is_simple
+                  else [command_text(command)]
+                  for command, is_simple in zip(commands, simple)]
+    environments = [_expand_assignments(command.assignments) if is_simple
+                    else {} for command, is_simple in zip(commands, simple)]
+    # Background jobs are tracked by PID, so their builtins still fork
+    threaded = [not pipeline.background and is_simple and bool(args)
+                and not env and args[0] not in shell_state.functions
+                and is_builtin_command(args[0]) and _runs_on_thread(args)
+                for args, env, is_simple in zip(stages, environments, simple)]
+
+    with _thread_streams(any(threaded)):
+        rings: Dict[int, StderrRing] = {}
+        launched = []   # (pid or BuiltinStage or None, status, start time)
+        pids = []
+        pgid = _job_group(shell_state.job_control)
+        stdin_fd = None
+
+        for i, command in enumerate(commands):
+            args = stages[i]
+
+            read_fd = write_fd = None
+            if i < last:
+                read_fd, write_fd = os.pipe()
+
+            fds: FdMap = {}
+            if stdin_fd is not None:
+                fds[0] = stdin_fd
+            if write_fd is not None:
+                fds[1] = write_fd
+            err_read_fd = err_write_fd = None
+            if capture_stderr:
+                err_read_fd, err_write_fd = os.pipe()
+                fds[2] = err_write_fd
+                rings[err_read_fd] = StderrRing()
+
+            pid = None
+            status = 1
+            started = time.perf_counter()
+            # Explicit redirections take precedence over the pipe
+            redirected = _open_redirects(command.redirects, expand, fds)
+            if redirected is not None:
+                fds, opened = redirected
+                # A thread can't close or share the shell's own 0-2
+                if threaded[i] and all(source is not None and source > 2
+                                       for source in fds.values()):
+                    pid, status = BuiltinStage(args, fds), 0
+                elif not simple[i]:
+                    close = (read_fd,) if read_fd is not None else ()
+                    pid, status = _fork_compound(command, expand, fds,
+                                                 close, pgid)
                 else:
-                    print_error(f"export: invalid argument: {arg}")
-                    return 1
+                    close = (read_fd,) if read_fd is not None else ()
+                    pid, status = _start_stage(args, fds, close, pgid,
+                                               environments[i])
+                _close_fds(opened)
+
+            launched.append((pid, status, started))
+            if isinstance(pid, int):
+                pids.append(pid)
+                if pgid == 0:
+                    pgid = pid      # The first process leads the job's group
+
+            # Drop the shell's copies of this stage's ends of the pipes
+            if stdin_fd is not None:
+                os.close(stdin_fd)
+            if write_fd is not None:
+                os.close(write_fd)
+            if err_write_fd is not None:
+                os.close(err_write_fd)
+            stdin_fd = read_fd
+
+        command_line = " | ".join(" ".join(args) for args in stages)
+        if pgid == 0:
+            pgid = None             # Nothing started
+        if pipeline.background:
+            add_background_job(pids, command_line, pgid)
+            return 0
+
+        if rings:
+            try:
+                _drain_stderr(rings)
+            finally:
+                _close_fds(rings)
+            _report_stderr(stages, rings)
+
+        results = wait_foreground(pids, pgid)
+        for stage, _, _ in launched:
+            if isinstance(stage, BuiltinStage):
+                stage.join()
+
+    # A stopped stage ends the wait before the others are reaped
+    stopped = any(os.WIFSTOPPED(result[0]) for result in results.values())
+    records = []
+    for args, (pid, status, started) in zip(stages, launched):
+        if isinstance(pid, BuiltinStage):
+            records.append(StageStatus(args, pid.status, pid.real, pid.cpu))
+            continue
+        result = results.get(pid)
+        if result is None:
+            # Never started (status says why), still running next to a
+            # stopped stage, or reaped elsewhere
+            if pid is not None and not stopped:
+                status = _lost_status(pid)
+            records.append(StageStatus(args, status))
+            continue
+        wait_status, rusage, finished = result
+        records.append(StageStatus(args, _exit_status(wait_status),
+                                   finished - started,
+                                   rusage.ru_utime + rusage.ru_stime, rusage))
+
+    shell_state.pipestatus = records
+    if stopped:
+        job = add_background_job(pids, command_line, pgid, announce=False)
+        return settle_job(job, results)
+    return _pipeline_status(records)
+
+
+def _run_in_shell(args: List[str], redirects: List[Redirect],
+                  expand: bool,
+                  assignments: Sequence[Tuple[str, Word]] = ()) -> int:
+    """
+    Run a lone builtin, bare redirections or bare assignments (VAR=value,
+    which set shell variables) in the shell process
+    """
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+
+    redirected = _open_redirects(redirects, expand)
+    if redirected is None:
+        status = 1
+    else:
+        fds, opened = redirected
+        try:
+            if not args:
+                # Each value can use the ones assigned before it
+                for name, value in assignments:
+                    set_variable(name, expand_word(value))
+                status = 0
             else:
-                var, value = arg.split("=", 1)
-                value = value.strip("'\"")
-                os.environ[var] = value
+                with _temporary_variables(
+                        _expand_assignments(assignments)):
+                    if fds:
+                        status = _run_builtin_redirected(args, fds)
+                    else:
+                        status = execute_builtin(args)
+        finally:
+            _close_fds(opened)
+
+    shell_state.pipestatus = [
+        StageStatus(args, status, time.perf_counter() - started,
+                    time.process_time() - cpu_started)]
+    return status
+
+
+def _expand_assignments(assignments: Sequence[Tuple[str, Word]]
+                        ) -> Dict[str, str]:
+    """Values of the VAR=value words in front of a command"""
+    return {name: expand_word(value) for name, value in assignments}
+
+
+@contextlib.contextmanager
+def _temporary_variables(assignments: Dict[str, str]):
+    """Export VAR=value to a builtin for as long as it runs"""
+    if not assignments:
+        yield
+        return
+
+    variables = shell_state.variables
+    saved = [(name, variables.get(name), variables.is_exported(name))
+             for name in assignments]
+    try:
+        for name, value in assignments.items():
+            set_variable(name, value, export=True)
+        yield
+    finally:
+        for name, value, exported in saved:
+            if value is None:
+                variables.unset(name)
+                _variable_changed(name)
+                continue
+            if not exported:
+                variables.unset(name)
+            set_variable(name, value, export=exported)
+
+
+# Report printed by the 'time' keyword unless $TIMEFORMAT is set.
+# %R/%U/%S real/user/sys seconds (optional precision 0-3 and 'l' for the
+# long MMmSS.FFFs form), %P CPU percentage, %M max RSS in KB, %F/%f
+# major/minor page faults, %w/%c voluntary/involuntary context switches.
+DEFAULT_TIMEFORMAT = ("\nreal\t%3lR\nuser\t%3lU\nsys\t%3lS\n"
+                      "maxrss\t%MKB\nfaults\t%F major, %f minor\n"
+                      "ctxsw\t%w voluntary, %c involuntary")
+
+_TIMEFORMAT_PATTERN = re.compile(r"%(?:(%)|([0-3])?(l)?([RUSP])|([MFfwc]))")
+
+
+def format_times(template: str, times: Dict[str, float]) -> str:
+    """
+    Render a TIMEFORMAT template.
+
+    Args:
+        template: Format with the % escapes described at DEFAULT_TIMEFORMAT
+        times: Values keyed by their escape letter (R, U, S, P, M, F, ...)
+    """
+    def repl(match: re.Match) -> str:
+        if match.group(1):
+            return "%"
+        letter = match.group(4)
+        if letter is None:
+            return str(int(times[match.group(5)]))
+
+        precision = int(match.group(2) or 3)
+        value = times[letter]
+        if match.group(3) and letter != "P":
+            minutes, seconds = divmod(value, 60)
+            return f"{int(minutes)}m{seconds:.{precision}f}s"
+        return f"{value:.{precision}f}"
+
+    return _TIMEFORMAT_PATTERN.sub(repl, template)
+
+
+def _execute_timed(pipeline: Pipeline, expand: bool) -> int:
+    """
+    Run a pipeline prefixed with 'time' and report its cost on stderr.
+
+    User/sys time, page faults and context switches are the shell's own
+    usage while running it plus the wait4() rusage of every stage; max RSS
+    is the largest stage (or the shell, for builtins run in-process).
+    """
+    import resource
+
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+
+    status = _execute_untimed(pipeline, expand)
+
+    real = time.perf_counter() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    def self_delta(field: str) -> float:
+        return getattr(self_after, field) - getattr(self_before, field)
+
+    totals = {
+        "U": self_delta("ru_utime"), "S": self_delta("ru_stime"),
+        "F": self_delta("ru_majflt"), "f": self_delta("ru_minflt"),
+        "w": self_delta("ru_nvcsw"), "c": self_delta("ru_nivcsw"),
+        "M": 0,
+    }
+    children = [stage.rusage for stage in shell_state.pipestatus
+                if stage.rusage is not None]
+    for usage in children:
+        totals["U"] += usage.ru_utime
+        totals["S"] += usage.ru_stime
+        totals["F"] += usage.ru_majflt
+        totals["f"] += usage.ru_minflt
+        totals["w"] += usage.ru_nvcsw
+        totals["c"] += usage.ru_nivcsw
+        totals["M"] = max(totals["M"], usage.ru_maxrss)
+    if not children:
+        totals["M"] = self_after.ru_maxrss
+
+    totals["R"] = real
+    totals["P"] = (totals["U"] + totals["S"]) / real * 100 if real else 0.0
+
+    template = shell_state.variables.get("TIMEFORMAT", DEFAULT_TIMEFORMAT)
+    sys.stdout.flush()
+    print(format_times(template, totals), file=sys.stderr)
+    return status
+
+
+def execute_tree(tree: Optional[Node], expand: bool = True) -> int:
+    """
+    Execute a parsed command tree.
+
+    A lone builtin runs inside the shell process (so cd, export and exit
+    affect the shell); everything else runs as connected child processes.
+    Pipelines prefixed with 'time' report their resource usage. Lists run
+    one pipeline at a time, and each pipeline is expanded only when it is
+    reached.
+
+    Args:
+        tree: Tree from parse_line()/parse_tokens(); None is a no-op
+        expand: Expand variables/tildes in the words (False when the words
+                were expanded by the caller already)
+
+    Returns:
+        Exit status of the last pipeline that ran (of its last stage);
+        1 if a word could not be expanded (the command doesn't run)
+    """
+    if tree is None:
         return 0
+    try:
+        if isinstance(tree, CommandList):
+            return _execute_list(tree, expand)
+        if isinstance(tree, AndOrList):
+            if tree.background:
+                return _start_and_or_job(tree, expand)
+            return _execute_and_or(tree, expand)
+        if tree.timed:
+            return _execute_timed(tree, expand)
+        return _execute_untimed(tree, expand)
+    except ExpansionError as e:
+        print_error(str(e))
+        return 1
+
+
+def _interrupted(status: int) -> bool:
+    """True if a foreground command was stopped short by Ctrl+C"""
+    return status == 128 + signal.SIGINT
+
+
+def _execute_list(tree: CommandList, expand: bool) -> int:
+    """Run the items of a ';' / '&' list in order"""
+    status = 0
+    for item in tree.items:
+        status = execute_tree(item, expand)
+        if item.background:
+            continue
+        # $? of each command is visible to the next one
+        shell_state.last_exit_status = status
+        if not shell_state.running or _interrupted(status):
+            break       # 'exit', or Ctrl+C abandons the rest of the line
+    return status
+
+
+def _execute_and_or(tree: AndOrList, expand: bool) -> int:
+    """Run 'a && b || c' left to right, skipping as the statuses dictate"""
+    status = execute_tree(tree.first, expand)
+    for op, pipeline in tree.rest:
+        if not shell_state.running or _interrupted(status):
+            break
+        if (status == 0) != (op == AND):
+            continue    # Skipped pipelines are never expanded
+        shell_state.last_exit_status = status
+        status = execute_tree(pipeline, expand)
+    return status
+
+
+def _start_and_or_job(tree: AndOrList, expand: bool) -> int:
+    """Run 'a && b &' in a forked subshell registered as a background job"""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pgid = _job_group(shell_state.job_control)
+    try:
+        pid = _fork_subshell(lambda: _execute_and_or(tree, expand),
+                             "subshell", {}, (), pgid)
+    except OSError as e:
+        print_error(f"fork failed: {e}")
+        return 1
+    add_background_job([pid], command_text(tree),
+                       pid if pgid is not None else None)
+    return 0
+
+
+# ===============================================================================
+# CONTROL FLOW
+# ===============================================================================
+
+# Nested function calls allowed (each call takes a few dozen Python frames)
+MAX_FUNCTION_DEPTH = 100
+
+# Python recursion limit once functions are defined
+PYTHON_STACK_FRAMES = 10_000
+
+
+class _Unwind(Exception):
+    """Raised by break, continue and return to leave the commands around"""
+
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
 
-    elif command == "unset":
-        if len(args) != 2:
-            print_error("unset: usage: unset VAR")
-            return 1
 
-        var = args[1]
-        if var in os.environ:
-            del os.environ[var]
+class _LoopControl(_Unwind):
+    """break / continue, caught by the loop 'levels' loops out"""
+
+    def __init__(self, levels: int, stop: bool):
+        super().__init__(0)
+        self.levels = levels
+        self.stop = stop        # break; continue otherwise
+
+
+class _FunctionReturn(_Unwind):
+    """return, caught by the function call"""
+
+
+def _stopped(status: int) -> bool:
+    """True if a compound command must not go on ('exit' or Ctrl+C)"""
+    return not shell_state.running or _interrupted(status)
+
+
+def _run_body(node: Node, expand: bool) -> int:
+    """Run one command list of a compound command, updating $?"""
+    status = execute_tree(node, expand)
+    if not node.background:
+        shell_state.last_exit_status = status
+    return status
+
+
+def _execute_compound(command: Compound, expand: bool) -> int:
+    """
+    Run a compound command in the current process (the redirections
+    written after it are applied by the caller).
+
+    The tree was built once by the parser; every iteration of a loop and
+    every call of a function walks the same nodes, expanding words as it
+    reaches them.
+    """
+    if isinstance(command, If):
+        for condition, body in command.clauses:
+            status = _run_body(condition, expand)
+            if _stopped(status):
+                return status
+            if status == 0:
+                return _run_body(body, expand)
+        if command.else_body is not None:
+            return _run_body(command.else_body, expand)
         return 0
+    if isinstance(command, (WhileLoop, ForLoop)):
+        return _execute_loop(command, expand)
+    if isinstance(command, BraceGroup):
+        return _run_body(command.body, expand)
 
-    elif command == "alias":
-        if len(args) == 1:
-            if hasattr(shell_state, 'aliases') and shell_state.aliases:
-                for name, value in shell_state.aliases.items():
-                    print(f"alias {name}='{value}'")
-            return 0
-        elif len(args) == 2 and "=" in args[1]:
-            name, value = args[1].split("=", 1)
-            value = value.strip("'\"")
-            if not hasattr(shell_state, 'aliases'):
-                shell_state.aliases = {}
-            shell_state.aliases[name] = value
-            return 0
+    # FunctionDef: the body runs when the function is called
+    shell_state.functions[command.name] = command
+    # Room for MAX_FUNCTION_DEPTH calls of loops within ifs within ...
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), PYTHON_STACK_FRAMES))
+    return 0
+
+
+def _execute_loop(loop: Union[WhileLoop, ForLoop], expand: bool) -> int:
+    """
+    Run a while/until or for loop; its status is that of the last body
+    run (0 if none ran).
+
+    Ctrl+C ends the loop even when it only runs builtins, which never
+    wait for a child that could report the interrupt.
+    """
+    from signals_mod import take_interrupt
+
+    items = None
+    if isinstance(loop, ForLoop):
+        if loop.words is None:
+            words = list(shell_state.positional)
+        elif expand:
+            words = expand_tokens(loop.words)
         else:
-            print_error("alias: usage: alias [name=value]")
+            words = list(loop.words)
+        items = iter(words)
+
+    if shell_state.loop_depth == 0:
+        take_interrupt()    # A Ctrl+C from before the loop doesn't count
+    shell_state.loop_depth += 1
+    status = 0
+    try:
+        while True:
+            if take_interrupt():
+                status = 128 + signal.SIGINT
+                break
+            if items is not None:
+                item = next(items, None)
+                if item is None:
+                    break
+                set_variable(loop.name, item)
+            else:
+                condition = _run_body(loop.condition, expand)
+                if _stopped(condition):
+                    status = condition
+                    break
+                if (condition == 0) == loop.until:
+                    break
+
+            try:
+                status = _run_body(loop.body, expand)
+            except _LoopControl as control:
+                if control.levels > 1:
+                    control.levels -= 1
+                    raise
+                status = 0
+                if control.stop:
+                    break
+                continue
+            if _stopped(status):
+                break
+    finally:
+        shell_state.loop_depth -= 1
+    return status
+
+
+@contextlib.contextmanager
+def _shell_fds(fds: FdMap):
+    """
+    Apply an fd map to the shell's own fds for the duration, so that
+    builtins and the children started meanwhile all see it
+    """
+    if not fds:
+        yield
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved: Dict[int, Optional[int]] = {}
+    for target in fds:
+        try:
+            saved[target] = fcntl.fcntl(target, fcntl.F_DUPFD_CLOEXEC, 10)
+        except OSError:
+            saved[target] = None        # Not open in the shell
+    try:
+        _apply_fds(fds)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for target, copy in saved.items():
+            if copy is None:
+                try:
+                    os.close(target)
+                except OSError:
+                    pass
+            else:
+                os.dup2(copy, target)
+                os.close(copy)
+
+
+def _run_redirected(run: Callable[[], int], redirects: List[Redirect],
+                    expand: bool) -> int:
+    """Run run() in the shell with redirections on the shell's fds"""
+    if not redirects:
+        return run()
+    redirected = _open_redirects(redirects, expand)
+    if redirected is None:
+        return 1
+    fds, opened = redirected
+    try:
+        with _shell_fds(fds):
+            return run()
+    finally:
+        _close_fds(opened)
+
+
+def _run_compound(command: Compound, expand: bool) -> int:
+    """
+    Run a compound command in the shell process, so variables it sets
+    and functions it defines stay (while ...; done > file included)
+    """
+    return _run_redirected(lambda: _execute_compound(command, expand),
+                           command.redirects, expand)
+
+
+def _fork_compound(command: Compound, expand: bool, fds: FdMap,
+                   close: Iterable[int], pgid: Optional[int] = None
+                   ) -> Tuple[Optional[int], int]:
+    """Start a compound pipeline stage (or '&' job) in a subshell"""
+    name = command_text(command).split(None, 1)[0]
+    try:
+        return _fork_subshell(lambda: _execute_compound(command, expand),
+                              name, fds, close, pgid), 0
+    except OSError as e:
+        print_error(f"fork failed: {e}")
+        return None, 1
+
+
+def call_function(function: FunctionDef, args: List[str]) -> int:
+    """Run a shell function with args[1:] as its positional parameters"""
+    if shell_state.function_depth >= MAX_FUNCTION_DEPTH:
+        print_error(f"{args[0]}: maximum function nesting level exceeded "
+                    f"({MAX_FUNCTION_DEPTH})")
+        return 1
+
+    saved = shell_state.positional
+    shell_state.positional = list(args[1:])
+    shell_state.function_depth += 1
+    try:
+        return _run_compound(function.body, True)
+    except _FunctionReturn as e:
+        return e.status
+    finally:
+        shell_state.function_depth -= 1
+        shell_state.positional = saved
+
+
+def _run_function(args: List[str], redirects: List[Redirect], expand: bool,
+                  assignments: Sequence[Tuple[str, Word]] = ()) -> int:
+    """Call a shell function in the shell process (f > file, X=1 f)"""
+    function = shell_state.functions[args[0]]
+
+    def run() -> int:
+        with _temporary_variables(_expand_assignments(assignments)):
+            return call_function(function, args)
+
+    return _run_redirected(run, redirects, expand)
+
+
+def loop_control_command(args: List[str]) -> int:
+    """break [n] / continue [n]: leave or restart the n-th enclosing loop"""
+    name = args[0]
+    if shell_state.loop_depth == 0:
+        print_error(f"{name}: only meaningful in a 'for', 'while', or "
+                    f"'until' loop")
+        return 0
+    levels = 1
+    if len(args) > 1:
+        if not args[1].isdigit() or int(args[1]) == 0:
+            print_error(f"{name}: {args[1]}: loop count out of range")
             return 1
+        levels = min(int(args[1]), shell_state.loop_depth)
+    raise _LoopControl(levels, name == "break")
+
+
+def return_command(args: List[str]) -> int:
+    """return [n]: leave the running function with status n (or $?)"""
+    if shell_state.function_depth == 0:
+        print_error("return: can only 'return' from a function")
+        return 1
+    status = shell_state.last_exit_status
+    if len(args) > 1:
+        try:
+            status = int(args[1]) & 0xFF
+        except ValueError:
+            print_error(f"return: {args[1]}: numeric argument required")
+            status = 2
+    raise _FunctionReturn(status)
+
+
+def _execute_untimed(pipeline: Pipeline, expand: bool) -> int:
+    """Run a pipeline without the 'time' report"""
+    commands = pipeline.commands
+    if len(commands) == 1:
+        command = commands[0]
+        if not isinstance(command, SimpleCommand):
+            if pipeline.background:
+                return _run_processes(pipeline, expand)
+            return _run_compound(command, expand)
+        args = expand_tokens(command.words) if expand else list(command.words)
+
+        if args and args[0] in shell_state.functions \
+                and not pipeline.background:
+            return _run_function(args, command.redirects, expand,
+                                 command.assignments)
+        if not args or is_builtin_command(args[0]):
+            return _run_in_shell(args, command.redirects, expand,
+                                 command.assignments)
+        return _run_processes(pipeline, expand, [args])
+
+    return _run_processes(pipeline, expand)
+
+
+def dispatch_command(tokens: List[str]) -> int:
+    """
+    Dispatch command to built-in or external executor.
+
+    Args:
+        tokens: Parsed and already expanded command tokens
+    """
+    if not tokens:
+        return 1
+
+    try:
+        tree = parse_tokens(tokens)
+    except ParseError as e:
+        print_error(str(e))
+        return 1
+
+    return execute_tree(tree, expand=False)
+
+
+def execute_pipeline(tokens: List[str]) -> int:
+    """Execute Piped Commands (expanded tokens containing '|')"""
+    return dispatch_command(tokens)
+
+
+def execute_with_redirection(tokens: List[str]) -> int:
+    """Execute Commands with I/O Redirection (expanded tokens)"""
+    return dispatch_command(tokens)
+
+
+# Options toggled with 'set -o NAME' / 'set +o NAME'
+SHELL_OPTIONS = ("pipefail",)
+
+
+# ===============================================================================
+# BUILTIN REGISTRY
+# ===============================================================================
+
+class Builtin:
+    """A builtin command: its handler plus what the executor and help use"""
+
+    __slots__ = ("name", "handler", "usage", "description", "on_thread")
+
+    def __init__(self, name: str, handler: Callable[[List[str]], int],
+                 usage: str = "", description: str = "",
+                 on_thread: Union[bool, Callable[[List[str]], bool]] = False):
+        self.name = name
+        self.handler = handler          # handler(args) -> status; args[0]
+        self.usage = usage              # shown by 'help' (if not empty)
+        self.description = description  # lines after the usage in 'help'
+        # True (or a predicate on args) if the builtin only prints, so a
+        # pipeline may run it on a thread and $(...) in the shell; False
+        # if it changes shell state (cd, export) and must fork there
+        self.on_thread = on_thread
+
+    def __repr__(self):
+        return f"Builtin({self.name!r})"
+
+
+# Name -> Builtin, in registration order (the order of 'help')
+BUILTINS: Dict[str, Builtin] = {}
+
+
+def register_builtin(name: str, handler: Callable[[List[str]], int],
+                     usage: str = "", description: str = "",
+                     on_thread: Union[bool, Callable[[List[str]], bool]]
+                     = False) -> Builtin:
+    """
+    Add a builtin command, or replace the one with the same name.
 
+    The shell's own builtins are registered when this module loads;
+    plug-ins register theirs the same way at startup. A shell function
+    of the same name still takes precedence.
+
+    Args:
+        name: Command name
+        handler: Called with the expanded words (args[0] is the name);
+                 returns the exit status
+        usage: Synopsis for 'help' (left out of 'help' if empty)
+        description: Text shown after the usage; may span lines
+        on_thread: see Builtin.on_thread
+    """
+    builtin = Builtin(name, handler, usage, description, on_thread)
+    BUILTINS[name] = builtin
+    return builtin
+
+
+def is_builtin_command(command: str) -> bool:
+    """
+    Check if command is a built-in shell command.
+
+    Args:
+        command: Command name
+
+    Returns:
+        True if it's a built-in command
+    """
+    return command in BUILTINS
+
+
+def execute_builtin(args: List[str]) -> int:
+    """
+    Execute built-in shell command.
+
+    Args:
+        args: Command and arguments
+
+    Returns:
+        Exit status (0 for success, non-zero for error)
+    """
+    if not args:
+        return 1
+
+    builtin = BUILTINS.get(args[0])
+    if builtin is None:
+        print_error(f"Unknown built-in command: {args[0]}")
+        return 1
+    return builtin.handler(args)
+
+
+def exit_command(args: List[str]) -> int:
+    """exit [code]: stop the shell once the current command is done"""
+    status = shell_state.last_exit_status
+    if len(args) > 1:
+        try:
+            status = int(args[1])
+        except ValueError:
+            print_error(f"Invalid exit code: {args[1]}")
+            status = 1
+    shell_state.running = False
+    return status
+
+
+def pwd_command(args: List[str]) -> int:
+    """pwd: print the current directory"""
+    print(get_current_directory())
+    return 0
+
+
+def cd_command(args: List[str]) -> int:
+    """cd [dir], cd -: change directory (default: home)"""
+    if len(args) > 2:
+        print_error("cd: too many arguments")
+        return 1
+    if len(args) > 1:
+        target_dir = args[1]
+
+        if target_dir == "-":
+            if hasattr(shell_state, "previous_directory") and shell_state.previous_directory:
+                target_dir = shell_state.previous_directory
+                print(target_dir)
+            else:
+                print_error("cd: OLDPWD not set")
+                return 1
     else:
-        print_error(f"Unknown built-in command: {command}")
+        # No argument, go to home directory
+        target_dir = home_directory()
+
+    try:
+        if hasattr(shell_state, 'previous_directory'):
+            shell_state.previous_directory = shell_state.current_directory
+
+        os.chdir(target_dir)
+        new_directory = get_current_directory()
+        if new_directory != shell_state.current_directory:
+            shell_state.current_directory = new_directory
+            set_prompt()
+
+        return 0
+    except OSError as e:
+        if e.errno == 2:
+            print_error(f"cd: no such file or directory: {target_dir}")
+        else:
+            print_error(f"cd: {e}")
         return 1
 
 
-def show_help():
-    """Display help information"""
-    help_text = """
-Available commands:
-  exit [code]     - Exit the shell with optional exit code
-  cd [directory]  - Change current directory (default: home)
-  cd -            - Change to previous directory
-  pwd             - Print current working directory
-  help            - Show this help message
-  jobs            - List active background jobs
-  history         - Show command history
-  echo [-n] [text]- Print text to stdout (-n: no newline)
-  export [VAR=val]- Set environment variable or list all
-  unset VAR       - Remove environment variable
-  alias [name=cmd]- Create or list command aliases
+def jobs_command(args: List[str]) -> int:
+    """jobs: list background and stopped jobs"""
+    from signals_mod import print_background_jobs
+    print_background_jobs()
+    return 0
+
+
+def resume_command(args: List[str]) -> int:
+    """fg [%n] / bg [%n]: continue a job in the foreground / background"""
+    command = args[0]
+    if len(args) > 2:
+        print_error(f"{command}: too many arguments")
+        return 1
+    job = find_job(args[1] if len(args) > 1 else None, command)
+    if job is None:
+        return 1
+    return resume_job(job, foreground=command == "fg")
+
+
+def echo_command(args: List[str]) -> int:
+    """echo [-n] [text]: print the arguments"""
+    echo_args = args[1:]
+    newline = True
+
+    if echo_args and echo_args[0] == "-n":
+        newline = False
+        echo_args = echo_args[1:]
+
+    output = " ".join(echo_args) if echo_args else ""
+
+    if newline:
+        print(output)
+    else:
+        print(output, end="")
+
+    return 0
+
+
+def export_command(args: List[str]) -> int:
+    """export [VAR=value | VAR ...]: export variables, or list them"""
+    if len(args) == 1:
+        for key, value in shell_state.variables.exported():
+            print(f"export {key}='{value}'")
+        return 0
+    for arg in args[1:]:
+        if "=" not in arg:
+            if arg in shell_state.variables:
+                # A shell variable (VAR=value) becomes an exported one
+                shell_state.variables.export(arg)
+            else:
+                print_error(f"export: invalid argument: {arg}")
+                return 1
+        else:
+            var, value = arg.split("=", 1)
+            value = value.strip("'\"")
+            set_variable(var, value, export=True)
+    return 0
+
+
+def unset_command(args: List[str]) -> int:
+    """unset VAR: remove a variable"""
+    if len(args) != 2:
+        print_error("unset: usage: unset VAR")
+        return 1
+
+    var = args[1]
+    shell_state.variables.unset(var)
+    _variable_changed(var)
+    return 0
+
+
+def set_command(args: List[str]) -> int:
+    """set [-o|+o option]: toggle a shell option, or list them"""
+    if len(args) == 1 or args[1:] == ["-o"]:
+        for option in SHELL_OPTIONS:
+            state = "on" if option in shell_state.options else "off"
+            print(f"{option:<15} {state}")
+        return 0
+    if len(args) != 3 or args[1] not in ("-o", "+o"):
+        print_error("set: usage: set [-o|+o option]")
+        return 2
+    if args[2] not in SHELL_OPTIONS:
+        print_error(f"set: {args[2]}: invalid option name")
+        return 2
+    if args[1] == "-o":
+        shell_state.options.add(args[2])
+    else:
+        shell_state.options.discard(args[2])
+    return 0
 
+
+def hash_command(args: List[str]) -> int:
+    """hash [-r] [name ...]: list, clear or add remembered command paths"""
+    if len(args) == 1:
+        if not shell_state.command_hash:
+            print("hash: hash table empty")
+            return 0
+        print("hits\tcommand")
+        for path, hits in shell_state.command_hash.values():
+            print(f"{hits:4d}\t{path}")
+        return 0
+    if args[1:] == ["-r"]:
+        clear_command_hash()
+        return 0
+    status = 0
+    for name in args[1:]:
+        if name.startswith("-"):
+            print_error("hash: usage: hash [-r] [name ...]")
+            return 1
+        # Re-search so stale entries are refreshed, without counting a hit
+        forget_command(name)
+        if find_command(name) is None:
+            print_error(f"hash: {name}: not found")
+            status = 1
+        elif name in shell_state.command_hash:
+            shell_state.command_hash[name][1] = 0
+    return status
+
+
+# Column where builtin descriptions start in 'help'
+_HELP_COLUMN = 16
+
+_HELP_OPERATORS = """
 Special operators:
   &               - Run command in background
   |               - Pipe output between commands
-  >, >>, <        - I/O redirection
+  a; b            - Run a, then b
+  a && b, a || b  - Run b only if a succeeded / failed
+  >, >>, <        - I/O redirection (2>, 2>> for stderr, n> for fd n)
+  2>&1, >&-       - Copy fd 1 to fd 2 / close stdout
+  &>, &>>         - Redirect stdout and stderr to one file
+  <<EOF, <<< w    - Here-document (lines up to EOF) / here-string
+  VAR=value       - Set a shell variable (not passed to commands
+                    unless exported); VAR=value cmd sets it for cmd only
+  '...', "..."    - Quoting ($VAR is expanded only inside "...")
+  ${VAR:-word}    - word if VAR is unset or empty (also :=, :+, :?)
+  ${#VAR}         - Length of VAR
+  ${VAR%pat}      - VAR minus a suffix matching pat (%%: longest;
+                    # and ## for a prefix)
+  $((expr))       - Integer arithmetic (+ - * / % ** << & | ?: = ++ ...)
+  $(command)      - Command output (split into words unless in "...")
+  *, ?, [...], ** - File name patterns (** spans directories)
+  $PIPESTATUS     - Exit status of each stage of the last pipeline
+  $PIPETIMES      - wall/cpu seconds of each stage of the last pipeline
+  if c; then a; elif c; then b; else d; fi
+                  - Run the commands of the first condition that succeeds
+  while c; do a; done, until c; do a; done
+                  - Repeat a while c succeeds / fails
+  for x in words; do a; done
+                  - Run a with $x set to each word (no "in": "$@")
+  { a; b; }       - Group commands (one redirection for all of them)
+  name() { a; }   - Define a function; its arguments are $1, $2, ...,
+                    $# (count) and $@ (all)
+  time pipeline   - Report real/user/sys, max RSS, page faults and
+                    context switches (format: $TIMEFORMAT)
+  !!, !n, !-n     - Re-run the last / number n / n-th previous command
+  !prefix, !?text - Re-run the last command starting with / containing text
   Ctrl+C          - Interrupt (doesn't exit shell)
+  Ctrl+Z          - Stop the foreground job (continue it with fg/bg)
   Ctrl+D          - Exit shell
 """
-    print(help_text.strip())
 
 
-def show_history():
-    """Display command history"""
-    # Import here to avoid circular import
-    from shell import shell_state
+def _help_entry(builtin: Builtin) -> List[str]:
+    """The 'help' lines of one builtin"""
+    lines = builtin.description.split("\n")
+    indent = " " * (_HELP_COLUMN + 2)
+    if len(builtin.usage) <= _HELP_COLUMN:
+        entry = [f"  {builtin.usage:<{_HELP_COLUMN}}- {lines[0]}"]
+    else:
+        entry = [f"  {builtin.usage}", f"{indent}- {lines[0]}"]
+    entry.extend(f"{indent}  {line}" for line in lines[1:])
+    return entry
 
-    if not hasattr(shell_state, 'command_history'):
-        print("No command history available.")
-        return
 
-    if not shell_state.command_history:
+def show_help(args: List[str] = ()) -> int:
+    """Display help information"""
+    lines = ["Available commands:"]
+    for builtin in BUILTINS.values():
+        if builtin.usage:
+            lines.extend(_help_entry(builtin))
+    print("\n".join(lines))
+    print()
+    print(_HELP_OPERATORS.strip())
+    return 0
+
+
+def alias_command(args: List[str]) -> int:
+    """alias [name[=value] ...]: define aliases or print them"""
+    aliases = shell_state.aliases
+    if not args:
+        for name, alias in aliases.items():
+            print(f"alias {name}='{alias.value}'")
+        return 0
+
+    status = 0
+    for arg in args:
+        if "=" not in arg:
+            if arg in aliases:
+                print(f"alias {arg}='{aliases[arg].value}'")
+            else:
+                print_error(f"alias: {arg}: not found")
+                status = 1
+            continue
+
+        name, value = arg.split("=", 1)
+        value = value.strip("'\"")
+        if not name or any(c in name for c in " \t|&;<>()$`'\"/"):
+            print_error(f"alias: `{name}': invalid alias name")
+            status = 1
+            continue
+        try:
+            # Tokenized once here instead of on every use
+            aliases[name] = Alias(value, tokenize_command(value))
+        except ValueError as e:
+            print_error(f"alias: {name}: {e}")
+            status = 1
+            continue
+        # Cached parse trees may have used the old definition
+        parse_line.cache_clear()
+    return status
+
+
+def unalias_command(args: List[str]) -> int:
+    """unalias name ... | unalias -a"""
+    if not args:
+        print_error("unalias: usage: unalias [-a] name [name ...]")
+        return 2
+
+    status = 0
+    if args == ["-a"]:
+        shell_state.aliases.clear()
+    else:
+        for name in args:
+            if shell_state.aliases.pop(name, None) is None:
+                print_error(f"unalias: {name}: not found")
+                status = 1
+    parse_line.cache_clear()
+    return status
+
+
+def show_history(args: List[str] = ()) -> int:
+    """
+    history [N]       - show the last N entries (default 20)
+    history -s TEXT   - show the entries containing TEXT
+    history -c        - clear the history
+    """
+
+    history = shell_state.history
+    args = list(args)
+
+    if args[:1] == ["-c"]:
+        history.clear()
+        return 0
+
+    if args[:1] == ["-s"]:
+        if len(args) != 2:
+            print_error("history: usage: history -s TEXT")
+            return 2
+        entries = [(number, history.get(number))
+                   for number in reversed(history.search(args[1]))]
+    elif not args:
+        entries = history.items(20)
+    elif len(args) == 1 and args[0].isdigit():
+        entries = history.items(int(args[0]))
+    else:
+        print_error("history: usage: history [N] | -s TEXT | -c")
+        return 2
+
+    if not len(history):
         print("No commands in history.")
-        return
+        return 0
 
     print("Command history:")
-    # Show last 20
-    for i, cmd in enumerate(shell_state.command_history[-20:], 1):
-        print(f"  {i:2d}  {cmd}")
+    for number, cmd in entries:
+        print(f"  {number:4d}  {cmd}")
+    return 0
+
 
 # ===============================================================================
-# BACKGROUND PROCESS UTILITIES
+# TEST / [ BUILTIN
 # ===============================================================================
 
+# test / [ operators
+_FILE_TESTS = {
+    "-e": os.path.exists,
+    "-f": os.path.isfile,
+    "-d": os.path.isdir,
+    "-L": os.path.islink,
+    "-h": os.path.islink,
+    "-r": lambda path: os.access(path, os.R_OK),
+    "-w": lambda path: os.access(path, os.W_OK),
+    "-x": lambda path: os.access(path, os.X_OK),
+    "-s": lambda path: os.path.isfile(path) and os.path.getsize(path) > 0,
+}
+_STRING_TESTS = {
+    "=": lambda a, b: a == b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+}
+_INTEGER_TESTS = {
+    "-eq": lambda a, b: a == b,
+    "-ne": lambda a, b: a != b,
+    "-lt": lambda a, b: a < b,
+    "-le": lambda a, b: a <= b,
+    "-gt": lambda a, b: a > b,
+    "-ge": lambda a, b: a >= b,
+}
+
+
+class _TestExpression:
+    """Recursive-descent evaluator for the arguments of test / ["""
+
+    def __init__(self, operands: List[str]):
+        self.operands = operands
+        self.position = 0
+
+    def peek(self, offset: int = 0) -> Optional[str]:
+        position = self.position + offset
+        if position < len(self.operands):
+            return self.operands[position]
+        return None
+
+    def take(self) -> str:
+        token = self.peek()
+        if token is None:
+            raise ValueError("argument expected")
+        self.position += 1
+        return token
+
+    def evaluate(self) -> bool:
+        if not self.operands:
+            return False
+        result = self.either()
+        if self.position != len(self.operands):
+            raise ValueError(f"{self.operands[self.position]}: "
+                             f"unexpected argument")
+        return result
+
+    def either(self) -> bool:
+        result = self.both()
+        while self.peek() == "-o":
+            self.position += 1
+            right = self.both()
+            result = result or right
+        return result
+
+    def both(self) -> bool:
+        result = self.negation()
+        while self.peek() == "-a":
+            self.position += 1
+            right = self.negation()
+            result = result and right
+        return result
+
+    def negation(self) -> bool:
+        if self.peek() == "!" and self.peek(1) is not None:
+            self.position += 1
+            return not self.negation()
+        return self.primary()
+
+    def primary(self) -> bool:
+        token = self.take()
+        operator = self.peek()
+        if operator is not None and self.peek(1) is not None and (
+                operator in _STRING_TESTS or operator in _INTEGER_TESTS):
+            self.position += 2
+            right = self.operands[self.position - 1]
+            if operator in _STRING_TESTS:
+                return _STRING_TESTS[operator](token, right)
+            return _INTEGER_TESTS[operator](_test_integer(token),
+                                            _test_integer(right))
+        if token == "(" and operator is not None:
+            result = self.either()
+            if self.take() != ")":
+                raise ValueError("')' expected")
+            return result
+        if operator is not None and token in ("-z", "-n"):
+            self.position += 1
+            return (operator == "") == (token == "-z")
+        if operator is not None and token in _FILE_TESTS:
+            self.position += 1
+            return _FILE_TESTS[token](operator)
+        return token != ""
+
+
+def _test_integer(text: str) -> int:
+    try:
+        return int(text.strip())
+    except ValueError:
+        raise ValueError(f"{text}: integer expression expected") from None
+
+
+def test_command(args: List[str]) -> int:
+    """
+    test EXPR / [ EXPR ]: status 0 if EXPR is true, 1 if it is false and
+    2 if it is malformed
+    """
+    name = args[0]
+    operands = args[1:]
+    if name == "[":
+        if not operands or operands[-1] != "]":
+            print_error("[: missing ']'")
+            return 2
+        operands = operands[:-1]
+    try:
+        return 0 if _TestExpression(operands).evaluate() else 1
+    except ValueError as e:
+        print_error(f"{name}: {e}")
+        return 2
+
+
+# ===============================================================================
+# BACKGROUND PROCESS UTILITIES
+# ===============================================================================
 
 def handle_background_processes():
     """Handle background process management - called from main loop"""
@@ -572,7 +2795,515 @@ def handle_background_processes():
     handle_bg()
 
 
-def add_background_process(pid: int):
-    """Add process to background tracking"""
-    from signals_mod import add_background_process as add_bg
-    add_bg(pid)
+def add_background_job(pids: List[int], command: str,
+                       pgid: Optional[int] = None, announce: bool = True):
+    """Add a background pipeline to the job table"""
+    from signals_mod import add_background_job as add_bg
+    return add_bg(pids, command, pgid, announce)
+
+
+# ===============================================================================
+# JOB CONTROL
+# ===============================================================================
+
+def find_job(spec: Optional[str], command: str):
+    """
+    Resolve a job spec: %n or n, %% / %+ or None for the latest job.
+
+    Prints an error and returns None if there is no such job.
+    """
+    if spec in (None, "%", "%%", "%+"):
+        job = shell_state.jobs.current()
+        if job is None:
+            print_error(f"{command}: current: no such job")
+        return job
+
+    number = spec[1:] if spec.startswith("%") else spec
+    job = shell_state.jobs.get(int(number)) if number.isdigit() else None
+    if job is None:
+        print_error(f"{command}: {spec}: no such job")
+    return job
+
+
+def signal_job(job, sig: int):
+    """Send sig to a job's process group (or to each of its processes)"""
+    if job.pgid is not None:
+        try:
+            os.killpg(job.pgid, sig)
+        except ProcessLookupError:
+            pass
+        return
+
+    for pid in shell_state.jobs.live_pids(job):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def settle_job(job, results: Dict[int, tuple]) -> int:
+    """
+    Apply the wait results of a foreground job to the job table.
+
+    A job that stopped stays in the table and is reported; a finished one
+    is removed silently. Returns the job's exit status.
+    """
+    jobs = shell_state.jobs
+    stop_status = None
+    for pid, (wait_status, _, _) in results.items():
+        if os.WIFSTOPPED(wait_status):
+            jobs.child_stopped(pid)
+            stop_status = wait_status
+        else:
+            jobs.child_exited(pid, wait_status)
+
+    if stop_status is not None:
+        print(f"\n[{job.job_id}] Stopped  {job.command}")
+        return _exit_status(stop_status)
+
+    jobs.remove(job)
+    return job.exit_status if job.exit_status is not None else 0
+
+
+def resume_job(job, foreground: bool) -> int:
+    """Continue a job with SIGCONT, waiting for it if foreground (fg/bg)"""
+    from jobs import RUNNING
+
+    job.state = RUNNING
+    if not foreground:
+        signal_job(job, signal.SIGCONT)
+        print(f"[{job.job_id}] {job.command} &")
+        return 0
+
+    print(job.command)
+    sys.stdout.flush()
+
+    from signals_mod import give_terminal_to
+
+    # Hand over the terminal before the job can run and read from it
+    give_terminal_to(job.pgid)
+    signal_job(job, signal.SIGCONT)
+    results = wait_foreground(shell_state.jobs.live_pids(job), job.pgid)
+    return settle_job(job, results)
+
+
+def _parse_signal(spec: str) -> Optional[int]:
+    """Signal number for '9', 'KILL' or 'SIGKILL'; None if unknown"""
+    if spec.isdigit():
+        return int(spec)
+    name = spec.upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    try:
+        return signal.Signals[name].value
+    except KeyError:
+        return None
+
+
+def kill_command(args: List[str]) -> int:
+    """kill [-s SIG | -SIG] %job|pid ...  and  kill -l"""
+    from jobs import STOPPED
+
+    if args and args[0] == "-l":
+        print(" ".join(sig.name[3:] for sig in signal.Signals
+                       if not sig.name.startswith("SIG_")))
+        return 0
+
+    sig = signal.SIGTERM
+    if args and args[0] == "-s" and len(args) > 1:
+        spec, args = args[1], args[2:]
+    elif args and args[0].startswith("-") and len(args[0]) > 1:
+        spec, args = args[0][1:], args[1:]
+    else:
+        spec = None
+    if spec is not None:
+        sig = _parse_signal(spec)
+        if sig is None:
+            print_error(f"kill: {spec}: invalid signal specification")
+            return 1
+
+    if not args:
+        print_error("kill: usage: kill [-s sigspec | -sigspec] pid | %job ...")
+        return 2
+
+    status = 0
+    for target in args:
+        if target.startswith("%"):
+            job = find_job(target, "kill")
+            if job is None:
+                status = 1
+                continue
+            signal_job(job, sig)
+            if job.state == STOPPED and sig in (signal.SIGTERM, signal.SIGHUP):
+                # A stopped process only acts on the signal once continued
+                signal_job(job, signal.SIGCONT)
+            continue
+
+        if not target.lstrip("-").isdigit():
+            print_error(f"kill: {target}: arguments must be process or "
+                        f"job IDs")
+            status = 1
+            continue
+        try:
+            os.kill(int(target), sig)
+        except ProcessLookupError:
+            print_error(f"kill: ({target}) - No such process")
+            status = 1
+        except PermissionError:
+            print_error(f"kill: ({target}) - Operation not permitted")
+            status = 1
+
+    return status
+
+
+def wait_command(args: List[str]) -> int:
+    """
+    wait [%job|pid ...]: wait for the given jobs, or every running job.
+
+    Returns the status of the last job waited for (0 with no arguments),
+    or 130 if interrupted with Ctrl+C.
+    """
+    from jobs import STOPPED
+
+    jobs = shell_state.jobs
+    if args:
+        targets = []
+        for spec in args:
+            if spec.startswith("%"):
+                job = find_job(spec, "wait")
+            elif spec.isdigit():
+                job = jobs.job_for_pid(int(spec))
+                if job is None:
+                    print_error(f"wait: pid {spec} is not a child of "
+                                f"this shell")
+            else:
+                print_error(f"wait: {spec}: not a pid or valid job spec")
+                return 2
+            if job is None:
+                return 127
+            targets.append(job)
+    else:
+        targets = [job for job in jobs if job.state != STOPPED]
+
+    status = 0
+    for job in targets:
+        if job.state == STOPPED:
+            print_error(f"wait: %{job.job_id} is stopped")
+            status = 128 + signal.SIGTSTP
+            continue
+        try:
+            results = wait_for_pids(jobs.live_pids(job), interruptible=True)
+        except KeyboardInterrupt:
+            return 130
+        status = settle_job(job, results)
+
+    return status if args else 0
+
+
+# ===============================================================================
+# PARALLEL EXECUTION
+# ===============================================================================
+
+# Children run at once by 'parallel' unless -j is given
+PARALLEL_DEFAULT_JOBS = os.cpu_count() or 1
+
+PARALLEL_USAGE = "parallel: usage: parallel [-j N] [-k] [-a file] command [arg ...]"
+
+
+class ParallelTask:
+    """One command run by 'parallel', with its buffered stdout"""
+
+    __slots__ = ("index", "args", "pid", "job", "fd", "output", "status",
+                 "exited")
+
+    def __init__(self, index: int, args: List[str]):
+        self.index = index          # position in the input
+        self.args = args
+        self.pid = None
+        self.job = None             # entry in the shell's job table
+        self.fd = None              # read end of the stdout pipe
+        self.output = bytearray()
+        self.status = None
+        self.exited = False
+
+    @property
+    def finished(self) -> bool:
+        """Reaped and its output fully read"""
+        return self.exited and self.fd is None
+
+
+def _parallel_args(template: List[str], line: str) -> List[str]:
+    """Substitute line for {} in template, or append it if there is none"""
+    if any("{}" in word for word in template):
+        return [word.replace("{}", line) for word in template]
+    return template + [line]
+
+
+def _write_output(data: bytes):
+    """Write a child's captured output to the shell's (maybe redirected) stdout"""
+    if not data:
+        return
+    sys.stdout.flush()
+    buffer = getattr(sys.stdout, "buffer", None)
+    if buffer is not None:
+        buffer.write(data)
+        buffer.flush()
+    else:
+        sys.stdout.write(data.decode(errors="replace"))
+
+
+def _start_parallel_task(task: ParallelTask, pgid: Optional[int]) -> bool:
+    """Launch a task with stdin from /dev/null and stdout into a pipe"""
+    read_fd, write_fd = os.pipe()
+    devnull = os.open(os.devnull, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        pid, status = launch_command(task.args, {0: devnull, 1: write_fd},
+                                     pgid)
+    finally:
+        os.close(devnull)
+        os.close(write_fd)
+
+    if pid is None:
+        os.close(read_fd)
+        task.status = status
+        task.exited = True
+        return False
+
+    task.pid = pid
+    task.fd = read_fd
+    task.job = add_background_job([pid], " ".join(task.args),
+                                  pid if pgid == 0 else None, announce=False)
+    return True
+
+
+def run_parallel(template: List[str], lines: List[str], max_jobs: int,
+                 keep_order: bool = False) -> int:
+    """
+    Run template once per line with at most max_jobs children at a time.
+
+    Children are started through launch_command() and listed in the job
+    table while they run. Each child's stdout is buffered and written as
+    one block when it finishes (in input order with keep_order), so
+    outputs never interleave. Ctrl+C terminates the running children and
+    starts no new ones.
+
+    Returns:
+        0 if every command succeeded, 1 if any failed, 130 if cancelled
+    """
+    from collections import deque
+    from signals_mod import collect_children, wait_for_events, watch_children
+
+    tasks = [ParallelTask(i, _parallel_args(template, line))
+             for i, line in enumerate(lines)]
+    pending = deque(tasks)
+    running: Dict[int, ParallelTask] = {}       # pid -> task
+    readers: Dict[int, ParallelTask] = {}       # stdout fd -> task
+    pgid = _job_group(shell_state.job_control)
+    next_output = 0
+    cancelled = False
+
+    def retire(task: ParallelTask):
+        nonlocal next_output
+        if task.job is not None:
+            shell_state.jobs.remove(task.job)
+        if not keep_order:
+            _write_output(task.output)
+            task.output = bytearray()
+            return
+        while next_output < len(tasks) and tasks[next_output].finished:
+            _write_output(tasks[next_output].output)
+            tasks[next_output].output = bytearray()
+            next_output += 1
+
+    def cancel():
+        nonlocal cancelled
+        cancelled = True
+        pending.clear()
+        print()     # Leave the ^C line, as after a foreground job
+        for task in running.values():
+            signal_job(task.job, signal.SIGTERM)
+
+    sys.stdout.flush()
+    try:
+        while pending or running or readers:
+            while pending and len(running) < max_jobs:
+                task = pending.popleft()
+                if _start_parallel_task(task, pgid):
+                    watch_children([task.pid])
+                    running[task.pid] = task
+                    readers[task.fd] = task
+                else:
+                    retire(task)
+            if not running and not readers:
+                continue
+
+            try:
+                ready, signals = wait_for_events(readers)
+            except KeyboardInterrupt:
+                # Default SIGINT handling (non-interactive shell)
+                ready, signals = set(), {signal.SIGINT}
+            if signal.SIGINT in signals and not cancelled:
+                cancel()
+
+            for fd in ready:
+                task = readers[fd]
+                data = os.read(fd, 65536)
+                if data:
+                    task.output += data
+                    continue
+                os.close(fd)
+                del readers[fd]
+                task.fd = None
+                if task.exited:
+                    retire(task)
+
+            for pid, (wait_status, _, _) in collect_children(running).items():
+                if os.WIFSTOPPED(wait_status):
+                    watch_children([pid])   # Keep waiting once continued
+                    continue
+                task = running.pop(pid)
+                task.status = _exit_status(wait_status)
+                task.exited = True
+                shell_state.jobs.child_exited(pid, wait_status)
+                if task.finished:
+                    retire(task)
+    finally:
+        if running:
+            # Interrupted by an exception: don't leave children behind
+            for task in running.values():
+                signal_job(task.job, signal.SIGTERM)
+                if task.job is not None:
+                    shell_state.jobs.remove(task.job)
+            wait_for_pids(running)
+        _close_fds(readers)
+
+    if cancelled:
+        return 130
+
+    failed = [task for task in tasks if task.status]
+    if failed:
+        print_error(f"parallel: {len(failed)} of {len(tasks)} jobs failed")
+        for task in failed:
+            print(f"  exit {task.status}: {' '.join(task.args)}",
+                  file=sys.stderr)
+        return 1
+    return 0
+
+
+def parallel_command(args: List[str]) -> int:
+    """parallel [-j N] [-k] [-a file] command [arg ...]"""
+    max_jobs = PARALLEL_DEFAULT_JOBS
+    keep_order = False
+    input_file = None
+
+    while args and args[0].startswith("-"):
+        option, args = args[0], args[1:]
+        if option == "--":
+            break
+        elif option == "-k":
+            keep_order = True
+        elif option in ("-j", "-a"):
+            if not args:
+                print_error(PARALLEL_USAGE)
+                return 2
+            value, args = args[0], args[1:]
+            if option == "-a":
+                input_file = value
+            elif value.isdigit() and int(value) > 0:
+                max_jobs = int(value)
+            else:
+                print_error(f"parallel: {value}: invalid job count")
+                return 2
+        elif option.startswith("-j") and option[2:].isdigit() \
+                and int(option[2:]) > 0:
+            max_jobs = int(option[2:])
+        else:
+            print_error(f"parallel: {option}: invalid option")
+            print_error(PARALLEL_USAGE)
+            return 2
+
+    if not args:
+        print_error(PARALLEL_USAGE)
+        return 2
+
+    try:
+        if input_file is not None:
+            with open(input_file, "r") as stream:
+                lines = stream.read().splitlines()
+        else:
+            lines = sys.stdin.read().splitlines()
+    except OSError as e:
+        print_error(f"parallel: {input_file}: {e.strerror}")
+        return 1
+
+    lines = [line for line in lines if line.strip()]
+    return run_parallel(args, lines, max_jobs, keep_order)
+
+
+def _listing_only(args: List[str]) -> bool:
+    """on_thread for builtins that only print when given no arguments"""
+    return len(args) == 1
+
+
+# The shell's own builtins, in the order 'help' lists them
+register_builtin("exit", exit_command, "exit [code]",
+                 "Exit the shell with optional exit code")
+register_builtin("cd", cd_command, "cd [dir], cd -",
+                 "Change current directory (default: home; -: the\n"
+                 "previous one)")
+register_builtin("pwd", pwd_command, "pwd",
+                 "Print current working directory", on_thread=True)
+register_builtin("help", show_help, "help", "Show this help message",
+                 on_thread=True)
+register_builtin("jobs", jobs_command, "jobs", "List active background jobs",
+                 on_thread=True)
+register_builtin("fg", resume_command, "fg [%n]",
+                 "Continue job n (default: latest) in the foreground")
+register_builtin("bg", resume_command, "bg [%n]",
+                 "Continue stopped job n in the background")
+register_builtin("kill", lambda args: kill_command(args[1:]),
+                 "kill [-SIG] %n|pid",
+                 "Send a signal (default TERM) to a job or process")
+register_builtin("wait", lambda args: wait_command(args[1:]),
+                 "wait [%n|pid]",
+                 "Wait for a job (default: all background jobs)")
+register_builtin("parallel", lambda args: parallel_command(args[1:]),
+                 "parallel [-j N] [-k] [-a file] cmd [args]",
+                 "Run cmd once per input line, at most N at a time\n"
+                 "({} is replaced by the line, else it is appended;\n"
+                 "-k keeps output in input order)")
+register_builtin("history", lambda args: show_history(args[1:]),
+                 "history [N]", "Show the last N commands (default 20)\n"
+                 "-s text: those containing text; -c: clear history",
+                 on_thread=lambda args: "-c" not in args)
+register_builtin("echo", echo_command, "echo [-n] [text]",
+                 "Print text to stdout (-n: no newline)", on_thread=True)
+register_builtin("export", export_command, "export [VAR=val]",
+                 "Pass a variable to commands, or list exported ones",
+                 on_thread=_listing_only)
+register_builtin("unset", unset_command, "unset VAR", "Remove a variable")
+register_builtin("alias", lambda args: alias_command(args[1:]),
+                 "alias [name=cmd]", "Create or list command aliases",
+                 on_thread=_listing_only)
+register_builtin("unalias", lambda args: unalias_command(args[1:]),
+                 "unalias name|-a", "Remove aliases (-a: all of them)")
+register_builtin("hash", hash_command, "hash [-r] [name]",
+                 "List, clear (-r) or add remembered command locations",
+                 on_thread=_listing_only)
+register_builtin("set", set_command, "set [-+]o [opt]",
+                 "Set/unset a shell option (pipefail) or list them",
+                 on_thread=_listing_only)
+register_builtin("true", lambda args: 0, "true, false, :",
+                 "Succeed / fail without doing anything", on_thread=True)
+register_builtin("false", lambda args: 1, on_thread=True)
+register_builtin(":", lambda args: 0, on_thread=True)
+register_builtin("test", test_command, "test EXPR, [ EXPR ]",
+                 "Check files (-e -f -d -r -w -x -s -L), strings\n"
+                 "(-z -n = != < >) or integers (-eq -ne -lt -le -gt\n"
+                 "-ge); combine with ! -a -o ( )", on_thread=True)
+register_builtin("[", test_command, on_thread=True)
+register_builtin("break", loop_control_command, "break [n], continue [n]",
+                 "Leave / restart the n-th enclosing loop")
+register_builtin("continue", loop_control_command)
+register_builtin("return", return_command, "return [n]",
+                 "Leave a function with status n")
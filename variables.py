@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Shell Variables Module for Custom Shell
+
+Variables live in the shell, not in os.environ. VAR=value creates a
+shell variable that commands don't see; 'export' marks it to be passed
+on. Started with the shell's own environment, every inherited variable
+is exported.
+
+Commands get the environment built from the exported variables only.
+It is kept already encoded (bytes), so posix_spawn/execve use it as is,
+and rebuilt only after an exported variable changes; setting unexported
+variables (loop counters, results of $(...)) never touches it.
+"""
+
+import os
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+
+class ExpansionError(ValueError):
+    """Raised when a word can't be expanded (${VAR:?}, bad $((...)))"""
+
+
+class Variables:
+    """Shell variables with export flags and a cached child environment"""
+
+    def __init__(self, environ: Optional[Dict[str, str]] = None):
+        values = os.environ if environ is None else environ
+        self._values: Dict[str, str] = dict(values)
+        self._exported: Set[str] = set(self._values)
+        self._environment: Optional[Dict[bytes, bytes]] = None
+        self.rebuilds = 0             # times the environment was built
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._values
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        """Value of a variable, or default if it is unset"""
+        return self._values.get(name, default)
+
+    def is_exported(self, name: str) -> bool:
+        return name in self._exported
+
+    def set(self, name: str, value: str, export: bool = False):
+        """Assign a variable (marking it exported if export is True)"""
+        if export and name not in self._exported:
+            self._exported.add(name)
+            self._environment = None
+        elif name in self._exported and self._values.get(name) != value:
+            self._environment = None
+        self._values[name] = value
+
+    def export(self, name: str):
+        """Pass a variable on to commands (set or not, like bash)"""
+        if name not in self._exported:
+            self._exported.add(name)
+            if name in self._values:
+                self._environment = None
+
+    def unset(self, name: str):
+        """Remove a variable and its export flag"""
+        if name in self._exported:
+            self._exported.discard(name)
+            if name in self._values:
+                self._environment = None
+        self._values.pop(name, None)
+
+    def exported(self) -> Iterator[Tuple[str, str]]:
+        """Iterate the exported (name, value) pairs in name order"""
+        return iter(sorted((name, value) for name, value in
+                           self._values.items() if name in self._exported))
+
+    def environment(self) -> Dict[bytes, bytes]:
+        """The environment for new commands (do not modify)"""
+        if self._environment is None:
+            encode = os.fsencode
+            self._environment = {
+                encode(name): encode(value)
+                for name, value in self._values.items()
+                if name in self._exported}
+            self.rebuilds += 1
+        return self._environment